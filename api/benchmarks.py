@@ -0,0 +1,199 @@
+"""
+Micro-benchmarks for the game engine, run with `python manage.py bench_engine`.
+
+Each benchmark times one operation on the sample game from api/tests.py.
+Results are saved as json, and can be compared against an older results
+file to catch performance regressions.
+"""
+import copy
+import platform
+import statistics
+import time
+import timeit
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional
+
+import api.game_logic
+from api.game_logic import Location, MoveContext
+from api.models import Game, count_surviving_pieces
+from core.settings import MOVE_TIMEOUT_SECONDS
+
+
+class Benchmark(NamedTuple):
+    name: str
+    # Given the fixtures, returns the function to time
+    build: Callable[[Dict[str, Any]], Callable]
+    # If set, called before every call of the timed function (untimed) and its result is passed to it.
+    setup: Optional[Callable[[Dict[str, Any]], Callable[[], Any]]] = None
+
+
+BENCHMARKS: List[Benchmark] = []
+
+
+def benchmark(name: str, setup=None):
+    def register(build):
+        BENCHMARKS.append(Benchmark(name, build, setup))
+        return build
+    return register
+
+
+def _fresh_context(fixtures):
+    board = fixtures['board']
+    return lambda: MoveContext(board.copy(), Location(0, 0), Location(1, 0), dict(fixtures['counts']))
+
+
+@benchmark('path_straight')
+def _path_straight(fixtures):
+    ctx = MoveContext(fixtures['board'], Location(0, 0), Location(1, 0))
+    return lambda: ctx.path(Location(0, 0), Location(7, 0), False, False)
+
+
+@benchmark('path_knightrider')
+def _path_knightrider(fixtures):
+    ctx = MoveContext(fixtures['board'], Location(0, 0), Location(1, 0))
+    return lambda: ctx.path(Location(0, 1), Location(6, 4), 1, 0)
+
+
+@benchmark('path_off_board')
+def _path_off_board(fixtures):
+    ctx = MoveContext(fixtures['board'], Location(0, 0), Location(1, 0))
+    return lambda: ctx.path(Location(0, 0), Location(9, 9), False, -2)
+
+
+@benchmark('tile_of')
+def _tile_of(fixtures):
+    ctx = MoveContext(fixtures['board'], Location(0, 0), Location(1, 0))
+    piece = fixtures['board'].piece_at(Location(3, 0))
+    return lambda: ctx.tile_of(piece)
+
+
+@benchmark('tele_to', setup=_fresh_context)
+def _tele_to(fixtures):
+    return lambda ctx: ctx.tele_to(ctx.acting_piece, Location(1, 0))
+
+
+@benchmark('take', setup=_fresh_context)
+def _take(fixtures):
+    target = fixtures['board'].piece_at(Location(3, 0))
+    return lambda ctx: ctx.take(target)
+
+
+@benchmark('make_move', setup=lambda fixtures: fixtures['board'].copy)
+def _make_move(fixtures):
+    action = fixtures['move_code'].action
+    counts = fixtures['counts']
+    return lambda board: api.game_logic.make_move(action, board, Location(0, 0), Location(1, 0),
+                                                  MOVE_TIMEOUT_SECONDS, dict(counts))
+
+
+@benchmark('count_surviving_pieces')
+def _count_surviving_pieces(fixtures):
+    board = fixtures['board']
+    return lambda: count_surviving_pieces(board)
+
+
+def _reset_game(fixtures):
+    game, game_state, game_board = fixtures['game'], fixtures['game_state'], fixtures['game_board']
+    ply, result = game.ply, game.result
+    def reset():
+        game.game_state = copy.deepcopy(game_state)
+        game.board = game_board
+        game.piece_counts = dict(fixtures['counts'])
+        game.white_to_move = True
+        game.ply = ply
+        game.result = result
+        # The saved game too, a move is only saved if the ply it was made at is still current
+        Game.objects.filter(pk=game.pk).update(
+            game_state=game.game_state, board=game.board, piece_counts=game.piece_counts,
+            white_to_move=True, ply=ply, result=result)
+        return game
+    return reset
+
+
+@benchmark('game_make_move', setup=_reset_game)
+def _game_make_move(fixtures):
+    user = fixtures['game'].white_user
+    return lambda game: game.make_move((0, 0), (1, 0), user)
+
+
+def measure(func: Callable, setup: Optional[Callable[[], Any]] = None,
+            min_seconds: float = 0.2, repeat: int = 5) -> Dict[str, float]:
+    """Time func, in seconds per call.
+
+    The calls are split into `repeat` rounds of at least min_seconds / repeat each,
+    and the median and best rounds are reported.
+    """
+    round_seconds = min_seconds / repeat
+    rounds = []
+    calls = 0
+    if setup is None:
+        number, _ = timeit.Timer(func).autorange()
+        number = max(1, int(number * round_seconds / 0.2))
+        for _ in range(repeat):
+            rounds.append(timeit.Timer(func).timeit(number) / number)
+            calls += number
+    else:
+        func(setup())
+        for _ in range(repeat):
+            elapsed = 0.0
+            number = 0
+            while elapsed < round_seconds:
+                arg = setup()
+                start = time.perf_counter()
+                func(arg)
+                elapsed += time.perf_counter() - start
+                number += 1
+            rounds.append(elapsed / number)
+            calls += number
+    return {
+        'seconds': statistics.median(rounds),
+        'best_seconds': min(rounds),
+        'calls': calls,
+    }
+
+
+def run_benchmarks(fixtures: Dict[str, Any], names: Optional[Iterable[str]] = None,
+                   min_seconds: float = 0.2, repeat: int = 5) -> Dict[str, Any]:
+    """Run the benchmarks (all of them, or the ones in names) against fixtures.
+
+    fixtures needs 'board' (an ArrayBoard), 'counts', 'move_code' (a CompiledMoveCode),
+    'game' (a saved Game where white can move (0, 0) -> (1, 0)) and its initial 'game_state' and 'game_board'.
+    """
+    selected = set(names) if names is not None else None
+    results = {}
+    for bench in BENCHMARKS:
+        if selected is not None and bench.name not in selected:
+            continue
+        func = bench.build(fixtures)
+        setup = bench.setup(fixtures) if bench.setup is not None else None
+        results[bench.name] = measure(func, setup, min_seconds, repeat)
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+
+class Comparison(NamedTuple):
+    name: str
+    baseline_seconds: float
+    seconds: float
+
+    @property
+    def ratio(self) -> float:
+        return self.seconds / self.baseline_seconds
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[Comparison]:
+    """Compare two outputs of run_benchmarks, for the benchmarks that are in both.
+
+    Returns the benchmarks that got slower by more than threshold (e.g. 0.1 is 10%).
+    """
+    regressions = []
+    for name, result in results['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        comparison = Comparison(name, before['seconds'], result['seconds'])
+        if comparison.ratio > 1 + threshold:
+            regressions.append(comparison)
+    return regressions
@@ -0,0 +1,763 @@
+"""
+Compile blockly move workspaces to python, without the convert_code_server.
+
+This is a port of the python generators in frontend/src/blockly.ts, and of
+the parts of Blockly's own python generator that the toolbox in
+ImplementationSandbox.tsx can reach (if, for loops, typed variables, math
+and logic). It gives exactly the same source as the js generator, so moves
+that were converted by the convert_code_server before behave the same.
+
+api/blockly_corpus has workspaces along with the source that the js
+generator produces for them. api/tests.py checks this module against it,
+and frontend/check_blockly_corpus.ts checks the js generator against it.
+"""
+import math
+import re
+import urllib.parse
+from decimal import Decimal
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
+
+# Bump this whenever the generated source changes, here or in frontend/src/blockly.ts,
+# so that api.move_cache doesn't keep using source from the old generator
+GENERATOR_VERSION = 1
+
+# Operator precedence, from Blockly's python generator. Lower binds tighter.
+ORDER_ATOMIC = 0
+ORDER_MEMBER = 2.1
+ORDER_FUNCTION_CALL = 2.2
+ORDER_EXPONENTIATION = 3
+ORDER_UNARY_SIGN = 4
+ORDER_MULTIPLICATIVE = 5
+ORDER_ADDITIVE = 6
+ORDER_RELATIONAL = 11
+ORDER_LOGICAL_NOT = 12
+ORDER_LOGICAL_AND = 13
+ORDER_LOGICAL_OR = 14
+ORDER_NONE = 99
+
+# (outer, inner) pairs that don't need parentheses even though they have the same precedence
+ORDER_OVERRIDES = {
+    (ORDER_FUNCTION_CALL, ORDER_MEMBER),
+    (ORDER_FUNCTION_CALL, ORDER_FUNCTION_CALL),
+    (ORDER_MEMBER, ORDER_MEMBER),
+    (ORDER_MEMBER, ORDER_FUNCTION_CALL),
+    (ORDER_LOGICAL_NOT, ORDER_LOGICAL_NOT),
+    (ORDER_LOGICAL_AND, ORDER_LOGICAL_AND),
+    (ORDER_LOGICAL_OR, ORDER_LOGICAL_OR),
+}
+
+INDENT = '  '
+PASS = INDENT + 'pass\n'
+COMMENT_WRAP = 60
+
+RESERVED_WORDS = set((
+    'False,None,True,and,as,assert,break,class,continue,def,del,elif,else,'
+    'except,exec,finally,for,from,global,if,import,in,is,lambda,nonlocal,not,'
+    'or,pass,print,raise,return,try,while,with,yield,'
+    'NotImplemented,Ellipsis,__debug__,quit,exit,copyright,license,credits,'
+    'ArithmeticError,AssertionError,AttributeError,BaseException,'
+    'BlockingIOError,BrokenPipeError,BufferError,BytesWarning,'
+    'ChildProcessError,ConnectionAbortedError,ConnectionError,'
+    'ConnectionRefusedError,ConnectionResetError,DeprecationWarning,EOFError,'
+    'Ellipsis,EnvironmentError,Exception,FileExistsError,FileNotFoundError,'
+    'FloatingPointError,FutureWarning,GeneratorExit,IOError,ImportError,'
+    'ImportWarning,IndentationError,IndexError,InterruptedError,'
+    'IsADirectoryError,KeyError,KeyboardInterrupt,LookupError,MemoryError,'
+    'ModuleNotFoundError,NameError,NotADirectoryError,NotImplemented,'
+    'NotImplementedError,OSError,OverflowError,PendingDeprecationWarning,'
+    'PermissionError,ProcessLookupError,RecursionError,ReferenceError,'
+    'ResourceWarning,RuntimeError,RuntimeWarning,StandardError,'
+    'StopAsyncIteration,StopIteration,SyntaxError,SyntaxWarning,SystemError,'
+    'SystemExit,TabError,TimeoutError,TypeError,UnboundLocalError,'
+    'UnicodeDecodeError,UnicodeEncodeError,UnicodeError,'
+    'UnicodeTranslateError,UnicodeWarning,UserWarning,ValueError,Warning,'
+    'ZeroDivisionError,_,__build_class__,__debug__,__doc__,__import__,'
+    '__loader__,__name__,__package__,__spec__,abs,all,any,apply,ascii,'
+    'basestring,bin,bool,buffer,bytearray,bytes,callable,chr,classmethod,cmp,'
+    'coerce,compile,complex,copyright,credits,delattr,dict,dir,divmod,'
+    'enumerate,eval,exec,execfile,exit,file,filter,float,format,frozenset,'
+    'getattr,globals,hasattr,hash,help,hex,id,input,int,intern,isinstance,'
+    'issubclass,iter,len,license,list,locals,long,map,max,memoryview,min,'
+    'next,object,oct,open,ord,pow,print,property,quit,range,raw_input,reduce,'
+    'reload,repr,reversed,round,set,setattr,slice,sorted,staticmethod,str,'
+    'sum,super,tuple,type,unichr,unicode,vars,xrange,zip'
+).split(','))
+
+# Value inputs of each block, in the order the block defines them. Comments on
+# the blocks plugged into them are added above the statement that uses them.
+VALUE_INPUTS = {
+    'unit_on_tile': ['VALUE'],
+    'unit_is_on_tile': ['VALUE'],
+    'tile_of_unit': ['VALUE'],
+    'path': ['FROM_TILE', 'TO_TILE', 'BEGIN_EXCLUSIVE', 'END_EXCLUSIVE'],
+    'for_all_tiles': ['TILE_LIST'],
+    'teleport': ['FROM_UNIT', 'TO_TILE'],
+    'take': ['TARGET_UNIT'],
+    'controls_for': ['FROM', 'TO', 'BY'],
+    'logic_compare': ['A', 'B'],
+    'logic_operation': ['A', 'B'],
+    'logic_negate': ['BOOL'],
+    'math_arithmetic': ['A', 'B'],
+    'math_single': ['NUM'],
+    'variables_set': ['VALUE'],
+    'variables_set_dynamic': ['VALUE'],
+}
+
+
+
+def value_inputs(block: 'Block') -> List[str]:
+    if block.get('type') == 'controls_if':
+        extra_state = block.get('extraState') or {}
+        return [f'IF{n}' for n in range(int(extra_state.get('elseIfCount', 0)) + 1)]
+    return VALUE_INPUTS.get(block.get('type'), [])
+
+
+# Fields that hold a variable
+VARIABLE_FIELDS = {
+    'for_all_tiles': 'VAR_F',
+    'controls_for': 'VAR',
+    'variables_get': 'VAR',
+    'variables_set': 'VAR',
+    'variables_get_dynamic': 'VAR',
+    'variables_set_dynamic': 'VAR',
+}
+
+# The way to go from the position of a top level block to the order it's generated in
+SCAN_OFFSET = math.sin(math.radians(3))
+
+
+class BlocklyCompileError(Exception):
+    """The workspace can't be turned into python."""
+
+
+Block = Dict[str, Any]
+ValueCode = Tuple[str, float]
+GENERATORS: Dict[str, Callable[['Generator', Block], Union[str, ValueCode]]] = {}
+
+
+def generator(*block_types: str):
+    def register(func):
+        for block_type in block_types:
+            GENERATORS[block_type] = func
+        return func
+    return register
+
+
+def js_number_to_string(x: float) -> str:
+    """Format a number the way javascript's String(x) would."""
+    if x != x:
+        return 'NaN'
+    if math.isinf(x):
+        return 'Infinity' if x > 0 else '-Infinity'
+    if x == 0:
+        return '0'
+    if x < 0:
+        return '-' + js_number_to_string(-x)
+    # repr gives the shortest digits that round trip, which is what javascript uses too
+    _, digits, exponent = Decimal(repr(x)).normalize().as_tuple()
+    digits = ''.join(map(str, digits))
+    k = len(digits)
+    n = k + exponent
+    if k <= n <= 21:
+        return digits + '0' * (n - k)
+    if 0 < n <= 21:
+        return digits[:n] + '.' + digits[n:]
+    if -6 < n <= 0:
+        return '0.' + '0' * -n + digits
+    e = n - 1
+    mantissa = digits if k == 1 else digits[0] + '.' + digits[1:]
+    return f"{mantissa}e{'+' if e >= 0 else '-'}{abs(e)}"
+
+
+def js_number(value: Any) -> float:
+    """Convert a value to a number the way javascript's Number(value) would (for the values blockly stores)."""
+    if isinstance(value, bool):
+        return float(value)
+    if isinstance(value, (int, float)):
+        return float(value)
+    if value is None:
+        return 0.0
+    text = str(value).strip()
+    if text == '':
+        return 0.0
+    try:
+        if text in ('Infinity', '+Infinity', '-Infinity'):
+            return float(text.replace('Infinity', 'inf'))
+        if re.fullmatch(r'[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?', text):
+            return float(text)
+        if re.fullmatch(r'0[xX][0-9a-fA-F]+', text):
+            return float(int(text, 16))
+    except (ValueError, OverflowError):
+        pass
+    return math.nan
+
+
+def is_number(text: str) -> bool:
+    return re.fullmatch(r'\s*-?\d+(\.\d+)?\s*', text) is not None
+
+
+def prefix_lines(text: str, prefix: str) -> str:
+    return prefix + re.sub(r'\n(?!\Z)', '\n' + prefix, text)
+
+
+def _wrap_score(words: List[str], word_breaks: List[bool], limit: int) -> float:
+    line_lengths = [0]
+    line_punctuation = []
+    for i, word in enumerate(words):
+        line_lengths[-1] += len(word)
+        if i < len(word_breaks):
+            if word_breaks[i]:
+                line_lengths.append(0)
+                line_punctuation.append(word[-1:])
+            else:
+                line_lengths[-1] += 1
+    max_length = max(line_lengths)
+    score = 0.0
+    for i, length in enumerate(line_lengths):
+        score -= abs(limit - length) ** 1.5 * 2
+        score -= (max_length - length) ** 1.5
+        punctuation = line_punctuation[i] if i < len(line_punctuation) else None
+        if punctuation is not None and punctuation in '.?!':
+            score += limit / 3
+        elif punctuation is not None and punctuation in ',;)]}':
+            score += limit / 4
+    if len(line_lengths) > 1 and line_lengths[-1] <= line_lengths[-2]:
+        score += 0.5
+    return score
+
+
+def _wrap_mutate(words: List[str], word_breaks: List[bool], limit: int) -> List[bool]:
+    while True:
+        best_score = _wrap_score(words, word_breaks, limit)
+        best_breaks = None
+        for i in range(len(word_breaks) - 1):
+            if word_breaks[i] == word_breaks[i + 1]:
+                continue
+            mutated = list(word_breaks)
+            mutated[i] = not mutated[i]
+            mutated[i + 1] = not mutated[i + 1]
+            mutated_score = _wrap_score(words, mutated, limit)
+            if mutated_score > best_score:
+                best_score = mutated_score
+                best_breaks = mutated
+        if best_breaks is None:
+            return word_breaks
+        word_breaks = best_breaks
+
+
+def _wrap_line(text: str, limit: int) -> str:
+    if len(text) <= limit:
+        return text
+    words = re.split(r'\s+', text.strip())
+    limit = max([limit] + [len(word) for word in words])
+    score = -math.inf
+    line_count = 1
+    while True:
+        last_score = score
+        last_text = text
+        steps = len(words) / line_count
+        inserted_breaks = 1
+        word_breaks = []
+        for i in range(len(words) - 1):
+            if inserted_breaks < (i + 1.5) / steps:
+                inserted_breaks += 1
+                word_breaks.append(True)
+            else:
+                word_breaks.append(False)
+        word_breaks = _wrap_mutate(words, word_breaks, limit)
+        score = _wrap_score(words, word_breaks, limit)
+        text = ''.join(word + ('' if i >= len(word_breaks) else '\n' if word_breaks[i] else ' ')
+                       for i, word in enumerate(words))
+        line_count += 1
+        if not score > last_score:
+            return last_text
+
+
+def wrap(text: str, limit: int) -> str:
+    """Blockly's word wrapping for comments."""
+    return '\n'.join(_wrap_line(line, limit) for line in text.split('\n'))
+
+
+class Generator:
+    """Generates the python for one workspace, like Blockly's pythonGenerator.workspaceToCode."""
+    def __init__(self, workspace: Dict[str, Any]):
+        if not isinstance(workspace, dict):
+            raise BlocklyCompileError("A workspace must be a json object")
+        self.variables: Dict[str, str] = {}
+        for variable in workspace.get('variables', []):
+            self.variables[variable['id']] = variable['name']
+        self.top_blocks: List[Block] = workspace.get('blocks', {}).get('blocks', [])
+        # Blocks that are plugged into a value input, by id() since blocks are dicts
+        self.plugged: Set[int] = set()
+        for block in self.top_blocks:
+            self._register_variables(block)
+        # Names database: lower case name -> python name, and every python name handed out
+        self.names: Dict[str, Dict[str, str]] = {}
+        self.used_names: Set[str] = set()
+        self.definitions: Dict[str, str] = {}
+        self.function_names: Dict[str, str] = {}
+
+    def _register_variables(self, block: Block) -> None:
+        """Variables that a block refers to but that aren't in the workspace get created when it's loaded."""
+        for name in value_inputs(block):
+            child = self._input_block(block, name)
+            if child is not None:
+                self.plugged.add(id(child))
+        for child in self._children(block):
+            self._register_variables(child)
+        field = VARIABLE_FIELDS.get(block.get('type'))
+        if field is None:
+            return
+        value = block.get('fields', {}).get(field)
+        if isinstance(value, dict) and value.get('id') not in self.variables:
+            self.variables[value['id']] = value.get('name', value['id'])
+
+    @staticmethod
+    def _input_block(block: Block, name: str) -> Optional[Block]:
+        connection = block.get('inputs', {}).get(name)
+        if connection is None:
+            return None
+        return connection.get('block') or connection.get('shadow')
+
+    def _children(self, block: Block) -> List[Block]:
+        """Blocks connected to this one, in the order they were connected when loaded."""
+        children = [self._input_block(block, name) for name in block.get('inputs', {})]
+        next_connection = block.get('next')
+        if next_connection is not None:
+            children.append(next_connection.get('block') or next_connection.get('shadow'))
+        return [child for child in children if child is not None]
+
+    def _descendants(self, block: Block) -> List[Block]:
+        blocks = [block]
+        for child in self._children(block):
+            blocks.extend(self._descendants(child))
+        return blocks
+
+    def _used_variables(self) -> List[str]:
+        """Ids of the variables that blocks use, in the order Blockly finds them."""
+        used = []
+        # Breadth first, like Workspace.getAllBlocks(false)
+        blocks = list(self.top_blocks)
+        i = 0
+        while i < len(blocks):
+            blocks.extend(self._children(blocks[i]))
+            i += 1
+        for block in blocks:
+            field = VARIABLE_FIELDS.get(block.get('type'))
+            value = block.get('fields', {}).get(field) if field else None
+            if isinstance(value, dict) and value['id'] not in used:
+                used.append(value['id'])
+        return used
+
+    #############################################################################
+    #  NAMES
+    #############################################################################
+    @staticmethod
+    def safe_name(name: str) -> str:
+        if not name:
+            return 'unnamed'
+        name = urllib.parse.quote(name.replace(' ', '_'), safe=";,/?:@&=+$-_.!~*'()#")
+        name = re.sub(r'[^A-Za-z0-9_]', '_', name)
+        if name[0] in '0123456789':
+            name = 'my_' + name
+        return name
+
+    def get_distinct_name(self, name: str) -> str:
+        safe_name = self.safe_name(name)
+        suffix = ''
+        while safe_name + suffix in self.used_names or safe_name + suffix in RESERVED_WORDS:
+            suffix = str(int(suffix) + 1) if suffix else '2'
+        safe_name += suffix
+        self.used_names.add(safe_name)
+        return safe_name
+
+    def get_name(self, name: str, name_type: str) -> str:
+        names = self.names.setdefault(name_type, {})
+        normalized = name.lower()
+        if normalized not in names:
+            names[normalized] = self.get_distinct_name(name)
+        return names[normalized]
+
+    def variable_name(self, block: Block, field: str) -> str:
+        value = block.get('fields', {}).get(field)
+        if not isinstance(value, dict) or 'id' not in value:
+            raise BlocklyCompileError(f"Block {block.get('type')} has no variable")
+        return self.get_name(self.variables[value['id']], 'VARIABLE')
+
+    def provide_function(self, desired_name: str, code: str) -> str:
+        if desired_name not in self.definitions:
+            function_name = self.get_distinct_name(desired_name)
+            self.function_names[desired_name] = function_name
+            self.definitions[desired_name] = code.strip().replace('{name}', function_name)
+        return self.function_names[desired_name]
+
+    #############################################################################
+    #  GENERATION
+    #############################################################################
+    def workspace_to_code(self) -> str:
+        used_variables = self._used_variables()
+        for variable_id in used_variables:
+            self.get_name(self.variables[variable_id], 'VARIABLE')
+        self.definitions['variables'] = '\n'.join(
+            self.get_name(self.variables[variable_id], 'VARIABLE') + ' = None' for variable_id in used_variables)
+
+        code = []
+        ordered = sorted(self.top_blocks, key=lambda block: block.get('y', 0) + SCAN_OFFSET * block.get('x', 0))
+        for block in ordered:
+            line = self.block_to_code(block)
+            if isinstance(line, tuple):
+                # A value block that's not plugged into anything
+                line = line[0] + '\n' if line[0] else ''
+            if line:
+                code.append(line)
+        return self.finish('\n'.join(code))
+
+    def finish(self, code: str) -> str:
+        imports = []
+        definitions = []
+        for definition in self.definitions.values():
+            if re.match(r'(from\s+\S+\s+)?import\s+\S+', definition):
+                imports.append(definition)
+            else:
+                definitions.append(definition)
+        all_definitions = '\n'.join(imports) + '\n\n' + '\n\n'.join(definitions)
+        all_definitions = re.sub(r'\n\n+', '\n\n', all_definitions)
+        all_definitions = re.sub(r'\n*\Z', '\n\n\n', all_definitions, count=1)
+        code = all_definitions + code
+        code = re.sub(r'\A\s+\n', '', code, count=1)
+        code = re.sub(r'\n\s+\Z', '\n', code, count=1)
+        code = re.sub(r'[ \t]+\n', '\n', code)
+        return code
+
+    def block_to_code(self, block: Optional[Block], this_only: bool = False) -> Union[str, ValueCode]:
+        if block is None:
+            return ''
+        if block.get('enabled') is False:
+            # Skip past disabled blocks
+            return '' if this_only else self.block_to_code(self._next_block(block))
+        block_type = block.get('type')
+        func = GENERATORS.get(block_type)
+        if func is None:
+            raise BlocklyCompileError(f"Don't know how to generate code for block type \"{block_type}\"")
+        code = func(self, block)
+        if isinstance(code, tuple):
+            return self.scrub(block, code[0], True), code[1]
+        return self.scrub(block, code, this_only)
+
+    @staticmethod
+    def _next_block(block: Block) -> Optional[Block]:
+        next_connection = block.get('next')
+        if next_connection is None:
+            return None
+        return next_connection.get('block') or next_connection.get('shadow')
+
+    def _comment(self, block: Block) -> str:
+        comment = block.get('icons', {}).get('comment', {})
+        return comment.get('text', '') if isinstance(comment, dict) else ''
+
+    def scrub(self, block: Block, code: str, this_only: bool = False) -> str:
+        """Add the comments on a statement (and on blocks it uses), and the code of the blocks after it."""
+        comment_code = ''
+        if id(block) not in self.plugged:
+            comment = self._comment(block)
+            if comment:
+                comment_code += prefix_lines(wrap(comment, COMMENT_WRAP - 3) + '\n', '# ')
+            for name in value_inputs(block):
+                child = self._input_block(block, name)
+                if child is not None:
+                    comments = [self._comment(descendant) for descendant in self._descendants(child)]
+                    comments = [comment for comment in comments if comment]
+                    if comments:
+                        comment_code += prefix_lines('\n'.join(comments + ['']), '# ')
+        next_code = '' if this_only else self.block_to_code(self._next_block(block))
+        return comment_code + code + next_code
+
+    def value_to_code(self, block: Block, name: str, outer_order: float) -> str:
+        target = self._input_block(block, name)
+        if target is None:
+            return ''
+        result = self.block_to_code(target)
+        if result == '':
+            return ''
+        if not isinstance(result, tuple):
+            raise BlocklyCompileError(f"Expected a value in input {name} of {block.get('type')}")
+        code, inner_order = result
+        if not code:
+            return ''
+        outer_class = math.floor(outer_order)
+        inner_class = math.floor(inner_order)
+        parens_needed = False
+        if outer_class <= inner_class:
+            if outer_class == inner_class and outer_class in (0, 99):
+                pass
+            else:
+                parens_needed = (outer_order, inner_order) not in ORDER_OVERRIDES
+        return f"({code})" if parens_needed else code
+
+    def statement_to_code(self, block: Block, name: str) -> str:
+        code = self.block_to_code(self._input_block(block, name))
+        if not isinstance(code, str):
+            raise BlocklyCompileError(f"Expected a statement in input {name} of {block.get('type')}")
+        return prefix_lines(code, INDENT) if code else code
+
+
+def _field(block: Block, name: str, default: Any = None) -> Any:
+    return block.get('fields', {}).get(name, default)
+
+
+#############################################################################
+#  CHESS BLOCKS (frontend/src/blockly.ts)
+#############################################################################
+@generator('acting_unit')
+def _acting_unit(gen: Generator, block: Block) -> ValueCode:
+    return 'ctx.acting_piece', ORDER_MEMBER
+
+
+@generator('unit_on_tile')
+def _unit_on_tile(gen: Generator, block: Block) -> ValueCode:
+    return "ctx.board[" + gen.value_to_code(block, 'VALUE', ORDER_MEMBER) + "]['piece']", ORDER_MEMBER
+
+
+@generator('unit_is_on_tile')
+def _unit_is_on_tile(gen: Generator, block: Block) -> ValueCode:
+    return "ctx.board[" + gen.value_to_code(block, 'VALUE', ORDER_MEMBER) + "]['piece'] is not None", ORDER_RELATIONAL
+
+
+@generator('tile_of_unit')
+def _tile_of_unit(gen: Generator, block: Block) -> ValueCode:
+    return 'ctx.tile_of(' + gen.value_to_code(block, 'VALUE', ORDER_NONE) + ')', ORDER_FUNCTION_CALL
+
+
+@generator('targeted_tile')
+def _targeted_tile(gen: Generator, block: Block) -> ValueCode:
+    return 'ctx.targeted_tile', ORDER_MEMBER
+
+
+@generator('path')
+def _path(gen: Generator, block: Block) -> ValueCode:
+    args = [gen.value_to_code(block, name, ORDER_NONE) for name in VALUE_INPUTS['path']]
+    return 'ctx.path(' + ', '.join(args) + ')', ORDER_MEMBER
+
+
+@generator('chess_action')
+def _chess_action(gen: Generator, block: Block) -> str:
+    return 'def action():\r\n' + gen.statement_to_code(block, 'ACTION')
+
+
+@generator('for_all_tiles')
+def _for_all_tiles(gen: Generator, block: Block) -> str:
+    return ('for ' + gen.variable_name(block, 'VAR_F') + ' in ' +
+            gen.value_to_code(block, 'TILE_LIST', ORDER_RELATIONAL) + ":\r\n" +
+            gen.statement_to_code(block, 'DO') + "\r\n")
+
+
+@generator('teleport')
+def _teleport(gen: Generator, block: Block) -> str:
+    return ('ctx.tele_to(' + gen.value_to_code(block, 'FROM_UNIT', ORDER_NONE) + ", " +
+            gen.value_to_code(block, 'TO_TILE', ORDER_NONE) + ")\r\n")
+
+
+@generator('take')
+def _take(gen: Generator, block: Block) -> str:
+    return 'ctx.take(' + gen.value_to_code(block, 'TARGET_UNIT', ORDER_NONE) + ")\r\n"
+
+
+#############################################################################
+#  BLOCKLY'S OWN BLOCKS
+#############################################################################
+@generator('controls_if')
+def _controls_if(gen: Generator, block: Block) -> str:
+    extra_state = block.get('extraState') or {}
+    code = ''
+    for n in range(int(extra_state.get('elseIfCount', 0)) + 1):
+        condition = gen.value_to_code(block, f'IF{n}', ORDER_NONE) or 'False'
+        branch = gen.statement_to_code(block, f'DO{n}') or PASS
+        code += ('if ' if n == 0 else 'elif ') + condition + ':\n' + branch
+    if extra_state.get('hasElse'):
+        code += 'else:\n' + (gen.statement_to_code(block, 'ELSE') or PASS)
+    return code
+
+
+def _up_range(gen: Generator) -> str:
+    return gen.provide_function('upRange', 'def {name}(start, stop, step):\n'
+                                           '  while start <= stop:\n'
+                                           '    yield start\n'
+                                           '    start += abs(step)\n')
+
+
+def _down_range(gen: Generator) -> str:
+    return gen.provide_function('downRange', 'def {name}(start, stop, step):\n'
+                                             '  while start >= stop:\n'
+                                             '    yield start\n'
+                                             '    start -= abs(step)\n')
+
+
+@generator('controls_for')
+def _controls_for(gen: Generator, block: Block) -> str:
+    variable = gen.variable_name(block, 'VAR')
+    start = gen.value_to_code(block, 'FROM', ORDER_NONE) or '0'
+    end = gen.value_to_code(block, 'TO', ORDER_NONE) or '0'
+    increment = gen.value_to_code(block, 'BY', ORDER_NONE) or '1'
+    branch = gen.statement_to_code(block, 'DO') or PASS
+    code = ''
+    num = js_number_to_string
+    if is_number(start) and is_number(end) and is_number(increment):
+        # All the arguments are simple numbers
+        start_n, end_n, increment_n = float(start), float(end), abs(float(increment))
+        if start_n % 1 == 0 and end_n % 1 == 0 and increment_n % 1 == 0:
+            if start_n <= end_n:
+                end_n += 1
+                if start_n == 0 and increment_n == 1:
+                    range_code = num(end_n)
+                else:
+                    range_code = num(start_n) + ', ' + num(end_n)
+                if increment_n != 1:
+                    range_code += ', ' + num(increment_n)
+            else:
+                end_n -= 1
+                range_code = num(start_n) + ', ' + num(end_n) + ', -' + num(increment_n)
+            range_code = 'range(' + range_code + ')'
+        else:
+            range_code = _up_range(gen) if start_n < end_n else _down_range(gen)
+            range_code += '(' + num(start_n) + ', ' + num(end_n) + ', ' + num(increment_n) + ')'
+    else:
+        # Don't look up non-trivial values more than once
+        def scrub(arg: str, suffix: str) -> Union[str, float]:
+            nonlocal code
+            if is_number(arg):
+                return float(arg)
+            if re.fullmatch(r'[A-Za-z0-9_]+', arg):
+                return 'float(' + arg + ')'
+            name = gen.get_distinct_name(variable + suffix)
+            code += name + ' = float(' + arg + ')\n'
+            return name
+        start_v = scrub(start, '_start')
+        end_v = scrub(end, '_end')
+        increment_v = scrub(increment, '_inc')
+        as_text = [num(value) if isinstance(value, float) else value for value in (start_v, end_v, increment_v)]
+        if isinstance(start_v, float) and isinstance(end_v, float):
+            range_code = (_up_range(gen) if start_v < end_v else _down_range(gen)) + '(' + ', '.join(as_text) + ')'
+        else:
+            range_code = ('(' + as_text[0] + ' <= ' + as_text[1] + ') and ' +
+                          _up_range(gen) + '(' + ', '.join(as_text) + ') or ' +
+                          _down_range(gen) + '(' + ', '.join(as_text) + ')')
+    return code + 'for ' + variable + ' in ' + range_code + ':\n' + branch
+
+
+@generator('variables_get', 'variables_get_dynamic')
+def _variables_get(gen: Generator, block: Block) -> ValueCode:
+    return gen.variable_name(block, 'VAR'), ORDER_ATOMIC
+
+
+@generator('variables_set', 'variables_set_dynamic')
+def _variables_set(gen: Generator, block: Block) -> str:
+    value = gen.value_to_code(block, 'VALUE', ORDER_NONE) or '0'
+    return gen.variable_name(block, 'VAR') + ' = ' + value + '\n'
+
+
+@generator('logic_compare')
+def _logic_compare(gen: Generator, block: Block) -> ValueCode:
+    operators = {'EQ': '==', 'NEQ': '!=', 'LT': '<', 'LTE': '<=', 'GT': '>', 'GTE': '>='}
+    operator = operators[_field(block, 'OP', 'EQ')]
+    a = gen.value_to_code(block, 'A', ORDER_RELATIONAL) or '0'
+    b = gen.value_to_code(block, 'B', ORDER_RELATIONAL) or '0'
+    return a + ' ' + operator + ' ' + b, ORDER_RELATIONAL
+
+
+@generator('logic_operation')
+def _logic_operation(gen: Generator, block: Block) -> ValueCode:
+    operator = 'and' if _field(block, 'OP', 'AND') == 'AND' else 'or'
+    order = ORDER_LOGICAL_AND if operator == 'and' else ORDER_LOGICAL_OR
+    a = gen.value_to_code(block, 'A', order)
+    b = gen.value_to_code(block, 'B', order)
+    if not a and not b:
+        a = b = 'False'
+    else:
+        default = 'True' if operator == 'and' else 'False'
+        a = a or default
+        b = b or default
+    return a + ' ' + operator + ' ' + b, order
+
+
+@generator('logic_negate')
+def _logic_negate(gen: Generator, block: Block) -> ValueCode:
+    return 'not ' + (gen.value_to_code(block, 'BOOL', ORDER_LOGICAL_NOT) or 'True'), ORDER_LOGICAL_NOT
+
+
+@generator('logic_boolean')
+def _logic_boolean(gen: Generator, block: Block) -> ValueCode:
+    return ('True' if _field(block, 'BOOL', 'TRUE') == 'TRUE' else 'False'), ORDER_ATOMIC
+
+
+@generator('math_number')
+def _math_number(gen: Generator, block: Block) -> ValueCode:
+    number = js_number(_field(block, 'NUM', 0))
+    if number == math.inf:
+        return 'float("inf")', ORDER_FUNCTION_CALL
+    if number == -math.inf:
+        return '-float("inf")', ORDER_UNARY_SIGN
+    return js_number_to_string(number), ORDER_UNARY_SIGN if number < 0 else ORDER_ATOMIC
+
+
+@generator('math_arithmetic')
+def _math_arithmetic(gen: Generator, block: Block) -> ValueCode:
+    operators = {
+        'ADD': (' + ', ORDER_ADDITIVE),
+        'MINUS': (' - ', ORDER_ADDITIVE),
+        'MULTIPLY': (' * ', ORDER_MULTIPLICATIVE),
+        'DIVIDE': (' / ', ORDER_MULTIPLICATIVE),
+        'POWER': (' ** ', ORDER_EXPONENTIATION),
+    }
+    operator, order = operators[_field(block, 'OP', 'ADD')]
+    a = gen.value_to_code(block, 'A', order) or '0'
+    b = gen.value_to_code(block, 'B', order) or '0'
+    return a + operator + b, order
+
+
+@generator('math_single')
+def _math_single(gen: Generator, block: Block) -> ValueCode:
+    operator = _field(block, 'OP', 'ROOT')
+    if operator == 'NEG':
+        # Negation has a different precedence to the others
+        return '-' + (gen.value_to_code(block, 'NUM', ORDER_UNARY_SIGN) or '0'), ORDER_UNARY_SIGN
+    gen.definitions['import_math'] = 'import math'
+    if operator in ('SIN', 'COS', 'TAN'):
+        arg = gen.value_to_code(block, 'NUM', ORDER_MULTIPLICATIVE) or '0'
+    else:
+        arg = gen.value_to_code(block, 'NUM', ORDER_NONE) or '0'
+    function_calls = {
+        'ABS': 'math.fabs({})',
+        'ROOT': 'math.sqrt({})',
+        'LN': 'math.log({})',
+        'LOG10': 'math.log10({})',
+        'EXP': 'math.exp({})',
+        'POW10': 'math.pow(10,{})',
+        'ROUND': 'round({})',
+        'ROUNDUP': 'math.ceil({})',
+        'ROUNDDOWN': 'math.floor({})',
+        'SIN': 'math.sin({} / 180.0 * math.pi)',
+        'COS': 'math.cos({} / 180.0 * math.pi)',
+        'TAN': 'math.tan({} / 180.0 * math.pi)',
+    }
+    if operator in function_calls:
+        return function_calls[operator].format(arg), ORDER_FUNCTION_CALL
+    inverse_trig = {
+        'ASIN': 'math.asin({}) / math.pi * 180',
+        'ACOS': 'math.acos({}) / math.pi * 180',
+        'ATAN': 'math.atan({}) / math.pi * 180',
+    }
+    if operator not in inverse_trig:
+        raise BlocklyCompileError(f"Unknown math operator: {operator}")
+    return inverse_trig[operator].format(arg), ORDER_MULTIPLICATIVE
+
+
+
+def compile_workspace(workspace: Dict[str, Any]) -> str:
+    """Python source for a serialized blockly workspace (Move.implementation).
+
+    Raises BlocklyCompileError if the workspace has blocks that we can't generate code for.
+    """
+    try:
+        return Generator(workspace).workspace_to_code()
+    except (KeyError, TypeError, AttributeError, ValueError) as e:
+        raise BlocklyCompileError(f"Malformed workspace: {e!r}") from e
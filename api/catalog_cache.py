@@ -0,0 +1,62 @@
+"""
+Cache of the serialized official catalog (moves, pieces and board setups).
+
+Official content almost never changes, so the catalog views serialize it
+once and keep it in Django's cache (see CACHES in core/settings.py). Every
+entry is stored under the current catalog version, and saving or deleting
+any Move, Piece or BoardSetup (or the PieceMoves and PieceLocations they're
+made of) starts a new version, so stale entries are never read again and
+just expire. PieceMoves and PieceLocations are bulk created, which doesn't
+send signals, but always in the same transaction as saving their Piece or
+BoardSetup, which does.
+
+The version is also what the views use for their ETags, a client that
+already has the current catalog gets a 304 without touching the database.
+"""
+import uuid
+from typing import Any, Callable
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from api.models import BoardSetup, Move, Piece, PieceLocation, PieceMove
+
+VERSION_KEY = 'catalog:version'
+# Entries of old versions are never read again, so don't keep them around for long
+TIMEOUT_SECONDS = 60 * 60
+
+
+def version() -> str:
+    current = cache.get(VERSION_KEY)
+    if current is None:
+        # Random rather than counting from 1, so a version that was evicted is never reused
+        cache.add(VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        current = cache.get(VERSION_KEY)
+    return current
+
+
+def new_version() -> None:
+    cache.set(VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def get_or_build(name: str, build: Callable[[], Any]) -> Any:
+    """The cached value of build() for the current catalog version."""
+    return cache.get_or_set(f'catalog:{version()}:{name}', build, timeout=TIMEOUT_SECONDS)
+
+
+def etag(user) -> str:
+    """ETag of a catalog as this user sees it, their own content only changes with the version too."""
+    return f'"{version()}-{user.pk or 0}"'
+
+
+def catalog_changed(sender, **kwargs):
+    new_version()
+    # And again once the transaction is committed, in case someone cached what
+    # they read before that under the version we just made
+    transaction.on_commit(new_version)
+
+
+for model in [Move, Piece, PieceMove, BoardSetup, PieceLocation]:
+    post_save.connect(catalog_changed, sender=model, dispatch_uid=f'catalog_cache_save_{model.__name__}')
+    post_delete.connect(catalog_changed, sender=model, dispatch_uid=f'catalog_cache_delete_{model.__name__}')
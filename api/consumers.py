@@ -1,247 +1,337 @@
+import asyncio
 import json
 import random
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, TypeVar
 
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
 from django.core.exceptions import ValidationError
 
 from api.models import GameRequest, BoardSetup, GameRequestSerializer, PieceSerializer, PieceLocation, Game, GameSerializer, BoardSetupSerializer
+from core.settings import MOVE_SANDBOX_WORKERS
+
+T = TypeVar('T')
+
+# Moves are run here rather than on the database thread, so that a slow move
+# doesn't hold up every other socket's queries. Each thread mostly waits for
+# a sandbox worker, more threads than workers would only wait longer.
+_move_executor = ThreadPoolExecutor(max_workers=max(MOVE_SANDBOX_WORKERS, 1), thread_name_prefix='moves')
+
+
+async def run_moves(run: Callable[[], T]) -> T:
+    """Call run (e.g. api.models.PreparedMove.run) on the move threads, it must not use the database."""
+    return await asyncio.get_running_loop().run_in_executor(_move_executor, run)
+
+
+class BroadcastConsumer(AsyncWebsocketConsumer):
+    """A consumer that sends events to everyone in its group.
+
+    Every member of the group gets the same event, only whoami differs, so the
+    event is encoded to json once in broadcast, and each socket splices its
+    own whoami into that text rather than decoding and encoding it again.
+
+    Consumers are async, so an idle socket doesn't take up a thread. Anything
+    that uses the database goes through database_sync_to_async.
+    """
+    group_name: str
+
+    async def broadcast(self, event):
+        await self.channel_layer.group_send(self.group_name, {
+            "type": "send_to_socket",
+            "text": json.dumps(event),
+        })
+
+    # Receive message from room group
+    async def send_to_socket(self, event):
+        if not hasattr(self, 'whoami_json'):
+            self.whoami_json = json.dumps(self.scope['user'].username)
+        # The text is always an encoded non empty object
+        await self.send(text_data='{"whoami": ' + self.whoami_json + ', ' + event['text'][1:])
+
+    async def send_json(self, content):
+        await self.send(text_data=json.dumps(content))
 
 
 # Related file: frontend/src/components/Lobby.tsc
-class LobbyConsumer(WebsocketConsumer):
-    def connect(self):
+class LobbyConsumer(BroadcastConsumer):
+    async def connect(self):
         self.group_name = 'lobby'
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             self.group_name, self.channel_name
         )
         if str(self.scope['user']) == "AnonymousUser":
             return
-        self.accept()
+        await self.accept()
 
-    def disconnect(self, close_code):
+    async def disconnect(self, close_code):
         current_user = self.scope["user"]
         if str(current_user) == "AnonymousUser":
-            self.send(text_data=json.dumps({
+            await self.send_json({
                 "message": "Not logged in, could not send request.",
                 "event_type": "fail"
-            }))
+            })
             return
 
         # Remove all pending requests
-        open_requests = GameRequest.objects.filter(requesting_user=current_user)
-        deleted_ids = []
-        for request in open_requests:
-            request.delete()
-            deleted_ids.append(str(request.pk))
+        deleted_ids = await self.delete_requests(current_user)
 
         # Let the world know about the deletions
-        async_to_sync(self.channel_layer.group_send)(
-            self.group_name, {
-                "type": "send_to_socket",
-                "event_type": "delete_game",
-                "deleted_ids": deleted_ids,
-                "accepted_by": ""}
-        )
+        await self.broadcast({
+            "event_type": "delete_game",
+            "deleted_ids": deleted_ids,
+            "accepted_by": "",
+        })
 
         # Leave the group
-        async_to_sync(self.channel_layer.group_discard)(
+        await self.channel_layer.group_discard(
             self.group_name, self.channel_name
         )
 
+    @database_sync_to_async
+    def delete_requests(self, user) -> List[str]:
+        open_requests = GameRequest.objects.filter(requesting_user=user)
+        deleted_ids = []
+        for request in open_requests:
+            request.delete()
+            deleted_ids.append(str(request.pk))
+        return deleted_ids
+
+    @database_sync_to_async
+    def request_game(self, requesting_user, board_pk) -> Dict[str, Any]:
+        """Post a new request, and return the event announcing it."""
+        board_setup = BoardSetup.objects.get(('pk', int(board_pk)))
+        request = GameRequest(requesting_user=requesting_user, board_setup=board_setup)
+        request.full_clean()
+        request.save()
+        board_piece_locs = PieceLocation.objects.filter(board_setup=request.board_setup)
+        piece_set = set()
+        for board_piece_loc in board_piece_locs:
+            piece_set.add(board_piece_loc.piece)
+        piece_pk_map = {
+            str(piece.pk): PieceSerializer(piece).data for piece in piece_set
+            }
+        return {
+            "event_type": "new_game",
+            "request": GameRequestSerializer(request).data,
+            "pieces": piece_pk_map,
+        }
+
+    @database_sync_to_async
+    def accept_game(self, requesting_user, pk: int) -> Dict[str, Any]:
+        """Start the game of this request, and return the event announcing it."""
+        accepted_request = GameRequest.objects.get(('pk', pk))
+        accepted_request.delete()
+        # Figure out who goes first
+        coin_flip = random.random() < .5
+        white = requesting_user if coin_flip else accepted_request.requesting_user
+        black = requesting_user if not coin_flip else accepted_request.requesting_user
+        # Create the game in the database
+        new_game = Game.create_game(white, black, accepted_request.board_setup)
+        return {
+            "event_type": "begin_game",
+            "deleted_ids": [str(pk)],
+            "game_data": GameSerializer(new_game).data,
+            "game_name": accepted_request.board_setup.name,
+        }
+
     # Receive message from WebSocket
-    def receive(self, text_data):
+    async def receive(self, text_data):
         data_json = json.loads(text_data)
         type = data_json['event_type']
         requesting_user = self.scope["user"]
         if str(requesting_user) == "AnonymousUser":
-            self.send(text_data=json.dumps({
+            await self.send_json({
                 "message": "Not logged in, could not send request.",
                 "event_type": "fail"
-            }))
+            })
             return
         if type == 'request_game':
-            board_pk = data_json["board_pk"]
-            board_setup = BoardSetup.objects.get(('pk', int(board_pk)))
             try:
-                request = GameRequest(requesting_user=requesting_user, board_setup=board_setup)
-                request.full_clean()
-                request.save()
-                board_piece_locs = PieceLocation.objects.filter(board_setup=request.board_setup)
-                piece_set = set()
-                for board_piece_loc in board_piece_locs:
-                    piece_set.add(board_piece_loc.piece)
-                piece_pk_map = {
-                    str(piece.pk): PieceSerializer(piece).data for piece in piece_set
-                    }
-                gameRequest = GameRequestSerializer(request).data
-                async_to_sync(self.channel_layer.group_send)(
-                    self.group_name, {
-                        "type": "send_to_socket",
-                        "event_type": "new_game",
-                        "request": gameRequest,
-                        "pieces": piece_pk_map}
-                )
+                await self.broadcast(await self.request_game(requesting_user, data_json["board_pk"]))
             except ValidationError as e:
-                self.send(text_data=json.dumps({
+                await self.send_json({
                     "message": "Could not send request" + str(e),
                     "event_type": "fail"
-                    }))
+                    })
         elif type == 'accept_game':
-            pk = int(data_json['request_pk'])
             try:
-                accepted_request = GameRequest.objects.get(('pk', pk))
-                accepted_request.delete()
-                # Figure out who goes first
-                coin_flip = random.random() < .5
-                white = requesting_user if coin_flip else accepted_request.requesting_user
-                black = requesting_user if not coin_flip else accepted_request.requesting_user
-                # Create the game in the database
-                new_game = Game.create_game(white, black, accepted_request.board_setup)
                 # Let everyone know this request was taken
-                async_to_sync(self.channel_layer.group_send)(
-                    self.group_name, {
-                        "type": "send_to_socket",
-                        "event_type": "begin_game",
-                        "deleted_ids": [str(pk)],
-                        "game_data": GameSerializer(new_game).data,
-                        "game_name": accepted_request.board_setup.name
-                    }
-                )
+                await self.broadcast(await self.accept_game(requesting_user, int(data_json['request_pk'])))
             except (ValueError, GameRequest.DoesNotExist):
-                self.send(text_data=json.dumps({
+                await self.send_json({
                     "message": f"This request no longer exists",
                     "event_type": "fail",
-                    }))
-
-    # Receive message from room group
-    def send_to_socket(self, event):
-        event['whoami'] = self.scope['user'].username
-        # Send message to WebSocket
-        self.send(text_data=json.dumps(event))
+                    })
+            except ValidationError as e:
+                await self.send_json({
+                    "message": "Could not start the game: " + " ".join(e.messages),
+                    "event_type": "fail",
+                    })
 
 
-class GameConsumer(WebsocketConsumer):
-    def connect(self):
+class GameConsumer(BroadcastConsumer):
+    async def connect(self):
         self.game_id = self.scope["url_route"]["kwargs"]["game_id"]
         self.group_name = f'game_{self.game_id}'
         requesting_user = self.scope["user"]
         if str(requesting_user) == "AnonymousUser":
             return
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             self.group_name, self.channel_name
         )
-        self.accept()
+        await self.accept()
+        # Everything after this is sent as updates to this state
+        await self.send_game_state()
+
+    @database_sync_to_async
+    def get_game(self) -> Optional[Game]:
+        try:
+            return Game.objects.get(pk=int(self.game_id))
+        except Game.DoesNotExist:
+            return None
+
+    @database_sync_to_async
+    def serialize_game(self) -> Optional[Dict[str, Any]]:
+        try:
+            game = Game.objects.select_related('white_user', 'black_user', 'setup').get(pk=int(self.game_id))
+        except Game.DoesNotExist:
+            return None
+        return GameSerializer(game).data
+
+    async def send_game_state(self):
+        """Send the full game to this socket only."""
+        game_data = await self.serialize_game()
+        if game_data is None:
+            await self.send_json({
+                "message": "This game has already ended",
+                "event_type": "fail"
+                })
+            return
+        await self.send_json({
+            "event_type": "game_state",
+            "game_data": game_data,
+            "whoami": self.scope['user'].username,
+            })
+
+    @database_sync_to_async
+    def delete_game(self):
+        Game.objects.filter(pk=int(self.game_id)).delete()
 
-    def disconnect(self, close_code):
+    async def disconnect(self, close_code):
         if close_code == 1000:
-            try:
-                Game.objects.get(pk=int(self.game_id)).delete()
-            except Game.DoesNotExist:
-                pass # already removed
+            # Nothing to do if it's already removed
+            await self.delete_game()
+
+    @database_sync_to_async
+    def draw(self, game: Game, user_color: str):
+        cur_offer = game.game_state['draw_offer']
+        if game.black_user_id == game.white_user_id and cur_offer != 'none':
+            # If you are playing as both users, accept the draw for
+            # the correct color.
+            if cur_offer == 'black':
+                game.draw('white')
+            elif cur_offer == 'white':
+                game.draw('black')
+        else:
+            game.draw(user_color)
+
+    @database_sync_to_async
+    def prepare_legal_moves(self, game: Game):
+        if game.result != Game.Result.IN_PROGRESS:
+            return None
+        return game.prepare_legal_moves()
 
     # Receive message from WebSocket
-    def receive(self, text_data):
+    async def receive(self, text_data):
         text_data_json = json.loads(text_data)
         requesting_user = self.scope["user"]
         if str(requesting_user) == "AnonymousUser":
-            self.send(text_data=json.dumps({
+            await self.send_json({
                 "message": "Not logged in, could not send request.",
                 "event_type": "fail"
-                }))
+                })
             return
         try:
             event_type = text_data_json['event_type']
-            try:
-                game = Game.objects.get(pk=int(self.game_id))
-            except Game.DoesNotExist:
-                self.send(text_data=json.dumps({
+            game = await self.get_game()
+            if game is None:
+                await self.send_json({
                     "message": "This game has already ended",
                     "event_type": "fail"
-                    }))
+                    })
                 return
             user_color = None
-            if game.white_user == requesting_user:
-                if game.black_user == requesting_user:
+            if game.white_user_id == requesting_user.pk:
+                if game.black_user_id == requesting_user.pk:
                     user_color = 'white' if game.white_to_move else 'black'
                 else:
                     user_color = 'white'
-            elif game.black_user == requesting_user:
+            elif game.black_user_id == requesting_user.pk:
                     user_color = 'black'
             if user_color == None:
-                self.send(text_data=json.dumps({
+                await self.send_json({
                     "message": "Not participating in game, could not send request.",
                     "event_type": "fail"
-                    }))
+                    })
+            elif event_type == "sync":
+                # The player missed an update
+                await self.send_game_state()
             elif event_type == "resign":
-                game.resign(user_color)
-                async_to_sync(self.channel_layer.group_send)(
-                    self.group_name,
-                    {
-                    "type": "send_to_socket",
+                await database_sync_to_async(game.resign)(user_color)
+                await self.broadcast({
                     "event_type": "agreement",
-                    "game_data": GameSerializer(game).data,
-                    }
-                )
+                    **game.game_update(),
+                })
             elif event_type == "draw":
-                cur_offer = game.game_state['draw_offer']
-                if game.black_user == game.white_user and cur_offer != 'none':
-                    # If you are playing as both users, accept the draw for 
-                    # the correct color.
-                    if cur_offer == 'black':
-                        game.draw('white')
-                    elif cur_offer == 'white':
-                        game.draw('black')
-                else:
-                    game.draw(user_color)
-                async_to_sync(self.channel_layer.group_send)(
-                    self.group_name,
-                    {
-                        "type": "send_to_socket",
-                        "event_type": "agreement",
-                        "game_data": GameSerializer(game).data,
-                    }
-                )
+                await self.draw(game, user_color)
+                await self.broadcast({
+                    "event_type": "agreement",
+                    **game.game_update(),
+                })
+            elif event_type == "legal_moves":
+                try:
+                    prepared = await self.prepare_legal_moves(game)
+                    await self.send_json({
+                        "event_type": "legal_moves",
+                        "white_to_move": game.white_to_move,
+                        "legal_moves": await run_moves(prepared.run) if prepared is not None else [],
+                        })
+                except (ValidationError, SyntaxError, NameError) as e:
+                    await self.send_json({
+                        "event_type": "fail",
+                        "message": "Could not compute the legal moves: " + repr(e)
+                        })
             elif event_type == "move":
                 from_loc = tuple(text_data_json['from_loc'])
                 to_loc = tuple(text_data_json['to_loc'])
+                previous_board = game.board
                 try:
-                    if game.make_move(from_loc, to_loc, requesting_user):
-                     # Successful move
-                     async_to_sync(self.channel_layer.group_send)(
-                        self.group_name,
-                            {
-                            "type": "send_to_socket",
+                    move = await database_sync_to_async(game.prepare_move)(from_loc, to_loc, requesting_user)
+                    result = await run_moves(move.run)
+                    if await database_sync_to_async(game.finish_move)(move, result):
+                        # Successful move, only send what changed
+                        await self.broadcast({
                             "event_type": "board_update",
-                            "game_data": GameSerializer(game).data,
-                            }
-                        )
+                            **game.game_update(previous_board),
+                        })
                     else:
                         # Move is not valid
-                        self.send(text_data=json.dumps({
+                        await self.send_json({
                             "event_type": "invalid_move",
                             "message": "You cannot move that piece to that location."
-                            }))
+                            })
                 except (ValidationError, SyntaxError, NameError) as e:
                     if isinstance(e, SyntaxError) or isinstance(e, NameError):
                         message = "Failed to compile this code, see the error trace:\n" + repr(e)
                     else:
                         message = repr(e)
-                    self.send(text_data=json.dumps({
+                    await self.send_json({
                         "event_type": "invalid_move",
                         "message": message
-                        }))
+                        })
         except KeyError:
-            self.send(text_data=json.dumps({
+            await self.send_json({
                 "message": f"Invalid data, you sent {text_data_json}",
                 "event_type": "fail"
-                }))
-
-
-
-    # Receive message from room group
-    def send_to_socket(self, event):
-        event['whoami'] = self.scope['user'].username
-        # Send message to WebSocket
-        self.send(text_data=json.dumps(event))
+                })
@@ -0,0 +1,151 @@
+"""
+Client for the convert_code_server (see frontend/convert_code_server.ts).
+
+Only used when CODE_CONVERTER is 'server'. All requests share one
+requests.Session, so connections to the converter are pooled and kept
+alive rather than opened for every move. Each request has a timeout and
+is retried a few times, and if the converter keeps failing the circuit
+breaker stops sending it requests for a while, so that saving a move or
+starting a game fails fast instead of waiting on a dead server.
+
+Many workspaces can be converted in one request with convert_many, which
+uses the server's /batch endpoint.
+"""
+import threading
+import time
+from typing import Any, Callable, List, Optional, Sequence
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from core.settings import CODE_CONVERT_HOST, CODE_CONVERT_PORT, CODE_CONVERT_RETRIES, CODE_CONVERT_TIMEOUT_SECONDS
+
+
+class ConverterUnavailable(Exception):
+    """The converter could not be reached, or the circuit breaker is open."""
+
+
+class ConversionFailed(Exception):
+    """The converter could not convert a workspace."""
+
+
+class CircuitBreaker:
+    """Stops calls to a failing service until it has had time to recover.
+
+    After failure_threshold failures in a row the breaker opens, and allow()
+    is False for reset_seconds. After that a single trial call is let through,
+    if it succeeds the breaker closes again, otherwise it stays open for
+    another reset_seconds.
+    """
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30,
+                 clock: Callable[[], float] = time.monotonic):
+        assert failure_threshold > 0
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._clock = clock
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial_running or self._clock() - self._opened_at < self.reset_seconds:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self.failure_threshold:
+                self._opened_at = self._clock()
+            self._trial_running = False
+
+
+class ConverterClient:
+    def __init__(self, base_url: str, timeout_seconds: float = 5, retries: int = 2,
+                 retry_backoff_seconds: float = 0.1, pool_size: int = 10,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.base_url = base_url.rstrip('/')
+        self.timeout_seconds = timeout_seconds
+        self.retries = retries
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _post(self, path: str, body: Any) -> requests.Response:
+        """POST json to the converter, retrying on connection errors, timeouts and 5xx responses."""
+        if not self.breaker.allow():
+            raise ConverterUnavailable("The code converter is not responding, try again later.")
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.retry_backoff_seconds * 2 ** (attempt - 1))
+            try:
+                response = self.session.post(self.base_url + path, json=body, timeout=self.timeout_seconds)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+                continue
+            if response.status_code >= 500:
+                error = ConverterUnavailable(f"Code conversion server has failed with error code {response.status_code}")
+                continue
+            self.breaker.record_success()
+            if response.status_code != 200:
+                raise ConversionFailed(f"Code conversion server has failed with error code {response.status_code}")
+            return response
+        self.breaker.record_failure()
+        raise ConverterUnavailable(f"Could not reach the code converter: {error}")
+
+    def convert(self, workspace: Any) -> str:
+        """Python source of one blockly workspace."""
+        return self._post('/', workspace).text
+
+    def convert_many(self, workspaces: Sequence[Any]) -> List[str]:
+        """Python source of each workspace, in one round trip.
+
+        Raises ConversionFailed if any of them can't be converted.
+        """
+        if not workspaces:
+            return []
+        results = self._post('/batch', {'workspaces': list(workspaces)}).json()['results']
+        if len(results) != len(workspaces):
+            raise ConversionFailed(f"Expected {len(workspaces)} conversions, got {len(results)}")
+        sources = []
+        for i, result in enumerate(results):
+            if 'error' in result:
+                raise ConversionFailed(f"Workspace {i}: {result['error']}")
+            sources.append(result['code'])
+        return sources
+
+    def close(self) -> None:
+        self.session.close()
+
+
+_client: Optional[ConverterClient] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> ConverterClient:
+    """The shared client for the configured convert_code_server."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = ConverterClient(f"http://{CODE_CONVERT_HOST}:{CODE_CONVERT_PORT}",
+                                      CODE_CONVERT_TIMEOUT_SECONDS, CODE_CONVERT_RETRIES)
+        return _client
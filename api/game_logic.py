@@ -1,6 +1,10 @@
+import ast
 import math
-from typing import Tuple, Dict, Any, NamedTuple, Optional, TypedDict, List, Union
-from func_timeout import func_timeout
+import signal
+import threading
+import time
+from typing import Callable, Tuple, Dict, Any, NamedTuple, Optional, TypedDict, List, Union, Mapping, Set, Iterable
+from func_timeout import func_timeout, FunctionTimedOut
 
 
 class Location(NamedTuple):
@@ -11,11 +15,259 @@ class PieceInstance(TypedDict):
     name: str
     team: str
     is_royal: bool
+class PieceType(TypedDict):
+    """A piece in game_state['piece_types'], shared by all of its instances on the board."""
+    name: str
+    # "relative_row,relative_col" -> move pk
+    piece_moves: Dict[str, str]
 class BoardTile(TypedDict):
     piece: Optional[PieceInstance]
 class TileList(TypedDict):
     tiles: List[PieceInstance]
 
+# Every tile on the board in row major order, so square i is SQUARES[i].
+SQUARES: Tuple[Location, ...] = tuple(Location(row, col) for row in range(8) for col in range(8))
+# Square i seen from the other side of the board, i.e. with its row mirrored
+_MIRRORED: Tuple[int, ...] = tuple((7 - row) * 8 + col for row, col in SQUARES)
+
+
+class PieceRecord:
+    """A piece on the board.
+
+    Also supports piece['team'] style access, since that's how pieces
+    were accessed when they were dicts.
+    """
+    __slots__ = ('piece_id', 'name', 'team', 'is_royal', 'piece_pk', 'piece_moves')
+
+    def __init__(self, piece_id: int, name: str, team: str, is_royal: bool,
+                 piece_pk: Optional[str] = None, piece_moves: Optional[Dict[Tuple[int, int], str]] = None):
+        self.piece_id = piece_id
+        self.name = name
+        self.team = team
+        self.is_royal = is_royal
+        self.piece_pk = piece_pk
+        # (relative_row, relative_col) -> move pk, shared by every piece of the same type
+        self.piece_moves = piece_moves if piece_moves is not None else {}
+
+    def __getitem__(self, key: str):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __repr__(self):
+        return f"PieceRecord({self.piece_id}, {self.name!r}, {self.team!r})"
+
+    @staticmethod
+    def from_json(data: Dict[str, Any], name: str, piece_moves: Dict[Tuple[int, int], str]) -> 'PieceRecord':
+        """A piece from game_state['pieces'], whose type has this name and these moves."""
+        return PieceRecord(data['piece_id'], name, data['team'], data['is_royal'], data['piece_pk'], piece_moves)
+
+    def to_json(self) -> Dict[str, Any]:
+        # The name and moves are in game_state['piece_types']
+        return {
+            'piece_id': self.piece_id,
+            'piece_pk': self.piece_pk,
+            'team': self.team,
+            'is_royal': self.is_royal,
+        }
+
+
+def parse_piece_moves(piece_type: PieceType) -> Dict[Tuple[int, int], str]:
+    """(relative_row, relative_col) -> move pk, for a piece type in game_state['piece_types']."""
+    piece_moves = {}
+    for key, move_pk in piece_type['piece_moves'].items():
+        row, col = key.split(',')
+        piece_moves[(int(row), int(col))] = move_pk
+    return piece_moves
+
+
+class TileView:
+    """The tile at one square of an ArrayBoard, so that board[loc]['piece'] keeps working."""
+    __slots__ = ('_squares', '_index')
+
+    def __init__(self, squares: List[Optional[PieceRecord]], index: int):
+        self._squares = squares
+        self._index = index
+
+    def __getitem__(self, key: str) -> Optional[PieceRecord]:
+        if key != 'piece':
+            raise KeyError(key)
+        return self._squares[self._index]
+
+    def __setitem__(self, key: str, piece: Optional[PieceRecord]) -> None:
+        if key != 'piece':
+            raise KeyError(key)
+        self._squares[self._index] = piece
+
+
+class ArrayBoard:
+    """
+    An 8x8 board stored as a flat list of 64 squares, plus a table
+    of every piece in the game keyed by piece_id.
+
+    Indexing with a location gives a TileView, so code written against
+    the Dict[Location, BoardTile] boards (including the code generated by
+    frontend/src/blockly.ts) can use it unchanged.
+
+    The squares are always stored as white sees them. If flip is true the
+    board is seen from black's side instead, so that black's pieces move up
+    the board too: every location is mirrored on access, and nothing is
+    copied to turn the board around (see flipped).
+    """
+    __slots__ = ('_squares', 'pieces', '_flip')
+
+    def __init__(self, squares: Optional[List[Optional[PieceRecord]]] = None,
+                 pieces: Optional[Dict[int, PieceRecord]] = None, flip: bool = False):
+        self._squares: List[Optional[PieceRecord]] = list(squares) if squares is not None else [None] * 64
+        assert len(self._squares) == 64
+        if pieces is None:
+            pieces = {piece.piece_id: piece for piece in self._squares if piece is not None}
+        self.pieces: Dict[int, PieceRecord] = pieces
+        self._flip = flip
+
+    def index_of(self, loc: Location) -> int:
+        """Where the square at this location (as seen from this side) is stored."""
+        try:
+            row, col = loc
+            if 0 <= row <= 7 and 0 <= col <= 7:
+                return (7 - row if self._flip else row) * 8 + col
+        except (TypeError, ValueError):
+            pass
+        raise KeyError(loc)
+
+    def piece_at(self, loc: Location) -> Optional[PieceRecord]:
+        return self._squares[self.index_of(loc)]
+
+    def set_piece(self, loc: Location, piece: Optional[PieceRecord]) -> None:
+        self._squares[self.index_of(loc)] = piece
+
+    def __getitem__(self, loc: Location) -> TileView:
+        return TileView(self._squares, self.index_of(loc))
+
+    def __contains__(self, loc) -> bool:
+        try:
+            self.index_of(loc)
+            return True
+        except KeyError:
+            return False
+
+    def __len__(self) -> int:
+        return 64
+
+    def __iter__(self):
+        return iter(SQUARES)
+
+    def keys(self):
+        return SQUARES
+
+    def _stored_order(self) -> Iterable[int]:
+        """Where each square is stored, in SQUARES order."""
+        return _MIRRORED if self._flip else range(64)
+
+    def values(self):
+        return [TileView(self._squares, i) for i in self._stored_order()]
+
+    def items(self):
+        return [(SQUARES[i], TileView(self._squares, stored)) for i, stored in enumerate(self._stored_order())]
+
+    def occupied(self):
+        """(location, piece) for every square with a piece on it."""
+        squares = self._squares
+        if self._flip:
+            return [(SQUARES[i], squares[stored]) for i, stored in enumerate(_MIRRORED) if squares[stored] is not None]
+        return [(SQUARES[i], squares[i]) for i in range(64) if squares[i] is not None]
+
+    def flipped(self) -> 'ArrayBoard':
+        """This board seen from the other side.
+
+        The two share their squares, so a move made on either shows up on both.
+        """
+        board = ArrayBoard.__new__(ArrayBoard)
+        board._squares = self._squares
+        board.pieces = self.pieces
+        board._flip = not self._flip
+        return board
+
+    def copy(self) -> 'ArrayBoard':
+        # Pieces are never modified by moves, so they can be shared
+        return ArrayBoard(self._squares, self.pieces, self._flip)
+
+    @staticmethod
+    def from_state(state_board: Dict[str, Dict[str, Any]], piece_types: Dict[str, PieceType],
+                   flip: bool = False) -> 'ArrayBoard':
+        """Build a board from the 'board' of Game.state_json and game_state['piece_types'].
+
+        The board has a "row,col" key for each occupied square, see PieceRecord.to_json.
+        If flip is true, rows are mirrored so that black's pieces move up the board.
+        """
+        types = {piece_pk: (piece_type['name'], parse_piece_moves(piece_type))
+                 for piece_pk, piece_type in piece_types.items()}
+        squares: List[Optional[PieceRecord]] = [None] * 64
+        for key, piece in state_board.items():
+            row, col = key.split(',')
+            squares[int(row) * 8 + int(col)] = PieceRecord.from_json(piece, *types[piece['piece_pk']])
+        return ArrayBoard(squares, flip=flip)
+
+    def to_state(self, flip: bool = False) -> Dict[str, Dict[str, Any]]:
+        """Inverse of from_state, the piece types don't change so they aren't included."""
+        state_board = {}
+        for (row, col), piece in self.occupied():
+            if flip:
+                row = 7 - row
+            state_board[f"{row},{col}"] = piece.to_json()
+        return state_board
+
+    def pack(self) -> bytes:
+        """The board as stored in Game.board, see unpack. Always as white sees it, whichever side this is."""
+        return bytes([PACKED_BOARD_VERSION]) + bytes(
+            piece.piece_id + 1 if piece is not None else 0 for piece in self._squares)
+
+    @staticmethod
+    def unpack(packed: bytes, pieces: Dict[int, PieceRecord], flip: bool = False) -> 'ArrayBoard':
+        """Build a board from its packed form.
+
+        That's a version byte, then a byte for each square in SQUARES order,
+        0 if it's empty and piece_id + 1 of the piece there otherwise, so
+        pieces has every piece that could be on the board by its piece_id.
+        """
+        packed = bytes(packed)
+        if len(packed) != 65 or packed[0] != PACKED_BOARD_VERSION:
+            raise ValueError(f"Not a packed board (version {packed[:1].hex()}, {len(packed)} bytes)")
+        return ArrayBoard([pieces[i - 1] if i else None for i in packed[1:]], pieces, flip)
+
+
+PACKED_BOARD_VERSION = 1
+
+def pieces_from_state(state_pieces: Dict[str, Dict[str, Any]], piece_types: Dict[str, PieceType]) -> Dict[int, PieceRecord]:
+    """piece_id -> piece, for game_state['pieces'] (see PieceRecord.to_json) and game_state['piece_types']."""
+    types = {piece_pk: (piece_type['name'], parse_piece_moves(piece_type))
+             for piece_pk, piece_type in piece_types.items()}
+    return {int(piece_id): PieceRecord.from_json(piece, *types[piece['piece_pk']])
+            for piece_id, piece in state_pieces.items()}
+
+
+# Keys of the (total, royal) piece counts that games keep for each team
+COUNT_KEYS: Dict[str, Tuple[str, str]] = {
+    'white': ('white_total', 'white_royal'),
+    'black': ('black_total', 'black_royal'),
+}
+
+def count_pieces(pieces: Iterable[PieceInstance]) -> Dict[str, int]:
+    counts = {
+        'white_total': 0,
+        'black_total': 0,
+        'white_royal': 0,
+        'black_royal': 0
+    }
+    for piece in pieces:
+        total_key, royal_key = COUNT_KEYS[piece['team']]
+        counts[total_key] += 1
+        if piece['is_royal']:
+            counts[royal_key] += 1
+    return counts
+
+
 class InvalidMoveError(Exception):
     def __init__(self, msg):
         self.msg = msg
@@ -24,13 +276,72 @@ class InvalidMoveError(Exception):
         return self.msg
 
 
+def compute_path(start_tile: Location, target_tile: Location,
+                 begin_exclusive: int, end_exclusive: int) -> Tuple[Location, ...]:
+    """Walk the path between two different tiles one step at a time. See MoveContext.path"""
+    gcd = math.gcd(start_tile.row - target_tile.row, start_tile.col - target_tile.col)
+    drow = (target_tile.row - start_tile.row) // gcd
+    dcol = (target_tile.col - start_tile.col) // gcd
+    if drow != 0:
+        path_length = abs((start_tile.row - target_tile.row) // drow) + 1
+    else:
+        path_length = abs((start_tile.col - target_tile.col) // dcol) + 1
+    begin_exclusive = min(max(begin_exclusive, -8), path_length)
+    end_exclusive = min(max(end_exclusive, -8), path_length - max(0, begin_exclusive + 1))
+
+    cur_tile = Location(start_tile.row + drow * begin_exclusive,
+                start_tile.col + dcol * begin_exclusive)
+    end_tile = Location(target_tile.row - drow * end_exclusive,
+                target_tile.col - dcol * end_exclusive)
+    path = [cur_tile]
+    while cur_tile != end_tile:
+        cur_tile = Location(cur_tile.row + drow, cur_tile.col + dcol)
+        path.append(cur_tile)
+    return tuple(path)
+
+# Paths can reach up to 8 tiles past either endpoint (see the clamping in compute_path)
+_RAY_OFFSET = 8
+
+def _build_rays() -> List[Tuple[Tuple[Location, ...], int]]:
+    """
+    For every pair of different tiles on the board, the tiles on the line
+    through them, from 8 steps before the start to 8 steps after the target,
+    along with the number of tiles from the start to the target.
+    Indexed by start_index * 64 + target_index.
+    """
+    locations: Dict[Tuple[int, int], Location] = {}
+    rays: List[Tuple[Tuple[Location, ...], int]] = []
+    for start_row, start_col in SQUARES:
+        for target_row, target_col in SQUARES:
+            if (start_row, start_col) == (target_row, target_col):
+                rays.append(((), 1))
+                continue
+            gcd = math.gcd(target_row - start_row, target_col - start_col)
+            drow = (target_row - start_row) // gcd
+            dcol = (target_col - start_col) // gcd
+            path_length = gcd + 1
+            ray = []
+            for step in range(-_RAY_OFFSET, path_length + _RAY_OFFSET):
+                coords = (start_row + drow * step, start_col + dcol * step)
+                if coords not in locations:
+                    locations[coords] = Location(*coords)
+                ray.append(locations[coords])
+            rays.append((tuple(ray), path_length))
+    return rays
+
+_RAYS = _build_rays()
+
+
 # Define examples for the compiler. The globals in this file will not be changed.
 # The variables that will change are the ones in the __globals dict
 # used in the exec call.
 class MoveContext:
-    def __init__(self, init_board: Dict[Location, BoardTile], from_loc: Location, to_loc: Location):
+    def __init__(self, init_board: Union[ArrayBoard, Dict[Location, BoardTile]], from_loc: Location, to_loc: Location,
+                 counts: Optional[Dict[str, int]] = None):
         """
         Initalize this move context with the given board state and intended action.
+
+        If counts (see count_pieces) are given, they are updated as pieces are taken.
         """
         self.board = init_board
         self.from_loc = from_loc
@@ -41,14 +352,21 @@ class MoveContext:
         self.acting_piece: PieceInstance = piece
         # If no action occurs, then this move is not considered valid.
         self.did_action = False
+        # piece_id -> tile, kept up to date by the actions below.
+        if isinstance(init_board, ArrayBoard):
+            occupied = init_board.occupied()
+        else:
+            occupied = [(loc, tile['piece']) for loc, tile in init_board.items() if tile['piece'] is not None]
+        self.piece_tiles: Dict[int, Location] = {piece['piece_id']: loc for loc, piece in occupied}
+        self.counts = counts
 
     def tile_of(self, piece: PieceInstance) -> Location:
         assert piece is not None
-        for k, v in self.board.items():
-            if v['piece'] is not None and piece['piece_id'] == v['piece']['piece_id']:
-                return k
-        # If this piece has already been taken or something
-        raise InvalidMoveError(f"Trying to get the tile of a piece that is no longer on the board.")
+        try:
+            return self.piece_tiles[piece['piece_id']]
+        except KeyError:
+            # If this piece has already been taken or something
+            raise InvalidMoveError(f"Trying to get the tile of a piece that is no longer on the board.")
 
     def out_of_bounds(self, loc: Location) -> bool:
         return not (0 <= loc.row <= 7 and 0 <= loc.col <= 7)
@@ -77,28 +395,18 @@ class MoveContext:
         end_exclusive = int(end_exclusive)
         if start_tile == target_tile:
             if begin_exclusive and end_exclusive:
-                return []
+                return ()
             else:
-                return [start_tile]
-        gcd = math.gcd(start_tile.row - target_tile.row, start_tile.col - target_tile.col)
-        drow = (target_tile.row - start_tile.row) // gcd
-        dcol = (target_tile.col - start_tile.col) // gcd
-        if drow != 0:
-            path_length = abs((start_tile.row - target_tile.row) // drow) + 1
-        else:
-            path_length = abs((start_tile.col - target_tile.col) // dcol) + 1
+                return (start_tile,)
+        start_row, start_col = start_tile
+        target_row, target_col = target_tile
+        if not (0 <= start_row <= 7 and 0 <= start_col <= 7 and 0 <= target_row <= 7 and 0 <= target_col <= 7):
+            # Only paths between tiles on the board are precomputed
+            return compute_path(start_tile, target_tile, begin_exclusive, end_exclusive)
+        ray, path_length = _RAYS[(start_row * 8 + start_col) * 64 + target_row * 8 + target_col]
         begin_exclusive = min(max(begin_exclusive, -8), path_length)
         end_exclusive = min(max(end_exclusive, -8), path_length - max(0, begin_exclusive + 1))
-        
-        cur_tile = Location(start_tile.row + drow * begin_exclusive,
-                    start_tile.col + dcol * begin_exclusive)
-        end_tile = Location(target_tile.row - drow * end_exclusive,
-                    target_tile.col - dcol * end_exclusive)
-        path = [cur_tile]
-        while cur_tile != end_tile:
-            cur_tile = Location(cur_tile.row + drow, cur_tile.col + dcol)
-            path.append(cur_tile)
-        return path
+        return ray[begin_exclusive + _RAY_OFFSET:path_length - end_exclusive + _RAY_OFFSET]
 
     #############################################################################
     #  ACTIONS
@@ -115,6 +423,9 @@ class MoveContext:
             # Move this piece to the target empty square via swap
             self.board[target_tile]['piece'], self.board[orig_tile]['piece'] = \
                 self.board[orig_tile]['piece'], self.board[target_tile]['piece']
+            if not isinstance(target_tile, Location):
+                target_tile = Location(*target_tile)
+            self.piece_tiles[moving_piece['piece_id']] = target_tile
             self.did_action = True
 
     def take(self, target_piece: PieceInstance) -> None:
@@ -126,32 +437,140 @@ class MoveContext:
                 # Remove the target piece
                 tile = self.tile_of(target_piece)
                 self.board[tile]['piece'] = None
+                del self.piece_tiles[target_piece['piece_id']]
+                if self.counts is not None:
+                    total_key, royal_key = COUNT_KEYS[target_piece['team']]
+                    self.counts[total_key] -= 1
+                    if target_piece['is_royal']:
+                        self.counts[royal_key] -= 1
                 self.did_action = True
             except InvalidMoveError:
                 # This piece is already dead, just don't take it.
                 pass
 
-def make_move(code: str, board: Dict[Location, BoardTile], from_loc: Location, to_loc: Location):
+def run_with_timeout(max_runtime_seconds: Optional[float], func):
+    """Call func, raising FunctionTimedOut if it runs for longer than max_runtime_seconds.
+
+    On the main thread (e.g. in a sandbox worker) this uses a SIGALRM timer. Anywhere
+    else it falls back to func_timeout, which has to start a new thread for every call.
+    """
+    if max_runtime_seconds is None:
+        return func()
+    if threading.current_thread() is not threading.main_thread() or not hasattr(signal, 'setitimer'):
+        return func_timeout(max_runtime_seconds, func)
+
+    def on_alarm(signum, frame):
+        raise FunctionTimedOut(timedOutAfter=max_runtime_seconds)
+    previous_handler = signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, max_runtime_seconds)
+    try:
+        return func()
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+# The generated code for a move defines action(), which uses these names
+MOVE_ARGUMENTS = ('ctx', 'board')
+# A compiled move, called as action(ctx, board)
+MoveAction = Callable[[MoveContext, Any], None]
+
+def compile_move(source: str, filename: str = '<move>') -> MoveAction:
+    """Turn the python source of a move into a function that can be played many times.
+
+    The source defines action() using the globals ctx and board. Rather than
+    exec-ing the source with new globals for every move, action is rewritten
+    to take them as arguments, so the source is only run once.
+
+    Raises SyntaxError if the source doesn't compile or doesn't define action.
+    """
+    tree = ast.parse(source, filename)
+    for node in ast.walk(tree):
+        # Since action is only defined once, globals would last from one move to the next
+        if isinstance(node, ast.Global):
+            raise SyntaxError("Moves can't use global variables", (filename, node.lineno, node.col_offset + 1, None))
+    actions = [node for node in tree.body if isinstance(node, ast.FunctionDef) and node.name == 'action']
+    if not actions:
+        raise SyntaxError("Move code has no action function", (filename, 1, 1, None))
+    for action in actions:
+        action.args = ast.arguments(posonlyargs=[], args=[ast.arg(name) for name in MOVE_ARGUMENTS],
+                                    kwonlyargs=[], kw_defaults=[], defaults=[])
+        ast.fix_missing_locations(action)
+    namespace = {}
+    exec(compile(tree, filename, 'exec'), {'__builtins__': {}}, namespace)
+    return namespace['action']
+
+def make_move(action: Union[str, MoveAction], board: Union[ArrayBoard, Dict[Location, BoardTile]],
+              from_loc: Location, to_loc: Location, max_runtime_seconds: Optional[float] = 1,
+              counts: Optional[Dict[str, int]] = None):
     """Make a move with a piece at from_loc going towards to_loc.
 
     We assume that all moves are made with valid from and to locations,
     and that the board is always oriented upwards
 
     Args:
-        code (_type_): python code for this move
+        action (str or MoveAction): python code for this move, or the result of compile_move
         board (): Current state of the game
         from_loc (Tuple[int, int]): Starting position
         to_loc (Tuple[int, int]): Target position
+        max_runtime_seconds (float): Raise FunctionTimedOut if the move takes longer than this.
+            If None, there is no limit.
+        counts (Dict[str, int]): Piece counts to update as pieces are taken, see count_pieces
     """
-    move_context = MoveContext(board, Location(*from_loc), Location(*to_loc))
-    # dict with the tiles of each piece
-    __globals = {'__builtins__' : {},
-                 'board': board,
-                 'ctx': move_context
-                 }
-    __locals = {}
-    exec(code, __globals, __locals)
-    # Run the function we just defined with exec!
-    max_runtime_seconds = 1
-    func_timeout(max_runtime_seconds, __locals['action'])
+    if isinstance(action, str):
+        action = compile_move(action)
+    move_context = MoveContext(board, Location(*from_loc), Location(*to_loc), counts)
+    run_with_timeout(max_runtime_seconds, lambda: action(move_context, board))
     return move_context
+
+def move_outcomes(board: ArrayBoard, team: str, move_codes: Mapping[str, MoveAction],
+                  max_runtime_seconds: Optional[float] = 1,
+                  counts: Optional[Dict[str, int]] = None,
+                  max_total_seconds: Optional[float] = None) -> Dict[Tuple[Location, Location], MoveContext]:
+    """Run every move that the given team could try, and keep the ones that are legal.
+
+    A move is legal if running it does something. Each candidate is run
+    on its own copy of the board (and counts), so the ones passed in are not modified.
+
+    Args:
+        board (ArrayBoard): Current state of the game, oriented so that team moves upwards
+        team (str): 'white' or 'black'
+        move_codes (Mapping[str, MoveAction]): Compiled code for each move pk used by the team's pieces, see compile_move
+        max_runtime_seconds (float): Time limit for each candidate move, see make_move
+        counts (Dict[str, int]): Piece counts before the move, see count_pieces
+        max_total_seconds (float): Raise FunctionTimedOut if running all the candidates takes longer than this.
+            If None, only each candidate is limited.
+    Returns:
+        (from_loc, to_loc) -> the MoveContext after playing that move
+    """
+    deadline = time.monotonic() + max_total_seconds if max_total_seconds is not None else None
+    outcomes = {}
+    for from_loc, piece in board.occupied():
+        if piece.team != team:
+            continue
+        for (relative_row, relative_col), move_pk in piece.piece_moves.items():
+            to_loc = Location(from_loc.row + relative_row, from_loc.col + relative_col)
+            if not (0 <= to_loc.row <= 7 and 0 <= to_loc.col <= 7):
+                continue
+            runtime_seconds = max_runtime_seconds
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise FunctionTimedOut(timedOutAfter=max_total_seconds)
+                runtime_seconds = remaining if runtime_seconds is None else min(runtime_seconds, remaining)
+            try:
+                result = make_move(move_codes[move_pk], board.copy(), from_loc, to_loc,
+                                   runtime_seconds, dict(counts) if counts is not None else None)
+            except (Exception, FunctionTimedOut):
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise FunctionTimedOut(timedOutAfter=max_total_seconds)
+                # Anything that would be rejected by Game.make_move isn't legal
+                continue
+            if result.did_action:
+                outcomes[(from_loc, to_loc)] = result
+    return outcomes
+
+def legal_moves(board: ArrayBoard, team: str, move_codes: Mapping[str, MoveAction],
+                max_runtime_seconds: Optional[float] = 1,
+                max_total_seconds: Optional[float] = None) -> Set[Tuple[Location, Location]]:
+    """Find every (from_loc, to_loc) that the given team can play. See move_outcomes"""
+    return set(move_outcomes(board, team, move_codes, max_runtime_seconds, max_total_seconds=max_total_seconds))
@@ -0,0 +1,64 @@
+"""
+Content addressed storage for piece images.
+
+Each image is written once to MEDIA_ROOT/pieces, named by the sha256 of its
+bytes, and the database only keeps that name. Since a name always refers to
+the same bytes, the images can be served with far future caching (see
+api.views.piece_image), and pieces that share an image share the file.
+"""
+import hashlib
+import os
+import re
+import tempfile
+from pathlib import Path
+
+from django.conf import settings
+
+IMAGE_DIR = 'pieces'
+# sha256 hex digest, then the file type
+NAME_PATTERN = re.compile(r'^[0-9a-f]{64}\.[a-z]{3,4}$')
+
+
+def image_dir() -> Path:
+    return Path(settings.MEDIA_ROOT) / IMAGE_DIR
+
+
+def name_of(data: bytes, extension: str) -> str:
+    """The name save gives this image, without storing it."""
+    name = f"{hashlib.sha256(data).hexdigest()}.{extension.lower()}"
+    assert NAME_PATTERN.match(name), f"Unsupported image type {extension}"
+    return name
+
+
+def save(data: bytes, extension: str) -> str:
+    """Store the image if it isn't stored yet, and return its name."""
+    name = name_of(data, extension)
+    path = image_dir() / name
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first, so nobody can read a half written image
+        fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+    return name
+
+
+def path_of(name: str) -> Path:
+    """Where the image with this name is stored. Raises ValueError for names that save couldn't have made."""
+    if not NAME_PATTERN.match(name):
+        raise ValueError(f"Invalid image name {name}")
+    return image_dir() / name
+
+
+def url_of(name: str) -> str:
+    return f"{settings.MEDIA_URL}{IMAGE_DIR}/{name}"
+
+
+def etag_of(name: str) -> str:
+    # The name is the hash of the content
+    return f'"{name.split(".")[0]}"'
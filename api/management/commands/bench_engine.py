@@ -0,0 +1,79 @@
+import json
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test import override_settings
+
+import api.move_cache
+from api.benchmarks import BENCHMARKS, compare, run_benchmarks
+from api.models import CompiledMove, count_surviving_pieces
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ("Time the game engine on the sample game from api/tests.py. "
+            "The sample data is created in a transaction that is rolled back afterwards.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', help="Save the results to this json file")
+        parser.add_argument('--baseline', help="Compare against results saved with --output")
+        parser.add_argument('--threshold', type=float, default=0.1,
+                            help="With --baseline, fail if a benchmark is this much slower (0.1 is 10%%)")
+        parser.add_argument('--only', nargs='+', choices=[bench.name for bench in BENCHMARKS],
+                            help="Only run these benchmarks")
+        parser.add_argument('--min-seconds', type=float, default=0.2, help="Minimum time spent on each benchmark")
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+
+        results = None
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            try:
+                with transaction.atomic():
+                    results = run_benchmarks(self.make_fixtures(), options['only'],
+                                             options['min_seconds'], options['repeat'])
+                    raise _Rollback()
+            except _Rollback:
+                pass
+
+        for name, result in results['results'].items():
+            self.stdout.write(f"{name:<24} {result['seconds'] * 1e6:12.2f} us/call "
+                              f"(best {result['best_seconds'] * 1e6:.2f})")
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+        if baseline is not None:
+            regressions = compare(results, baseline, options['threshold'])
+            for regression in regressions:
+                self.stderr.write(f"{regression.name} is {regression.ratio - 1:.1%} slower "
+                                  f"({regression.baseline_seconds * 1e6:.2f} -> {regression.seconds * 1e6:.2f} us/call)")
+            if regressions:
+                raise CommandError(f"{len(regressions)} benchmark(s) regressed by more than {options['threshold']:.0%}")
+            self.stdout.write(f"No regressions over {options['threshold']:.0%} against {options['baseline']}")
+
+    def make_fixtures(self):
+        from api.tests import TestCaseWithMockData, move_implementation, move_source
+        mock_data = TestCaseWithMockData('setUp')
+        mock_data.setUp()
+        # Don't depend on the convert_code_server
+        CompiledMove.objects.get_or_create(implementation_hash=api.move_cache.implementation_hash(move_implementation),
+                                           generator=api.move_cache.GENERATOR, defaults={'source': move_source})
+        game = mock_data.sample_game
+        board = game.array_board()
+        return {
+            'board': board,
+            'counts': count_surviving_pieces(board),
+            'move_code': api.move_cache.get_move_code(move_implementation),
+            'game': game,
+            'game_state': game.game_state,
+            'game_board': game.board,
+        }
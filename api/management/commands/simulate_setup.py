@@ -0,0 +1,43 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.models import BoardSetup
+from api.simulator import POLICIES, simulate_setup
+
+
+class Command(BaseCommand):
+    help = "Play a batch of games between bots on a board setup and report how balanced it is."
+
+    def add_arguments(self, parser):
+        parser.add_argument('setup', help="Name or pk of the board setup")
+        parser.add_argument('--games', type=int, default=100)
+        parser.add_argument('--white', choices=sorted(POLICIES), default='random', help="Policy for white")
+        parser.add_argument('--black', choices=sorted(POLICIES), default='random', help="Policy for black")
+        parser.add_argument('--processes', type=int, default=None,
+                            help="Number of worker processes, defaults to the number of CPUs")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--max-plies', type=int, default=200,
+                            help="Games that last longer than this are draws")
+        parser.add_argument('--json', action='store_true', help="Print the report as json")
+
+    def handle(self, *args, **options):
+        setup = options['setup']
+        try:
+            board_setup = BoardSetup.objects.get(pk=int(setup)) if setup.isdigit() \
+                else BoardSetup.objects.get(name=setup)
+        except BoardSetup.DoesNotExist:
+            raise CommandError(f"Board setup {setup} does not exist")
+        report = simulate_setup(
+            board_setup, options['games'],
+            white_policy=POLICIES[options['white']], black_policy=POLICIES[options['black']],
+            processes=options['processes'], seed=options['seed'], max_plies=options['max_plies'])
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self.stdout.write(f"{board_setup.name}: {report['games']} games, "
+                          f"{options['white']} (white) vs {options['black']} (black)")
+        self.stdout.write(f"  white wins {report['white_win_rate']:.1%}, black wins {report['black_win_rate']:.1%}, "
+                          f"draws {report['draw_rate']:.1%}")
+        self.stdout.write(f"  mean game length {report['mean_game_length']:.1f} plies, "
+                          f"{report['moves_per_second']:.0f} moves/s ({report['elapsed_seconds']:.1f}s)")
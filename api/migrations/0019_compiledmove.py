@@ -0,0 +1,21 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0018_alter_piece_image_black_alter_piece_image_white'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompiledMove',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('implementation_hash', models.CharField(max_length=64, unique=True)),
+                ('source', models.TextField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0019_compiledmove'),
+    ]
+
+    # Filled in by 0021, then renamed over the image blobs in 0022
+    operations = [
+        migrations.AddField(
+            model_name='piece',
+            name='image_white_name',
+            field=models.CharField(blank=True, max_length=80),
+        ),
+        migrations.AddField(
+            model_name='piece',
+            name='image_black_name',
+            field=models.CharField(blank=True, max_length=80),
+        ),
+    ]
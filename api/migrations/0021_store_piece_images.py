@@ -0,0 +1,71 @@
+import base64
+import hashlib
+import os
+import tempfile
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image
+from django.conf import settings
+from django.db import migrations
+
+# See api.image_store, copied here so that this migration keeps working if that changes
+
+
+def image_path(name):
+    return Path(settings.MEDIA_ROOT) / 'pieces' / name
+
+
+def save_image(data, extension):
+    """Store the image under the sha256 of its bytes if it isn't stored yet, and return its name."""
+    name = f"{hashlib.sha256(data).hexdigest()}.{extension}"
+    path = image_path(name)
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+    return name
+
+
+def images_to_store(apps, schema_editor):
+    """Write the base64 image blobs to the image store, and keep their names."""
+    Piece = apps.get_model('api', 'Piece')
+    for piece in Piece.objects.all():
+        for color in ['white', 'black']:
+            blob = getattr(piece, f'image_{color}')
+            if not blob:
+                continue
+            data = base64.b64decode(bytes(blob))
+            with Image.open(BytesIO(data)) as image:
+                extension = image.format.lower()
+            setattr(piece, f'image_{color}_name', save_image(data, extension))
+        piece.save(update_fields=['image_white_name', 'image_black_name'])
+
+
+def images_from_store(apps, schema_editor):
+    Piece = apps.get_model('api', 'Piece')
+    for piece in Piece.objects.all():
+        for color in ['white', 'black']:
+            name = getattr(piece, f'image_{color}_name')
+            if name:
+                setattr(piece, f'image_{color}', base64.b64encode(image_path(name).read_bytes()))
+        piece.save(update_fields=['image_white', 'image_black'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0020_piece_image_names'),
+    ]
+
+    # Separate from adding the columns in 0020 and dropping the blobs in 0022,
+    # so that no transaction both changes the schema and writes rows
+    operations = [
+        migrations.RunPython(images_to_store, images_from_store),
+    ]
@@ -0,0 +1,29 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0021_store_piece_images'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='piece',
+            name='image_white',
+        ),
+        migrations.RemoveField(
+            model_name='piece',
+            name='image_black',
+        ),
+        migrations.RenameField(
+            model_name='piece',
+            old_name='image_white_name',
+            new_name='image_white',
+        ),
+        migrations.RenameField(
+            model_name='piece',
+            old_name='image_black_name',
+            new_name='image_black',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0022_remove_piece_image_blobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='ply',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
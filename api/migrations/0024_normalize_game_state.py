@@ -0,0 +1,81 @@
+import json
+
+from django.db import migrations
+
+
+def normalize_game_state(game_state):
+    """Store each kind of piece once in 'piece_types', and only the occupied squares in 'board'."""
+    piece_types = {}
+    # Games from before pieces kept their pk get made up (negative) ones
+    unknown_types = {}
+    board = {}
+    for key, tile in game_state['board'].items():
+        piece = tile['piece']
+        if piece is None:
+            continue
+        piece_moves = {}
+        for piece_move in piece.get('piece_moves') or []:
+            # Games used to play the first move at each offset
+            piece_moves.setdefault(f"{piece_move['relative_row']},{piece_move['relative_col']}", str(piece_move['move']))
+        piece_pk = piece.get('piece_pk')
+        if piece_pk is None:
+            signature = json.dumps([piece['name'], piece_moves], sort_keys=True)
+            piece_pk = unknown_types.setdefault(signature, str(-1 - len(unknown_types)))
+        piece_types.setdefault(str(piece_pk), {'name': piece['name'], 'piece_moves': piece_moves})
+        board[key] = {
+            'piece_id': piece['piece_id'],
+            'piece_pk': str(piece_pk),
+            'team': piece['team'],
+            'is_royal': piece['is_royal'],
+        }
+    game_state['piece_types'] = piece_types
+    game_state['board'] = board
+    return game_state
+
+
+def denormalize_game_state(game_state):
+    piece_types = game_state.pop('piece_types')
+    board = {f"{row},{col}": {'piece': None} for row in range(8) for col in range(8)}
+    for key, piece in game_state['board'].items():
+        piece_type = piece_types[piece['piece_pk']]
+        piece_moves = []
+        for relative, move_pk in piece_type['piece_moves'].items():
+            relative_row, relative_col = relative.split(',')
+            piece_moves.append({'relative_row': int(relative_row), 'relative_col': int(relative_col), 'move': move_pk})
+        board[key] = {'piece': {
+            'team': piece['team'],
+            'name': piece_type['name'],
+            'piece_id': piece['piece_id'],
+            'piece_pk': piece['piece_pk'],
+            'piece_moves': piece_moves,
+            'is_royal': piece['is_royal'],
+        }}
+    game_state['board'] = board
+    return game_state
+
+
+def forwards(apps, schema_editor):
+    Game = apps.get_model('api', 'Game')
+    for game in Game.objects.iterator():
+        if 'piece_types' not in game.game_state:
+            game.game_state = normalize_game_state(game.game_state)
+            game.save(update_fields=['game_state'])
+
+
+def backwards(apps, schema_editor):
+    Game = apps.get_model('api', 'Game')
+    for game in Game.objects.iterator():
+        if 'piece_types' in game.game_state:
+            game.game_state = denormalize_game_state(game.game_state)
+            game.save(update_fields=['game_state'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0023_game_ply'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards),
+    ]
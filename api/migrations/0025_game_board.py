@@ -0,0 +1,24 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0024_normalize_game_state'),
+    ]
+
+    # Filled in by 0026
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='board',
+            field=models.BinaryField(default=b''),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='piece_counts',
+            field=models.JSONField(default=dict),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,69 @@
+from django.db import migrations
+
+# See api.game_logic.ArrayBoard.pack, copied here so that this migration keeps working if that changes
+PACKED_BOARD_VERSION = 1
+
+
+def count_pieces(pieces):
+    counts = {'white_total': 0, 'black_total': 0, 'white_royal': 0, 'black_royal': 0}
+    for piece in pieces:
+        counts[f"{piece['team']}_total"] += 1
+        if piece['is_royal']:
+            counts[f"{piece['team']}_royal"] += 1
+    return counts
+
+
+def pack_board(game_state):
+    """Move the board out of game_state, and keep every piece on it in 'pieces' instead."""
+    state_board = game_state.pop('board')
+    squares = [0] * 64
+    pieces = {}
+    for key, piece in state_board.items():
+        row, col = (int(i) for i in key.split(','))
+        squares[row * 8 + col] = piece['piece_id'] + 1
+        pieces[str(piece['piece_id'])] = piece
+    game_state['pieces'] = pieces
+    return bytes([PACKED_BOARD_VERSION] + squares)
+
+
+def unpack_board(game_state, packed):
+    """The game_state of 0024, with the board in it."""
+    packed = bytes(packed)
+    pieces = game_state.pop('pieces')
+    game_state['board'] = {
+        f"{square // 8},{square % 8}": pieces[str(piece_id - 1)]
+        for square, piece_id in enumerate(packed[1:]) if piece_id
+    }
+    return game_state
+
+
+def forwards(apps, schema_editor):
+    Game = apps.get_model('api', 'Game')
+    for game in Game.objects.iterator():
+        # Games from before the counts were kept get them counted once here
+        counts = game.game_state.pop('piece_counts', None)
+        if counts is None:
+            counts = count_pieces(game.game_state['board'].values())
+        game.piece_counts = counts
+        game.board = pack_board(game.game_state)
+        game.save(update_fields=['game_state', 'board', 'piece_counts'])
+
+
+def backwards(apps, schema_editor):
+    Game = apps.get_model('api', 'Game')
+    for game in Game.objects.iterator():
+        game.game_state = unpack_board(game.game_state, game.board)
+        game.game_state['piece_counts'] = game.piece_counts
+        game.save(update_fields=['game_state'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0025_game_board'),
+    ]
+
+    # Separate from adding the columns in 0025, so that no transaction both changes the schema and writes rows
+    operations = [
+        migrations.RunPython(forwards, backwards),
+    ]
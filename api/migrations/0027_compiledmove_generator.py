@@ -0,0 +1,27 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0026_pack_game_boards'),
+    ]
+
+    # Source stored before the generator was recorded doesn't match any generator, so it gets converted again
+    operations = [
+        migrations.AddField(
+            model_name='compiledmove',
+            name='generator',
+            field=models.CharField(default='', max_length=32),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='compiledmove',
+            name='implementation_hash',
+            field=models.CharField(max_length=64),
+        ),
+        migrations.AddConstraint(
+            model_name='compiledmove',
+            constraint=models.UniqueConstraint(fields=('implementation_hash', 'generator'), name='unique_compiled_move'),
+        ),
+    ]
@@ -1,16 +1,11 @@
-import base64
-from io import BytesIO
-from PIL import Image
-import json
 import re
-import requests
 from random import randint
-from typing import Dict, List, Tuple, Literal
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple, Literal, Union
 
 from wonderwords import RandomWord
 
 from api.emoji import emoji
-from django.db import models
+from django.db import models, transaction
 from django.utils.translation import gettext_lazy as _
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.core.exceptions import ValidationError
@@ -18,10 +13,21 @@ from django.contrib.auth.models import User
 from django.db.utils import IntegrityError
 from func_timeout import FunctionTimedOut
 from rest_framework import serializers
-from core.settings import CODE_CONVERT_HOST, CODE_CONVERT_PORT
+from core.settings import MOVE_TIMEOUT_SECONDS
 
 import api.game_logic
+import api.image_store
+import api.move_cache
+import api.piece_images
+import api.sandbox
 class BaseModelSerializer(serializers.ModelSerializer):
+    def __init__(self, *args, fields: Optional[Iterable[str]] = None, **kwargs):
+        """fields limits the output to these fields, by default all of Meta.fields are sent."""
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
     def to_representation(self, obj):
         data = super().to_representation(obj)
         # pks must be serialized as strings because the db doesn't start at 1 and rounding error happens 
@@ -53,6 +59,15 @@ def validate_simple_name(value):
             params={'value': value},
         )
 
+def in_bulk_or_invalid(model, pks: Iterable[Any]) -> Dict[int, Any]:
+    """pk -> instance for these pks in one query. Raises ValidationError if any don't exist."""
+    pks = {int(pk) for pk in pks}
+    instances = model.objects.in_bulk(pks)
+    missing = pks - set(instances)
+    if missing:
+        raise ValidationError(f"{model.__name__} {', '.join(map(str, sorted(missing)))} does not exist")
+    return instances
+
 random_word_gen = RandomWord()
 def make_random_username(emoji_mode=False):
     """Generate a random username
@@ -92,6 +107,13 @@ class Move(models.Model):
     def __str__(self):
         return f"Move {self.pk}: {self.overview} by {self.author}"
 
+    def clean(self):
+        # Convert the move now, so the author finds out about problems before it's played
+        try:
+            api.move_cache.check_move(self.implementation)
+        except ValidationError as e:
+            raise ValidationError({'implementation': e.messages})
+
     class Meta:
         indexes = [models.Index(fields=['author'])]
 
@@ -100,20 +122,39 @@ class MoveSerializer(BaseModelSerializer):
 
     def to_representation(self, obj):
         data = super().to_representation(obj)
-        data['color'] =  list(map(int, data['color'][1:-1].split(',')))
+        if 'color' in data:
+            data['color'] = list(map(int, data['color'][1:-1].split(',')))
         return data
 
     class Meta:
         model = Move
         fields = ['pk', 'cat', 'color', 'implementation', 'overview', 'description', 'symbol', 'author']
 
-class BinarySeralizer(serializers.Field):
+class CompiledMove(models.Model):
+    """
+    Python source generated from a move implementation, shared by every
+    move with the same implementation. See api/move_cache.py
+    """
+    implementation_hash = models.CharField(max_length=64)
+    # See api.move_cache.GENERATOR, source from any other generator is ignored
+    generator = models.CharField(max_length=32)
+    source = models.TextField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['implementation_hash', 'generator'], name='unique_compiled_move')]
+
+    def __str__(self):
+        return f"Compiled move {self.implementation_hash[:12]}"
+
+class ImageUrlSerializer(serializers.Field):
+    """Turns the name of an image in api.image_store into the url it's served from."""
     def to_representation(self, value):
-        return "data:image/png;base64," + str(value, 'ascii') #remove b' and trailing '
+        return api.image_store.url_of(value)
 
 class Piece(models.Model):
-    image_white = models.BinaryField(blank=True)
-    image_black = models.BinaryField(blank=True)
+    # Names of the images in api.image_store
+    image_white = models.CharField(max_length=80, blank=True)
+    image_black = models.CharField(max_length=80, blank=True)
     author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='author')
     class Meta:
         indexes = [models.Index(fields=['author', 'cat'])]
@@ -132,43 +173,34 @@ class Piece(models.Model):
                      name: str, moves: List[Dict[str, int]],
                      cat: Category):
         # image is formated as 'data:image/png;base64,iVBOr== EGk'
-        metadata, base64_data = image.split(',')
-        content_type = re.search(r'(data:image\/)([a-z]*)(;base64)', metadata).group(2)
-        piece = Piece(author=author, name=name, cat=cat)
-        bytes_data = BytesIO(base64.b64decode(base64_data))
-        def make_image_bytes(bg_file):
-            with Image.open(bytes_data) as base_img:
-                with Image.open(bg_file) as tile:
-                    resize_tile = tile.resize(base_img.size)
-                    comp = Image.alpha_composite(resize_tile, base_img)
-                    with BytesIO() as output:
-                        comp.save(output, format=content_type)
-                        return base64.b64encode(output.getvalue())
-        byte_data = make_image_bytes('static/tile-white.png')
-        piece.image_white = byte_data
-        piece.image_black = make_image_bytes('static/tile-black.png')
-        pieceMoves = []
-        for moveInfo in moves:
-            move = Move.objects.get(pk=int(moveInfo['move']))
-            pieceMoves.append(PieceMove(
-                relative_row=moveInfo['relative_row'],
-                relative_col=moveInfo['relative_col'],
-                move=move,
-                piece=piece,
-            ))
+        images = api.piece_images.make_piece_images(image)
+        piece = Piece(author=author, name=name, cat=cat,
+                      image_white=images['white'].name, image_black=images['black'].name)
+        moves_by_pk = in_bulk_or_invalid(Move, [moveInfo['move'] for moveInfo in moves])
+        pieceMoves = [PieceMove(
+            relative_row=moveInfo['relative_row'],
+            relative_col=moveInfo['relative_col'],
+            move=moves_by_pk[int(moveInfo['move'])],
+            piece=piece,
+        ) for moveInfo in moves]
+        # Everything is checked before anything is written
+        piece.full_clean()
+        for pieceMove in pieceMoves:
+            # The piece isn't saved yet, and the moves were just fetched
+            pieceMove.full_clean(exclude=['piece', 'move'])
+        offsets = [(pieceMove.relative_row, pieceMove.relative_col) for pieceMove in pieceMoves]
+        duplicates = sorted({offset for offset in offsets if offsets.count(offset) > 1})
+        if duplicates:
+            raise ValidationError(f"A piece can only have one move at {', '.join(map(str, duplicates))}")
         try:
-            piece.save()
-            for move in pieceMoves:
-                move.save()
-            piece.full_clean()
-            for i in range(len(pieceMoves)):
-                pieceMoves[i].full_clean()
-        except (ValidationError, IntegrityError) as e:
-            try:
-                piece.delete()
-            except ValueError:
-                pass # was not saved
-            raise ValidationError(e)
+            with transaction.atomic():
+                piece.save()
+                PieceMove.objects.bulk_create(pieceMoves)
+                # Last, so that nothing is written for a piece that couldn't be saved
+                for piece_image in images.values():
+                    piece_image.save()
+        except IntegrityError as e:
+            raise ValidationError(str(e))
         return piece
 
 
@@ -187,6 +219,14 @@ class PieceMove(models.Model):
     class Meta:
         indexes = [models.Index(fields=['piece'])]
 
+    def clean(self):
+        # A piece that isn't saved yet has no moves to clash with, create_piece checks those
+        if self.piece_id is not None and PieceMove.objects.filter(
+                piece_id=self.piece_id, relative_row=self.relative_row, relative_col=self.relative_col,
+        ).exclude(pk=self.pk).exists():
+            raise ValidationError(
+                f"This piece already has a move at ({self.relative_row}, {self.relative_col})")
+
 class PieceMoveSerializer(BaseModelSerializer):
     def to_representation(self, obj):
         data = super().to_representation(obj)
@@ -200,8 +240,8 @@ class PieceMoveSerializer(BaseModelSerializer):
 class PieceSerializer(BaseModelSerializer):
     piece_moves = PieceMoveSerializer(many=True, read_only=True)
     author = serializers.SlugRelatedField('username', read_only=True)
-    image_white = BinarySeralizer()
-    image_black = BinarySeralizer()
+    image_white = ImageUrlSerializer()
+    image_black = ImageUrlSerializer()
 
     class Meta:
         model = Piece
@@ -240,8 +280,9 @@ class BoardSetup(models.Model):
         black_has_piece = False
         white_has_royal = False
         black_has_royal = False
+        pieces_by_pk = in_bulk_or_invalid(Piece, [pieceLocation['piece'] for pieceLocation in pieces])
         for pieceLocation in pieces:
-            piece = Piece.objects.get(pk=int(pieceLocation['piece']))
+            piece = pieces_by_pk[int(pieceLocation['piece'])]
             if pieceLocation['team'] == 'white':
                 team = PieceLocation.Team.WHITE
                 white_has_piece = True
@@ -270,19 +311,17 @@ class BoardSetup(models.Model):
         if wincon_black == BoardSetup.WinCon.KILL_ANY_ROYAL or wincon_black == BoardSetup.WinCon.KILL_ALL_ROYALS:
             if not white_has_royal:
                 raise ValidationError("White has no royal pieces")
+        board.full_clean()
+        for pieceLoc in pieceLocations:
+            # The board isn't saved yet, and the pieces were just fetched
+            pieceLoc.full_clean(exclude=['board_setup', 'piece'])
         try:
-            board.save()
-            for pieceLoc in pieceLocations:
-                pieceLoc.save()
-            board.full_clean()
-            for pieceLoc in pieceLocations:
-                pieceLoc.full_clean()
-        except (ValidationError, IntegrityError) as e:
-            try:
-                board.delete()
-            except ValueError:
-                pass # was not saved
-            raise ValidationError(e)
+            with transaction.atomic():
+                board.save()
+                PieceLocation.objects.bulk_create(pieceLocations)
+        except IntegrityError as e:
+            # Such as another board with the same name saved since full_clean
+            raise ValidationError(str(e))
         return board
 
     class Meta:
@@ -351,7 +390,14 @@ class Game(models.Model):
     black_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='black_user')
     white_to_move = models.BooleanField(default=True)
     setup = models.ForeignKey(BoardSetup, on_delete=models.DO_NOTHING)
+    # Everything about the game that doesn't change from move to move, see initial_game_state
     game_state = models.JSONField()
+    # Where each piece is, see api.game_logic.ArrayBoard.pack. Kept out of game_state
+    # so that a move only writes these few bytes.
+    board = models.BinaryField()
+    # Pieces left on the board, see api.game_logic.count_pieces. Kept up to date by each
+    # move (see MoveContext.take) rather than counted from the board.
+    piece_counts = models.JSONField()
 
     class Meta:
         indexes = [models.Index(fields=['white_user', 'black_user'])]
@@ -365,13 +411,16 @@ class Game(models.Model):
         DRAW_AGREED = 'E'
         IN_PROGRESS = "P"
     result = models.CharField(max_length=1, choices=Result.choices, default=Result.IN_PROGRESS)
-        
+    # Number of moves played so far, lets players notice if they missed an update
+    ply = models.PositiveIntegerField(default=0)
+
     def resign(self, requesting_color: Literal['black', 'white']):
         if requesting_color == "white":
             self.result = self.Result.BLACK_WIN_RESIGN
         elif requesting_color == "black":
             self.result = self.Result.WHITE_WIN_RESIGN
-        self.save()
+        # Only what changed, so that a move saved in the meantime is kept
+        self.save(update_fields=['result'])
         return True
 
     def draw(self, requesting_color: Literal['black', 'white']):
@@ -379,181 +428,281 @@ class Game(models.Model):
             self.game_state['draw_offer'] = requesting_color
         elif self.game_state['draw_offer'] != requesting_color:
             self.result = self.Result.DRAW_AGREED
-        self.save()
+        self.save(update_fields=['game_state', 'result'])
         return True
         
     @staticmethod
-    def create_game(white_user: User, black_user: User, orig_board_setup: BoardSetup):
-        initial_piece_locations = PieceLocation.objects.filter(('board_setup', orig_board_setup))
+    def initial_game_state(orig_board_setup: BoardSetup) -> Tuple[Dict[str, Any], api.game_logic.ArrayBoard]:
+        """The game_state and board of a new game using this board setup.
+
+        Each kind of piece is stored once in 'piece_types', keyed by piece pk, with
+        its moves keyed by "relative_row,relative_col". Each piece in the game is in
+        'pieces', keyed by piece_id, and only says which piece type it is, its team,
+        and if it's royal (see api.game_logic.PieceRecord.to_json).
+        """
+        initial_piece_locations = PieceLocation.objects.filter(board_setup=orig_board_setup) \
+            .select_related('piece') \
+            .prefetch_related(models.Prefetch('piece__piece_moves', PieceMove.objects.order_by('pk'))).order_by('pk')
         # Store all of the pieces and their moves in this object.
         # Even if the original data gets modified or deleted during play,
         # we won't need to worry about it.
-        board = {}
-        for row in range(8):
-            for col in range(8):
-                board[f"{row},{col}"] = {'piece': None}
-        moves = {}
+        board = api.game_logic.ArrayBoard()
+        piece_types = {}
         for pieceId, pieceLoc in enumerate(initial_piece_locations, 0):
-            piece = PieceSerializer(pieceLoc.piece).data
-            piece['team'] = pieceLoc.team
-            board[f"{pieceLoc.row},{pieceLoc.col}"] = {
-                'piece': {
-                    'team': pieceLoc.team,
-                    'name': piece['name'],
-                    'piece_id': pieceId,
-                    'piece_pk': str(piece['pk']),
-                    'piece_moves': piece['piece_moves'],
-                    'is_royal': pieceLoc.is_royal
+            piece_pk = str(pieceLoc.piece.pk)
+            if piece_pk not in piece_types:
+                piece_moves = {}
+                for piece_move in pieceLoc.piece.piece_moves.all():
+                    # Pieces from before duplicates were rejected play the first move at each offset
+                    piece_moves.setdefault(f"{piece_move.relative_row},{piece_move.relative_col}", str(piece_move.move_id))
+                piece_types[piece_pk] = {
+                    'name': pieceLoc.piece.name,
+                    'piece_moves': piece_moves,
                 }
-            }
-            for move in piece['piece_moves']:
-                move_pk = move['move']
-                if move_pk not in moves:
-                    moves[str(move_pk)] = MoveSerializer(Move.objects.get(('pk', move_pk))).data
+            piece = api.game_logic.PieceRecord(pieceId, pieceLoc.piece.name, pieceLoc.team, pieceLoc.is_royal, piece_pk)
+            board.set_piece((pieceLoc.row, pieceLoc.col), piece)
+            board.pieces[pieceId] = piece
+        move_pks = {move_pk for piece_type in piece_types.values() for move_pk in piece_type['piece_moves'].values()}
+        moves = {str(move.pk): MoveSerializer(move).data
+                 for move in Move.objects.filter(pk__in=move_pks).select_related('author')}
+        # Keep the python rather than the blocks, so changes to the move
+        # (or to how blocks are converted) don't affect games in progress.
+        # All of the moves are converted together, in one go.
+        sources = api.move_cache.get_move_sources([move.pop('implementation') for move in moves.values()])
+        for move, source in zip(moves.values(), sources):
+            move['code'] = source
 
         game_state_json = {
-            'board': board,
+            'piece_types': piece_types,
+            'pieces': {str(piece_id): piece.to_json() for piece_id, piece in board.pieces.items()},
             'moves': moves,
             'wincon_white': orig_board_setup.wincon_white,
             'wincon_black': orig_board_setup.wincon_black,
             'draw_offer': 'none'
         }
+        return game_state_json, board
 
+    @staticmethod
+    def create_game(white_user: User, black_user: User, orig_board_setup: BoardSetup):
+        game_state, board = Game.initial_game_state(orig_board_setup)
         game = Game(white_user=white_user, black_user=black_user,
-                    game_state=game_state_json,
+                    game_state=game_state, board=board.pack(), piece_counts=count_surviving_pieces(board),
                     setup=orig_board_setup)
         game.full_clean()
         game.save()
         return game
 
+    def array_board(self, flip: bool = False) -> api.game_logic.ArrayBoard:
+        pieces = api.game_logic.pieces_from_state(self.game_state['pieces'], self.game_state['piece_types'])
+        return api.game_logic.ArrayBoard.unpack(self.board, pieces, flip)
+
+    def state_json(self) -> Dict[str, Any]:
+        """The game_state sent to players, with the board as "row,col" -> piece for each occupied square."""
+        state = {key: value for key, value in self.game_state.items() if key != 'pieces'}
+        state['board'] = self.array_board().to_state()
+        state['piece_counts'] = self.piece_counts
+        return state
+
     def make_move(self, from_loc: Tuple[int, int], to_loc: Tuple[int, int], user):
-        board = {}
-        for row in range(8):
-            for col in range(8):
-                board[api.game_logic.Location(row, col)] = {'piece': None}
-        # Convert keys from string to tuple and flip board for black
-        for k, v in self.game_state['board'].items():
-            row, col = k.split(',')
-            if not self.white_to_move:
-                row = 7 - int(row)
-            board[api.game_logic.Location(int(row), int(col))] = v
+        move = self.prepare_move(from_loc, to_loc, user)
+        return self.finish_move(move, move.run())
+
+    def prepare_move(self, from_loc: Tuple[int, int], to_loc: Tuple[int, int], user) -> 'PreparedMove':
+        """Check that this user can play this move, and get it ready to run. See make_move"""
+        # Black sees the board from their side, so that their pieces move upwards
+        board = self.array_board(flip=not self.white_to_move)
 
         if not self.white_to_move:
             from_loc = 7 - from_loc[0], from_loc[1]
             to_loc = 7 - to_loc[0], to_loc[1]
 
         # Get the move that we want to execute
-        piece = board[from_loc]['piece']
+        piece = board.piece_at(from_loc)
         if piece == None:
             raise ValidationError("Could not find a piece to move")
-        if piece['team'] == 'white':
+        if piece.team == 'white':
             if not self.white_to_move:
-                raise ValidationError(f"It's not currently {piece['team']}'s turn to move")
+                raise ValidationError(f"It's not currently {piece.team}'s turn to move")
             if user != self.white_user:
                 raise ValidationError(f"You are not playing as white")
-        if piece['team'] == 'black':
+        if piece.team == 'black':
             if self.white_to_move:
-                raise ValidationError(f"It's not currently {piece['team']}'s turn to move")
+                raise ValidationError(f"It's not currently {piece.team}'s turn to move")
             if user != self.black_user:
                 raise ValidationError(f"You are not playing as black")
 
-        rel_row = to_loc[0] - from_loc[0]
-        rel_col = to_loc[1] - from_loc[1]
-        move = None
-        for piece_move in piece['piece_moves']:
-            if piece_move['relative_row'] == rel_row and piece_move['relative_col'] == rel_col:
-                move = self.game_state['moves'][str(piece_move['move'])]
-                break
-        if move == None:
+        move_pk = piece.piece_moves.get((to_loc[0] - from_loc[0], to_loc[1] - from_loc[1]))
+        if move_pk is None:
             raise ValidationError("Could not find a move at the specified location")
+        move = self.game_state['moves'][move_pk]
+
+        move_code = api.move_cache.get_game_move_code(move)
+
+        return PreparedMove(move_code, board, api.game_logic.Location(*from_loc), api.game_logic.Location(*to_loc),
+                            dict(self.piece_counts), self.ply)
+
+    def finish_move(self, move: 'PreparedMove', result: api.game_logic.MoveContext) -> bool:
+        """Save the outcome of a move from prepare_move.
 
-        # Get the implementation of the move from the XML representation
-        headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
-        data = json.dumps(move['implementation'])
-        response = requests.post(f"http://{CODE_CONVERT_HOST}:{CODE_CONVERT_PORT}", data, headers=headers)
-        if response.status_code != 200:
-            raise ValidationError(f"Code conversion server has failed with error code {response.status_code}")
+        Raises ValidationError if another move was saved since the move was prepared.
+        """
+        self.piece_counts = result.counts
+        self.result = get_game_result(
+            move.start_pieces, self.piece_counts, self.game_state['wincon_white'], self.game_state['wincon_black'])
 
-        start_pieces = count_surviving_pieces(board)
+        self.board = result.board.pack()
+        update_fields = ['board', 'piece_counts', 'result', 'white_to_move', 'ply']
+        if (((self.game_state['draw_offer'] == 'black') and self.white_to_move) or
+            ((self.game_state['draw_offer'] == 'white') and not self.white_to_move)):
+            self.game_state['draw_offer'] = 'none'
+            update_fields.append('game_state')
+        self.white_to_move = not self.white_to_move
+        self.ply = move.ply + 1
+        # Only if nobody else moved in the meantime
+        if not Game.objects.filter(pk=self.pk, ply=move.ply).update(
+                **{field: getattr(self, field) for field in update_fields}):
+            self.refresh_from_db()
+            raise ValidationError("The game changed while this move was being made, try again.")
+        return True
 
-        # Make the move!
+    def game_update(self, previous_board: Optional[bytes] = None) -> Dict[str, Any]:
+        """What the players need to bring their copy of the game up to date.
+
+        Only the tiles whose piece changed since previous_board (a packed board, or
+        none, if it isn't given) are included, as "row,col" -> piece_id or None.
+        Players have every piece from the full game_state (see GameSerializer), and
+        pieces never change, so the piece_id is enough.
+        """
+        changed = {}
+        captured = []
+        if previous_board is not None:
+            # Both are in the format of ArrayBoard.pack, so squares can be compared byte by byte
+            board, previous_board = bytes(self.board)[1:], bytes(previous_board)[1:]
+            for i, (square, previous_square) in enumerate(zip(board, previous_board)):
+                if square != previous_square:
+                    row, col = api.game_logic.SQUARES[i]
+                    changed[f"{row},{col}"] = square - 1 if square else None
+            captured = sorted(square - 1 for square in set(previous_board) - set(board) if square)
+        return {
+            'pk': str(self.pk),
+            'ply': self.ply,
+            'white_to_move': self.white_to_move,
+            'result': self.result,
+            'draw_offer': self.game_state['draw_offer'],
+            'changed': changed,
+            'captured': captured,
+        }
+
+    def legal_moves(self) -> List[Tuple[Tuple[int, int], Tuple[int, int]]]:
+        """Every (from_loc, to_loc) that the side to move can currently play."""
+        if self.result != self.Result.IN_PROGRESS:
+            return []
+        return self.prepare_legal_moves().run()
+
+    def prepare_legal_moves(self) -> 'PreparedLegalMoves':
+        """Everything legal_moves needs from the database. See PreparedLegalMoves.run"""
+        flip = not self.white_to_move
+        team = 'white' if self.white_to_move else 'black'
+        board = self.array_board(flip=flip)
+        # Compile each move that could be used once, rather than once per piece
+        move_pks = {move_pk
+                    for _, piece in board.occupied() if piece.team == team
+                    for move_pk in piece.piece_moves.values()}
+        move_codes = {
+            move_pk: api.move_cache.get_game_move_code(self.game_state['moves'][move_pk])
+            for move_pk in move_pks
+        }
+        return PreparedLegalMoves(move_codes, board, team)
+
+class PreparedMove(NamedTuple):
+    """A move that Game.prepare_move has checked, ready to run.
+
+    Running it doesn't touch the database, so it can be done on any thread,
+    then Game.finish_move saves the result.
+    """
+    code: 'api.move_cache.CompiledMoveCode'
+    # Seen from the side of the player making the move, like the locations
+    board: api.game_logic.ArrayBoard
+    from_loc: api.game_logic.Location
+    to_loc: api.game_logic.Location
+    start_pieces: Dict[str, int]
+    # Of the game when the move was prepared
+    ply: int
+
+    def run(self) -> api.game_logic.MoveContext:
+        """Make the move on the sandbox, raising ValidationError if it can't be played."""
         try:
-            result = api.game_logic.make_move(response.text,
-                board, api.game_logic.Location(*from_loc), api.game_logic.Location(*to_loc))
+            result = api.sandbox.make_move(self.code, self.board, self.from_loc, self.to_loc,
+                                           dict(self.start_pieces))
         except AttributeError:
             raise ValidationError("This move could not be executed. Try another move instead.")
         except api.game_logic.InvalidMoveError:
             raise ValidationError("You cannot play this move from this position.")
         except FunctionTimedOut:
-            raise ValidationError("It took too long to execute this move (>1 sec), there may be an infinite loop. Try another move instead.")
+            raise ValidationError(f"It took too long to execute this move (>{MOVE_TIMEOUT_SECONDS:g} sec), there may be an infinite loop. Try another move instead.")
+        except api.sandbox.WorkerCrashed:
+            raise ValidationError("This move crashed while it was executing. Try another move instead.")
         if not result.did_action:
             raise ValidationError(f"You cannot play this move as it would do nothing.")
+        return result
 
-        end_pieces = count_surviving_pieces(board)
-        self.result = get_game_result(
-            start_pieces, end_pieces, self.game_state['wincon_white'], self.game_state['wincon_black'])
-
-        # Convert keys from tuple back to a json-able string and flip board back for black
-        new_board = {}
-        for k, v in board.items():
-            row, col = k
-            if not self.white_to_move:
-                row = 7 - row
-            new_board[f"{row},{col}"] = v
+class PreparedLegalMoves(NamedTuple):
+    """What Game.legal_moves needs to run the moves, without touching the database. See PreparedMove"""
+    codes: Dict[str, 'api.move_cache.CompiledMoveCode']
+    board: api.game_logic.ArrayBoard
+    team: str
 
-        self.game_state['board'] = new_board
-        if (((self.game_state['draw_offer'] == 'black') and self.white_to_move) or
-            ((self.game_state['draw_offer'] == 'white') and not self.white_to_move)):
-            self.game_state['draw_offer'] = 'none'
-        self.white_to_move = not self.white_to_move
-        self.save()
-        return True
-
-def count_surviving_pieces(board: Dict[api.game_logic.Location, api.game_logic.BoardTile]):
-    counts = {
-        'white_total': 0,
-        'black_total': 0,
-        'white_royal': 0,
-        'black_royal': 0
-    }
-    for tile in board.values():
-        piece = tile['piece']
-        if piece != None:
-            if piece['team'] == 'white':
-                counts['white_total'] += 1
-                if piece['is_royal']:
-                    counts['white_royal'] += 1
-            if piece['team'] == 'black':
-                counts['black_total'] += 1
-                if piece['is_royal']:
-                    counts['black_royal'] += 1
-    return counts
+    def run(self) -> List[Tuple[Tuple[int, int], Tuple[int, int]]]:
+        """Find the legal moves on the sandbox, raising ValidationError if that fails."""
+        try:
+            found = api.sandbox.legal_moves(self.codes, self.board, self.team)
+        except FunctionTimedOut:
+            raise ValidationError("It took too long to find the legal moves, one of the moves may have an infinite loop.")
+        except api.sandbox.WorkerCrashed:
+            raise ValidationError("One of the moves crashed while finding the legal moves.")
+        legal = []
+        for from_loc, to_loc in found:
+            if self.team == 'black':
+                from_loc = 7 - from_loc.row, from_loc.col
+                to_loc = 7 - to_loc.row, to_loc.col
+            legal.append((tuple(from_loc), tuple(to_loc)))
+        return sorted(legal)
+
+def count_surviving_pieces(board: Union[api.game_logic.ArrayBoard, Dict[api.game_logic.Location, api.game_logic.BoardTile]]):
+    if isinstance(board, api.game_logic.ArrayBoard):
+        return api.game_logic.count_pieces(piece for _, piece in board.occupied())
+    return api.game_logic.count_pieces(tile['piece'] for tile in board.values() if tile['piece'] is not None)
+
+def _team_won(start_pieces, end_pieces, wincon: BoardSetup.WinCon, other_team: str) -> bool:
+    other_total, other_royal = api.game_logic.COUNT_KEYS[other_team]
+    if wincon == BoardSetup.WinCon.KILL_ALL:
+        return end_pieces[other_total] == 0
+    elif wincon == BoardSetup.WinCon.KILL_ALL_ROYALS:
+        return end_pieces[other_royal] == 0
+    elif wincon == BoardSetup.WinCon.KILL_ANY_ROYAL:
+        return end_pieces[other_royal] < start_pieces[other_royal]
+    return False
 
 def get_game_result(start_pieces, end_pieces, wincon_white: BoardSetup.WinCon, wincon_black: BoardSetup.WinCon):
-    results = []
-    for team, other_team, wincon in zip(['white', 'black'], ['black', 'white'], [wincon_white, wincon_black]):
-        team_won = False
-        if wincon == BoardSetup.WinCon.KILL_ALL and end_pieces[f"{other_team}_total"] == 0:
-            team_won = True
-        elif wincon == BoardSetup.WinCon.KILL_ALL_ROYALS and end_pieces[f"{other_team}_royal"] == 0:
-            team_won = True
-        elif wincon == BoardSetup.WinCon.KILL_ANY_ROYAL and end_pieces[f"{other_team}_royal"] < start_pieces[f"{other_team}_royal"]:
-            team_won = True
-        results.append(team_won)
-    if not results[0] and not results[1]:
-        return Game.Result.IN_PROGRESS
-    elif results[0] and not results[1]:
+    white_won = _team_won(start_pieces, end_pieces, wincon_white, 'black')
+    black_won = _team_won(start_pieces, end_pieces, wincon_black, 'white')
+    if white_won and black_won:
+        return Game.Result.DRAW
+    elif white_won:
         return Game.Result.WHITE_WIN
-    elif not results[0] and results[1]:
+    elif black_won:
         return Game.Result.BLACK_WIN
-    elif not results[0] and results[1]:
-        return Game.Result.DRAW
+    return Game.Result.IN_PROGRESS
 
 class GameSerializer(BaseModelSerializer):
     white_user = serializers.SlugRelatedField('username', read_only=True)
     black_user = serializers.SlugRelatedField('username', read_only=True)
     setup = serializers.SlugRelatedField("info_short", read_only=True)
+    game_state = serializers.SerializerMethodField()
+
+    def get_game_state(self, game):
+        return game.state_json()
 
     class Meta:
         model = Game
-        fields = ['pk',  'white_user', 'black_user', 'white_to_move', 'game_state', 'result', 'setup']
+        fields = ['pk',  'white_user', 'black_user', 'white_to_move', 'game_state', 'result', 'setup', 'ply']
@@ -0,0 +1,256 @@
+"""
+Cache for the python code that implements each move.
+
+Turning a blockly workspace into python takes a walk over every block (or
+a round trip to the convert_code_server), and the result still has to be
+compiled into a function (see api.game_logic.compile_move). Both steps only
+depend on the implementation json, so we key them on a hash of it and keep
+the results in two tiers:
+
+1) In-process LRUs of the generated source, and of the compiled move
+   functions (keyed on a hash of the source, so they follow any change to it).
+2) The CompiledMove table, which holds the generated source so that
+   other processes (and restarts) don't have to convert it again. Rows are
+   also keyed on GENERATOR, so a new generator converts every move again.
+
+Games keep a copy of the source of each of their moves (see
+Game.initial_game_state), so playing a move only needs the second LRU.
+"""
+import ast
+import builtins
+import hashlib
+import json
+import symtable
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, Hashable, List, NamedTuple, Optional, Sequence
+
+from django.core.exceptions import ValidationError
+
+import api.blockly_compiler
+import api.converter_client
+import api.game_logic
+import api.models
+from api.game_logic import MoveAction
+from core.settings import CODE_CONVERTER, COMPILED_MOVE_CACHE_SIZE
+
+
+class CompiledMoveCode(NamedTuple):
+    # Hash of the source, see code_hash
+    code_hash: str
+    source: str
+    # See api.game_logic.compile_move
+    action: MoveAction
+
+
+class LRUCache:
+    """A small thread safe least-recently-used cache."""
+    def __init__(self, max_size: int):
+        assert max_size > 0
+        self.max_size = max_size
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+            except KeyError:
+                return default
+            return self._entries[key]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# What turns implementations into source. CODE_CONVERTER is part of it even
+# though both converters should give the same source, in case they don't.
+GENERATOR = f"{CODE_CONVERTER}-{api.blockly_compiler.GENERATOR_VERSION}"
+
+_sources = LRUCache(COMPILED_MOVE_CACHE_SIZE)
+_compiled_moves = LRUCache(COMPILED_MOVE_CACHE_SIZE)
+
+
+def implementation_hash(implementation: Any) -> str:
+    """Hash of a move implementation that doesn't depend on key order or whitespace."""
+    canonical = json.dumps(implementation, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def code_hash(source: str) -> str:
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+
+def convert_implementation(implementation: Any) -> str:
+    """Get the python source of this implementation."""
+    return convert_implementations([implementation])[0]
+
+
+def convert_implementations(implementations: Sequence[Any]) -> List[str]:
+    """Get the python source of each implementation.
+
+    With the convert_code_server they are all converted in one request.
+    """
+    if CODE_CONVERTER == 'server':
+        return convert_with_server(implementations)
+    try:
+        return [api.blockly_compiler.compile_workspace(implementation) for implementation in implementations]
+    except api.blockly_compiler.BlocklyCompileError as e:
+        raise ValidationError(f"Could not convert this move to code: {e}")
+
+
+def convert_with_server(implementations: Sequence[Any]) -> List[str]:
+    """Ask the convert_code_server for the python source of these implementations."""
+    client = api.converter_client.get_client()
+    try:
+        if len(implementations) == 1:
+            return [client.convert(implementations[0])]
+        return client.convert_many(implementations)
+    except api.converter_client.ConversionFailed as e:
+        raise ValidationError(f"Could not convert this move to code: {e}")
+    except api.converter_client.ConverterUnavailable as e:
+        raise ValidationError(str(e))
+
+
+def get_move_source(implementation: Any) -> str:
+    """Get the python source for a move implementation.
+
+    Looks in the in-process cache first, then the database, and only
+    converts the implementation if neither has seen it.
+    """
+    return get_move_sources([implementation])[0]
+
+
+def get_move_sources(implementations: Sequence[Any]) -> List[str]:
+    """get_move_source for many implementations at once.
+
+    Uses one query for the ones that aren't cached, and one conversion
+    (a single round trip with the convert_code_server) for the ones that
+    aren't in the database either.
+    """
+    keys = [implementation_hash(implementation) for implementation in implementations]
+    sources: Dict[str, str] = {}
+    for key in keys:
+        source = _sources.get(key)
+        if source is not None:
+            sources[key] = source
+    missing = {key: implementation for key, implementation in zip(keys, implementations) if key not in sources}
+    if missing:
+        sources.update(api.models.CompiledMove.objects.filter(implementation_hash__in=list(missing), generator=GENERATOR)
+                       .values_list('implementation_hash', 'source'))
+        to_convert = {key: implementation for key, implementation in missing.items() if key not in sources}
+        if to_convert:
+            converted = dict(zip(to_convert, convert_implementations(list(to_convert.values()))))
+            api.models.CompiledMove.objects.bulk_create(
+                [api.models.CompiledMove(implementation_hash=key, generator=GENERATOR, source=source)
+                 for key, source in converted.items()],
+                ignore_conflicts=True)
+            sources.update(converted)
+        for key in missing:
+            _sources.put(key, sources[key])
+    return [sources[key] for key in keys]
+
+
+def compile_source(source: str) -> CompiledMoveCode:
+    """Compile move source, or get it from the cache if it was compiled already.
+
+    May raise a SyntaxError if the source does not compile.
+    """
+    key = code_hash(source)
+    compiled: Optional[CompiledMoveCode] = _compiled_moves.get(key)
+    if compiled is None:
+        compiled = CompiledMoveCode(key, source, api.game_logic.compile_move(source, f"<move {key[:12]}>"))
+        _compiled_moves.put(key, compiled)
+    return compiled
+
+
+def get_move_code(implementation: Any) -> CompiledMoveCode:
+    """Get the compiled python code for a move implementation.
+
+    May raise a SyntaxError if the generated code does not compile.
+    """
+    return compile_source(get_move_source(implementation))
+
+
+def get_game_move_code(move: Dict[str, Any]) -> CompiledMoveCode:
+    """Get the compiled python code for a move in game_state['moves'].
+
+    Games keep the source of their moves, apart from games that were
+    created before they did, which still need to convert the implementation.
+    """
+    if 'code' in move:
+        return compile_source(move['code'])
+    return get_move_code(move['implementation'])
+
+
+# Names that move code can use without defining them
+MOVE_GLOBALS = set(api.game_logic.MOVE_ARGUMENTS)
+
+
+def check_source(source: str) -> None:
+    """Raise a ValidationError if this move source could never be played.
+
+    Moves run with no builtins, and the action function can only see
+    MOVE_GLOBALS, so e.g. reading a variable before setting it would be a
+    NameError in the middle of a game.
+    """
+    try:
+        tree = ast.parse(source)
+    except SyntaxError as e:
+        raise ValidationError(f"The code for this move is invalid (line {e.lineno}: {e.msg}). "
+                              "Check for blocks with missing inputs.")
+    if not any(isinstance(node, ast.FunctionDef) and node.name == 'action' for node in tree.body):
+        raise ValidationError("A move needs an Act block.")
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            raise ValidationError(f"Moves can't use {ast.unparse(node)[len('import '):]}.")
+    unavailable = set()
+    tables = [table for table in symtable.symtable(source, '<move>', 'exec').get_children()
+              if table.get_name() == 'action']
+    while tables:
+        table = tables.pop()
+        tables.extend(table.get_children())
+        for symbol in table.get_symbols():
+            if symbol.is_referenced() and symbol.is_global() and symbol.get_name() not in MOVE_GLOBALS:
+                unavailable.add(symbol.get_name())
+    # e.g. the helper functions that blockly adds for some loops
+    helpers = sorted(unavailable & {node.name for node in tree.body if isinstance(node, ast.FunctionDef)})
+    if helpers:
+        raise ValidationError(f"Moves can't use {', '.join(helpers)}. Try rewriting this part of the move.")
+    # e.g. range, which blockly uses for counting loops
+    builtin_names = sorted(unavailable & set(dir(builtins)))
+    if builtin_names:
+        raise ValidationError(f"Moves can't use the built-in {', '.join(builtin_names)}. "
+                              "Try rewriting this part of the move.")
+    if unavailable:
+        raise ValidationError(f"This move uses {', '.join(sorted(unavailable))} before giving it a value.")
+
+
+def check_move(implementation: Any) -> CompiledMoveCode:
+    """Get the compiled code for a move implementation, raising a ValidationError if it can't be played."""
+    source = get_move_source(implementation)
+    check_source(source)
+    try:
+        return compile_source(source)
+    except SyntaxError as e:
+        raise ValidationError(f"The code for this move is invalid (line {e.lineno}: {e.msg}).")
+
+
+def clear() -> None:
+    """Empty the in-process tier. The database tier is left alone."""
+    _sources.clear()
+    _compiled_moves.clear()
@@ -0,0 +1,101 @@
+"""
+Turns an uploaded piece image into its white and black versions.
+
+Each version is the upload drawn over the tile background of that color
+(static/tile-white.png and static/tile-black.png). The backgrounds are
+decoded once and kept resized to each size that has been asked for.
+
+Uploads are checked against PIECE_IMAGE_MAX_BYTES and PIECE_IMAGE_MAX_SIZE
+before anything is decoded, since an image that is small on the wire can
+still decode to gigabytes of pixels. Within those limits compositing takes
+a few tens of milliseconds, so it is simply done in the request.
+"""
+import base64
+import binascii
+import re
+from functools import lru_cache
+from io import BytesIO
+from typing import Dict, NamedTuple, Tuple
+
+from PIL import Image, UnidentifiedImageError
+from django.conf import settings
+from django.core.exceptions import ValidationError
+
+import api.image_store
+from core.settings import PIECE_IMAGE_MAX_BYTES, PIECE_IMAGE_MAX_SIZE
+
+COLORS = ('white', 'black')
+# Formats that can be saved with transparency
+FORMATS = {'png': 'PNG', 'webp': 'WEBP', 'gif': 'GIF'}
+# e.g. 'data:image/png;base64'
+_METADATA = re.compile(r'^data:image/([a-z]+);base64$')
+
+
+@lru_cache(maxsize=None)
+def _tile(color: str) -> Image.Image:
+    with Image.open(settings.BASE_DIR / 'static' / f'tile-{color}.png') as tile:
+        return tile.convert('RGBA')
+
+
+@lru_cache(maxsize=32)
+def tile_background(color: str, size: Tuple[int, int]) -> Image.Image:
+    """The tile of this color, resized. Shared between requests, so never modify it."""
+    return _tile(color).resize(size)
+
+
+def decode(image: str) -> Tuple[Image.Image, str]:
+    """The image in a data url such as 'data:image/png;base64,iVBOr...', and its format.
+
+    Raises ValidationError for anything that isn't an image within the limits.
+    """
+    metadata, _, base64_data = image.partition(',')
+    match = _METADATA.match(metadata)
+    if match is None or match.group(1) not in FORMATS:
+        raise ValidationError(f"Piece images must be one of {', '.join(FORMATS)}")
+    extension = match.group(1)
+    # Base64 takes 4 characters for every 3 bytes
+    if len(base64_data) > (PIECE_IMAGE_MAX_BYTES + 2) // 3 * 4:
+        raise ValidationError(f"Piece images can be at most {PIECE_IMAGE_MAX_BYTES // 1024} KB")
+    try:
+        data = base64.b64decode(base64_data, validate=True)
+        # Only reads the header, the pixels are decoded by load()
+        base_img = Image.open(BytesIO(data), formats=[FORMATS[extension]])
+    except (binascii.Error, UnidentifiedImageError, Image.DecompressionBombError):
+        raise ValidationError(f"This is not a valid {extension} image")
+    width, height = base_img.size
+    if width > PIECE_IMAGE_MAX_SIZE or height > PIECE_IMAGE_MAX_SIZE:
+        raise ValidationError(f"Piece images can be at most {PIECE_IMAGE_MAX_SIZE}x{PIECE_IMAGE_MAX_SIZE} pixels")
+    try:
+        base_img.load()
+    except (OSError, Image.DecompressionBombError):
+        raise ValidationError(f"This is not a valid {extension} image")
+    return base_img.convert('RGBA'), extension
+
+
+class PieceImage(NamedTuple):
+    """An image made by make_piece_images, which isn't in api.image_store until it's saved."""
+    # What it will be stored as
+    name: str
+    data: bytes
+    extension: str
+
+    def save(self) -> None:
+        api.image_store.save(self.data, self.extension)
+
+
+def _composite(base_img: Image.Image, color: str, extension: str) -> PieceImage:
+    comp = Image.alpha_composite(tile_background(color, base_img.size), base_img)
+    with BytesIO() as output:
+        comp.save(output, format=FORMATS[extension])
+        data = output.getvalue()
+    return PieceImage(api.image_store.name_of(data, extension), data, extension)
+
+
+def make_piece_images(image: str) -> Dict[str, PieceImage]:
+    """color -> the image of a piece of that color. See decode for image.
+
+    Nothing is written yet, so that a piece that turns out to be invalid
+    doesn't leave its images behind.
+    """
+    base_img, extension = decode(image)
+    return {color: _composite(base_img, color, extension) for color in COLORS}
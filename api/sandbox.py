@@ -0,0 +1,204 @@
+"""
+A pool of long lived worker processes that run move code.
+
+Running moves in the web server process means that a CPU heavy move holds
+the GIL while every websocket waits, and func_timeout has to start (and
+then asynchronously kill) a thread for every move. Instead, each worker
+is its own process that keeps the moves it has compiled. Workers enforce
+the time limit themselves with a SIGALRM timer, and if a worker still
+doesn't answer in time (e.g. it's stuck in a long running C call) it gets
+killed and replaced.
+
+Workers only import api.game_logic, so they never touch the database.
+"""
+import multiprocessing
+import pickle
+import queue
+import threading
+from multiprocessing.connection import Connection
+from typing import Dict, Mapping, Optional, Set, Tuple
+
+from func_timeout import FunctionTimedOut
+
+import api.game_logic
+from api.game_logic import ArrayBoard, Location, MoveContext
+from core.settings import COMPILED_MOVE_CACHE_SIZE, LEGAL_MOVES_TIMEOUT_SECONDS, MOVE_SANDBOX_WAIT_SECONDS, \
+    MOVE_SANDBOX_WORKERS, MOVE_TIMEOUT_SECONDS
+
+
+class WorkerCrashed(Exception):
+    """The worker running a move exited without answering."""
+
+
+def _worker_main(conn: Connection, cache_size: int):
+    codes = {}
+    def get_code(code_hash: str, source: str):
+        code = codes.get(code_hash)
+        if code is None:
+            if len(codes) >= cache_size:
+                codes.clear()
+            code = api.game_logic.compile_move(source, f"<move {code_hash[:12]}>")
+            codes[code_hash] = code
+        return code
+
+    while True:
+        try:
+            kind, args, max_runtime_seconds = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        try:
+            if kind == 'make_move':
+                (code_hash, source), board, from_loc, to_loc, counts = args
+                result = api.game_logic.make_move(get_code(code_hash, source), board, from_loc, to_loc,
+                                                  max_runtime_seconds, counts)
+            elif kind == 'legal_moves':
+                sources, board, team, max_total_seconds = args
+                move_codes = {move_pk: get_code(code_hash, source)
+                              for move_pk, (code_hash, source) in sources.items()}
+                # Each candidate gets max_runtime_seconds, so one slow move only rules itself out
+                result = api.game_logic.legal_moves(board, team, move_codes, max_runtime_seconds, max_total_seconds)
+            else:
+                raise ValueError(f"Unknown job {kind}")
+            reply = ('ok', result)
+        except (Exception, FunctionTimedOut) as e:
+            reply = ('error', e)
+        try:
+            conn.send(reply)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            conn.send(('error', RuntimeError(repr(reply[1]))))
+
+
+class _Worker:
+    def __init__(self, mp_context, cache_size: int):
+        self.conn, child_conn = mp_context.Pipe()
+        self.process = mp_context.Process(target=_worker_main, args=(child_conn, cache_size), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class SandboxPool:
+    """
+    Runs moves on a fixed number of worker processes, which are all
+    started up front. If every worker is busy, callers wait up to
+    wait_seconds for one to free up.
+    """
+    def __init__(self, size: int, max_runtime_seconds: float, grace_seconds: float = 1,
+                 cache_size: int = COMPILED_MOVE_CACHE_SIZE,
+                 max_legal_moves_seconds: float = LEGAL_MOVES_TIMEOUT_SECONDS,
+                 wait_seconds: float = MOVE_SANDBOX_WAIT_SECONDS):
+        assert size > 0
+        # Don't fork, the server process has threads running.
+        self._mp_context = multiprocessing.get_context('spawn')
+        self.max_runtime_seconds = max_runtime_seconds
+        self.grace_seconds = grace_seconds
+        self.max_legal_moves_seconds = max_legal_moves_seconds
+        self.wait_seconds = wait_seconds
+        self.cache_size = cache_size
+        self._idle: queue.Queue = queue.Queue()
+        for _ in range(size):
+            self._idle.put(_Worker(self._mp_context, cache_size))
+
+    def _run(self, kind: str, args: tuple, wait_seconds: float):
+        try:
+            worker = self._idle.get(timeout=self.wait_seconds)
+        except queue.Empty:
+            raise FunctionTimedOut(timedOutAfter=self.wait_seconds)
+        try:
+            worker.conn.send((kind, args, self.max_runtime_seconds))
+            if not worker.conn.poll(wait_seconds):
+                worker.kill()
+                worker = _Worker(self._mp_context, self.cache_size)
+                raise FunctionTimedOut(timedOutAfter=wait_seconds)
+            status, value = worker.conn.recv()
+        except (EOFError, OSError):
+            worker.kill()
+            worker = _Worker(self._mp_context, self.cache_size)
+            raise WorkerCrashed(f"The sandbox worker exited while running {kind}")
+        finally:
+            self._idle.put(worker)
+        if status == 'error':
+            raise value
+        return value
+
+    def make_move(self, code: Tuple[str, str], board: ArrayBoard,
+                  from_loc: Location, to_loc: Location, counts: Optional[Dict[str, int]] = None) -> MoveContext:
+        """Same as api.game_logic.make_move, but on a worker.
+
+        Args:
+            code (Tuple[str, str]): (hash, source) of the move's python code
+        Returns the MoveContext after the move. Its board and counts are copies,
+        the ones passed in are unchanged.
+        """
+        return self._run('make_move', (code, board, from_loc, to_loc, counts),
+                         self.max_runtime_seconds + self.grace_seconds)
+
+    def legal_moves(self, codes: Mapping[str, Tuple[str, str]], board: ArrayBoard,
+                    team: str) -> Set[Tuple[Location, Location]]:
+        """Same as api.game_logic.legal_moves, but every candidate is run in one job on a worker.
+
+        Each candidate is limited to max_runtime_seconds, and all of them together
+        to max_legal_moves_seconds, after which FunctionTimedOut is raised.
+
+        Args:
+            codes (Mapping[str, Tuple[str, str]]): move pk -> (hash, source) of the move's python code
+        """
+        candidates = sum(len(piece.piece_moves) for _, piece in board.occupied() if piece.team == team)
+        max_total_seconds = min(self.max_runtime_seconds * max(candidates, 1), self.max_legal_moves_seconds)
+        return self._run('legal_moves', (dict(codes), board, team, max_total_seconds),
+                         max_total_seconds + self.grace_seconds)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().kill()
+            except queue.Empty:
+                return
+
+
+_pool: Optional[SandboxPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> Optional[SandboxPool]:
+    """The shared pool, started on first use. None if MOVE_SANDBOX_WORKERS is 0."""
+    global _pool
+    if MOVE_SANDBOX_WORKERS <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = SandboxPool(MOVE_SANDBOX_WORKERS, MOVE_TIMEOUT_SECONDS)
+        return _pool
+
+
+def make_move(code: 'api.move_cache.CompiledMoveCode', board: ArrayBoard,
+              from_loc: Location, to_loc: Location, counts: Optional[Dict[str, int]] = None) -> MoveContext:
+    """Run a move on the sandbox pool, or in this process if the pool is disabled.
+
+    Use the board and counts of the returned MoveContext, the ones passed in
+    may or may not have been updated.
+    Raises FunctionTimedOut if the move takes longer than MOVE_TIMEOUT_SECONDS.
+    """
+    pool = get_pool()
+    if pool is None:
+        return api.game_logic.make_move(code.action, board, from_loc, to_loc, MOVE_TIMEOUT_SECONDS, counts)
+    return pool.make_move((code.code_hash, code.source), board, from_loc, to_loc, counts)
+
+
+def legal_moves(codes: Mapping[str, 'api.move_cache.CompiledMoveCode'], board: ArrayBoard,
+                team: str) -> Set[Tuple[Location, Location]]:
+    """Find the legal moves on the sandbox pool, or in this process if the pool is disabled.
+
+    Raises FunctionTimedOut if that takes longer than LEGAL_MOVES_TIMEOUT_SECONDS.
+    """
+    pool = get_pool()
+    if pool is None:
+        return api.game_logic.legal_moves(
+            board, team, {move_pk: code.action for move_pk, code in codes.items()}, MOVE_TIMEOUT_SECONDS,
+            LEGAL_MOVES_TIMEOUT_SECONDS)
+    return pool.legal_moves(
+        {move_pk: (code.code_hash, code.source) for move_pk, code in codes.items()}, board, team)
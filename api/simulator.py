@@ -0,0 +1,171 @@
+"""
+Headless self-play for board setups, to help balance them.
+
+Games are played by policies that pick one of the legal moves, using
+api.game_logic directly. The setup and its move implementations are read
+once up front, after that nothing touches the database or the websockets,
+so games can be spread across processes.
+"""
+import multiprocessing
+import random
+import time
+from typing import Any, Callable, Dict, List, Mapping, NamedTuple, Optional, Tuple
+
+import django
+
+import api.game_logic
+from api.game_logic import ArrayBoard, Location, MoveAction, MoveContext
+from core.settings import MOVE_TIMEOUT_SECONDS
+
+# api.models is imported inside functions, workers that are spawned
+# rather than forked import this module before django.setup() has run.
+
+Outcomes = Dict[Tuple[Location, Location], MoveContext]
+# A policy picks one of the legal moves, given what each of them would lead to,
+# the team that is moving, the piece counts before the move, and a random generator.
+Policy = Callable[[Outcomes, str, Dict[str, int], random.Random], Tuple[Location, Location]]
+
+
+def random_policy(outcomes: Outcomes, team: str, counts: Dict[str, int],
+                  rng: random.Random) -> Tuple[Location, Location]:
+    """Pick a legal move uniformly at random."""
+    return rng.choice(sorted(outcomes))
+
+
+def greedy_capture_policy(outcomes: Outcomes, team: str, counts: Dict[str, int],
+                          rng: random.Random) -> Tuple[Location, Location]:
+    """Take as many enemy royals (then pieces) as possible, ties are broken at random."""
+    other_total, other_royal = api.game_logic.COUNT_KEYS['black' if team == 'white' else 'white']
+    def captured(move):
+        after = outcomes[move].counts
+        return (counts[other_royal] - after[other_royal], counts[other_total] - after[other_total])
+    moves = sorted(outcomes)
+    best = max(captured(move) for move in moves)
+    return rng.choice([move for move in moves if captured(move) == best])
+
+
+POLICIES: Dict[str, Policy] = {
+    'random': random_policy,
+    'greedy': greedy_capture_policy,
+}
+
+
+class GameRecord(NamedTuple):
+    result: str
+    plies: int
+    # Why the game ended: 'wincon', 'no_moves' or 'max_plies'
+    reason: str
+
+
+def play_game(game_state: Dict[str, Any], packed_board: bytes, move_codes: Mapping[str, MoveAction],
+              white_policy: Policy, black_policy: Policy, rng: random.Random, max_plies: int,
+              max_runtime_seconds: Optional[float] = MOVE_TIMEOUT_SECONDS) -> GameRecord:
+    """Play one game from game_state and its packed board (see Game.initial_game_state and ArrayBoard.pack).
+
+    If the side to move has no legal moves, or max_plies is reached, the game is a draw.
+    """
+    from api.models import Game, get_game_result
+    # The board is always kept from the point of view of the side to move
+    board = ArrayBoard.unpack(packed_board,
+                              api.game_logic.pieces_from_state(game_state['pieces'], game_state['piece_types']))
+    counts = api.game_logic.count_pieces(piece for _, piece in board.occupied())
+    white_to_move = True
+    for ply in range(max_plies):
+        team = 'white' if white_to_move else 'black'
+        outcomes = api.game_logic.move_outcomes(board, team, move_codes, max_runtime_seconds, counts)
+        if not outcomes:
+            return GameRecord(Game.Result.DRAW, ply, 'no_moves')
+        policy = white_policy if white_to_move else black_policy
+        played = outcomes[policy(outcomes, team, counts, rng)]
+        result = get_game_result(counts, played.counts,
+                                 game_state['wincon_white'], game_state['wincon_black'])
+        if result != Game.Result.IN_PROGRESS:
+            return GameRecord(result, ply + 1, 'wincon')
+        board = played.board.flipped()
+        counts = played.counts
+        white_to_move = not white_to_move
+    return GameRecord(Game.Result.DRAW, max_plies, 'max_plies')
+
+
+# State of each worker process, set up once by _init_worker
+_worker: Dict[str, Any] = {}
+
+
+def _init_worker(*args):
+    django.setup()
+    _load_worker(*args)
+
+
+def _load_worker(game_state, packed_board, move_sources, white_policy, black_policy, seed, max_plies):
+    _worker.update(
+        game_state=game_state,
+        packed_board=packed_board,
+        move_codes={move_pk: api.game_logic.compile_move(source, f"<move {move_pk}>")
+                    for move_pk, source in move_sources.items()},
+        white_policy=white_policy,
+        black_policy=black_policy,
+        seed=seed,
+        max_plies=max_plies,
+    )
+
+
+def _play_game_number(game_number: int) -> GameRecord:
+    # Each game has its own seed, so results don't depend on how games are split between processes
+    rng = random.Random(f"{_worker['seed']}:{game_number}")
+    return play_game(_worker['game_state'], _worker['packed_board'], _worker['move_codes'],
+                     _worker['white_policy'], _worker['black_policy'], rng, _worker['max_plies'])
+
+
+def summarize(records: List[GameRecord], elapsed_seconds: float) -> Dict[str, Any]:
+    from api.models import Game
+    games = len(records)
+    total_plies = sum(record.plies for record in records)
+    def rate(*results):
+        return sum(record.result in results for record in records) / games if games else 0
+    return {
+        'games': games,
+        'white_win_rate': rate(Game.Result.WHITE_WIN),
+        'black_win_rate': rate(Game.Result.BLACK_WIN),
+        'draw_rate': rate(Game.Result.DRAW),
+        'mean_game_length': total_plies / games if games else 0,
+        'moves_per_second': total_plies / elapsed_seconds if elapsed_seconds > 0 else 0,
+        'elapsed_seconds': elapsed_seconds,
+        'end_reasons': {reason: sum(record.reason == reason for record in records)
+                        for reason in sorted({record.reason for record in records})},
+    }
+
+
+def simulate(game_state: Dict[str, Any], packed_board: bytes, move_sources: Mapping[str, str], games: int,
+             white_policy: Policy = random_policy, black_policy: Policy = random_policy,
+             processes: Optional[int] = None, seed: int = 0, max_plies: int = 200) -> Dict[str, Any]:
+    """Play a batch of games and summarize the results.
+
+    Args:
+        game_state: See Game.initial_game_state
+        packed_board: The starting position, see ArrayBoard.pack
+        move_sources: move pk -> python source of that move
+        games: Number of games to play
+        white_policy, black_policy: See Policy. Must be module level functions so they can be sent to workers.
+        processes: Number of worker processes, defaults to the number of CPUs. 1 plays in this process.
+        seed: The same seed gives the same games, no matter how many processes are used.
+        max_plies: Games that last longer than this are draws.
+    """
+    init_args = (game_state, packed_board, dict(move_sources), white_policy, black_policy, seed, max_plies)
+    start = time.perf_counter()
+    if processes == 1:
+        _load_worker(*init_args)
+        records = [_play_game_number(i) for i in range(games)]
+    else:
+        with multiprocessing.Pool(processes, initializer=_init_worker, initargs=init_args) as pool:
+            records = pool.map(_play_game_number, range(games), chunksize=max(1, games // 64))
+    return summarize(records, time.perf_counter() - start)
+
+
+def simulate_setup(board_setup: 'api.models.BoardSetup', games: int, **kwargs) -> Dict[str, Any]:
+    """simulate, starting from a board setup in the database. See simulate for the arguments."""
+    import api.move_cache
+    from api.models import Game
+    game_state, board = Game.initial_game_state(board_setup)
+    move_sources = {move_pk: api.move_cache.get_game_move_code(move).source
+                    for move_pk, move in game_state['moves'].items()}
+    return simulate(game_state, board.pack(), move_sources, games, **kwargs)
@@ -1,27 +1,49 @@
 #python3 manage.py test
 #or f5 if you set it up your .vscode/launch.json right
-# Make sure you start redis and the convert_code_server.ts first. (See README.md)
+# Make sure you start redis first. (See README.md)
+import base64
 import tempfile
 import itertools
 import json
 import shutil
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from pathlib import Path
 from typing import Dict
+from unittest import mock
+from urllib.parse import urlencode
 
 from asgiref.sync import async_to_sync
 from channels.testing import WebsocketCommunicator
 from channels.routing import URLRouter
-from django.test import TestCase, Client, override_settings
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError
+from django.test import TestCase, TransactionTestCase, Client, override_settings
+from func_timeout import FunctionTimedOut
+from PIL import Image
 from django.test import Client
 
+import api.blockly_compiler
+import api.piece_images
+import api.sandbox
+import api.move_cache
+from api.converter_client import CircuitBreaker, ConversionFailed, ConverterClient, ConverterUnavailable
+from api.benchmarks import BENCHMARKS, compare, run_benchmarks
+from api.sandbox import SandboxPool
+from api.simulator import greedy_capture_policy, simulate_setup
 from api.consumers import LobbyConsumer, GameConsumer
-from api.game_logic import make_move, Location, BoardTile, PieceInstance, MoveContext, InvalidMoveError
-from api.models import User, Move, Piece, PieceMove, BoardSetup,  Game, PieceLocation
+from api.game_logic import make_move, Location, BoardTile, PieceInstance, MoveContext, InvalidMoveError, \
+    ArrayBoard, PieceRecord, SQUARES, compute_path, compile_move
+from api.models import User, Move, Piece, PieceMove, PieceSerializer, BoardSetup,  Game, GameRequest, PieceLocation, CompiledMove, \
+    count_surviving_pieces, get_game_result
 from api.routing import websocket_urlpatterns
 # Create your tests here.
 
 image_bytes = 'data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAANAAAADQCAYAAAB2pO90AAAAAXNSR0IArs4c6QAACn1JREFUeF7tnTGSFTcURS9lB87AqQMDqRNgBUCVqxw4AK8AvAJgBcAGDKwAyJwZclcBKwASp4ZyOccrwHVr5ttN0//PTD/pq/vpdBUBMyPp67x3RmpJ3XNKXBCAwGwCp2aXpCAEICAEIgkgECCAQAF4FIUAApEDEAgQQKAAPIpCAIHIAQgECCBQAB5FIYBA5AAEAgQQKACPohBAIHIAAgECCBSAR1EIIBA5AIEAAQQKwKMoBBCIHIBAgAACBeBRFAIIRA5AIEAAgQLwKAoBBCIHIBAggEABeBSFAAKRAxAIEECgADyKQgCByAEIBAggUAAeRSGAQOQABAIEECgAj6IQQCByAAIBAggUgEdRCCAQOQCBAAEECsCjKAQQiByAQIAAAgXgURQCCEQOQCBAAIEC8CgKAQQiByAQIIBAAXgUhQACkQMQCBBAoAA8ikIAgfrIgXOSrkl6JelNH13eTy8RaD+cW7ZyUdLrwQc4L+ldyw+UqW0EyhTN6b7ck3R38K07kh7m7/Z+eohA++HcspWxQPcl+WtcBQggUAGIC68CgSoGCIEqwl1I1QhUMRAIVBHuQqpGoIqBQKCKcBdSNQJVDAQCVYS7kKoRqGIgehDopqSPkp5L+lCR5VKrRqCKkcku0LPDHXgjfCrJMvV2IVDFiGcXyCPO6QG/7P2dShUEQqDZBHxk5eyg9KUOz4Ih0Oz0Obpg9t/ILyVdHmC4Kslf6+lCoIrRzi6Qz3zdGvDr8RgLAiHQbALj5Hkk6fbs2tZZ0Asnjwcf3auR19fZleV96uwj0BVJLwbY/TyMv9bTBYOK0e5NID9M5oWEni4Eqhjt7AIZnTdRh1cPfR72F4EQKESgd4H4JRJKn92Fe/htPN5M7fGRZn6JVJKoB4HYC2IaW0kfCYGqoV1UxV48uTD4RD1uKFcJCAJVwbq4ShmFK4UEgSqBXVi1CFQpID0IxFEW6YmkG4Mc4tVWhYRCoEIgF14Nv0QqBagHgXz27cGAX4/n4RAIgWYTYCf+4EWKw7eT9ngqfXYC7SrYwwg0FojzcAcvme/tUC0CBQj0vhPPKBxInt5HIM6CHYw2vT/WUUWhHqZwBtf7Tvz4T5z0OI1FoAABNhI5DxdIn+1FexmBxu9G6HEjcXwf+HWnL5osKlIvArGMe/A2ot7fUFRUHleGQMWRLrbC8XEe9oIKhAqBCkBcSRXjExm8nadA4BCoAMSVVDFeyvZbW/10LleAAAIF4K2waO8bysVDhkDFkS66QgQqHB4EKgx04dUhUOEAIVBhoAuvbvjXKt5K8gkFrgCBXgTiicyDJPE7sb0ndubwHeH+A2RcAQK9CDR+N1yPfycokCYU3UagF4GGU5f3ks6REhAoQaAXgbwH4mmcpy7+cx9MXUpkD3V0c5SHUEOgCoFeRqAq8KgUAghEDkAgQACBAvAoCgEEIgcgECCAQAF4FIUAApEDEAgQQKAAPIpCAIHIAQgECCBQAB5FIYBA5AAEAgQQKACPohBAIHIAAgECCBSAR1EIIBA5AIEAAQQKwKMoBBCIHIBAgAACBeBRFAIIRA5AIEAAgQLwKAoBBCIHIBAggEABeBSFAAKRAxAIEECgADyKQgCByAEIBAggUAAeRSGAQOQABAIEECgAj6IQQCByAAIBAggUgEdRCCAQOQCBAAEECsCjKAQQiByAQIAAAgXgURQCCEQOQCBAAIEC8CgKAQQiByAQIIBAAXgUhQACkQMQCBBAoAC8BEXPSbom6ZWkNwn6s/curEmg7yR9L+l3SX/snVS+Bi9Kej3o1nlJ7/J1s26P1iLQj5J+lfSFpI+S/P+XddGkr/2epLuDXt6R9DB9rwt3cC0C/S3pm0Hf/5L0bWEWvVVnWW4NOn1fkqXiOgGBtQr0j6TrjEIniPSnP2p2v41KI9AMnGsRaDOF+1LSV4N+XkWiE0fd9z4vJJ0ZlbzEQsKJWWotArlnXkT4RdIPg25+kGSJWEE6XuwtjRcOvPo2vH6W9OR4VfBTQwJrEsif24H/cxRCy2OJLBPXbgIeea4gT7k0WZtA7vltSQ9GCLwiZ4m4thOY4vZU0k2gzSewRoHcW083boy6/ehQrvk08pacuu/x5ul4NMpLoFLP1iqQcXjqdoHpyJGZ4fseT90s0ebyKqanw0x7j8S3+wfWLJATwzvnp5Foa5Cn5PEP/yTpWTB3KC6tahVuKmD+rer7HySaTmfv9XjPZ3hx31NQ/TWPQBsMvgl+PMGk96VZMxkvEHDfU1AeV5VBIPcDiT5NjCl53h4uGnDfU1CiLAIh0f9JMT4k6u8gT0FphlVlEmiXRF729pQu+zU1EnvFzfeKPKpQIfrZBDKibQsL2SXaJo/3ejjqVEGeTPdAYzy7JPJzL9nuA5CnkiBHVZtxBNr0eZtE2c7OIc9RWV7x+5kF2kznPHUbn1jIItG21UceTagoTeZFhCls3o33ZutYIt9Ue0d+rfcHLN3vSZJdzWQfgTZ93yaR74Us0drer4A8C5An8yLCtpHI7wEYn+L2z3rvxI80r+FCngVFqZcRaIh86lEIf9+jkPeKlrxfgjwLkqe3EWiIflsiekrn0cjPFi3tQp6lRSTRWbg5aL3B6CP945PcSxyNkGdOhPdQpscp3BCrFxcs0eUJ1h6N/Bi0j/+3vPzyw6n3tfV+2rxlTP5ru3eBNiAsipN022jk0wv7Xu623D5VPX6ex58ZeRahT57HGUrg9CPOXmCYGo1cv7+3r2NAlsYvThm/fgp5SkS6YB2MQJ/D3DUaeVrnpXAvMtQ4T2dhLM7UqONT1RwMLZj8JapCoGmKTmSL4j/9MXVZHt87+Z+f8ozKZDG8P2Vxxm8Mdfs8z1Mi2yvUgUC7oTqxPXU7ewR73x9ZuOcnkMlTRR949Yg3NVXbNOkNXtcdlbRC+lAlAh0vB3ZN68Y1WCb/G2/IWhaPLv43fMXUtk/gkc3L10ve2D0evcQ/hUDHD64T3wltmY4akY5f6+c/+f5wRZB3VUco7qksAs0D7RHEMnmKNz7lPa/Gg/0mS7O2g61z+5uiHALFw+j7F9/8W6iTyOSFgc10z+JwjxOPxd5rQKCyyDf3N5ZqvDBgWTaSMMqU5d6sNgRqhp6GMxBAoAxRpA/NCCBQM/Q0nIEAAmWIIn1oRgCBmqGn4QwEEChDFOlDMwII1Aw9DWcggEAZokgfmhFAoGboaTgDAQTKEEX60IwAAjVDT8MZCCBQhijSh2YEEKgZehrOQACBMkSRPjQjgEDN0NNwBgIIlCGK9KEZAQRqhp6GMxBAoAxRpA/NCCBQM/Q0nIEAAmWIIn1oRgCBmqGn4QwEEChDFOlDMwII1Aw9DWcggEAZokgfmhFAoGboaTgDAQTKEEX60IwAAjVDT8MZCCBQhijSh2YEEKgZehrOQACBMkSRPjQjgEDN0NNwBgIIlCGK9KEZAQRqhp6GMxBAoAxRpA/NCCBQM/Q0nIEAAmWIIn1oRgCBmqGn4QwEEChDFOlDMwII1Aw9DWcggEAZokgfmhFAoGboaTgDAQTKEEX60IwAAjVDT8MZCCBQhijSh2YEEKgZehrOQACBMkSRPjQj8C89Jk/gQeC1iAAAAABJRU5ErkJggg=='
 move_implementation = {"blocks": {"languageVersion": 0, "blocks": [{"type": "chess_action", "id": "`8DRg_aD7uEOo{L?xIXd", "x": 137, "y": 52, "inputs": {"ACTION": {"block": {"type": "teleport", "id": "S5kX9!cc`[Weq+@;23GT", "inputs": {"FROM_UNIT": {"block": {"type": "acting_unit", "id": "8IZ.zuq_o3fB_EYrd|r5"}}, "TO_TILE": {"block": {"type": "targeted_tile", "id": "^!!!^cr){Mn?=xSH#6Ao"}}}}}}}]}}
 MOCK_MEDIA_ROOT = tempfile.mkdtemp()
+move_source = "def action():\r\n  ctx.tele_to(ctx.acting_piece, ctx.targeted_tile)\r\n"
 TIMEOUT_SEC = 1
 
 class AuthWebsocketCommunicator(WebsocketCommunicator):
@@ -30,8 +52,7 @@ class AuthWebsocketCommunicator(WebsocketCommunicator):
         if user is not None:
             self.scope['user'] = user
 
-@override_settings(MEDIA_ROOT=MOCK_MEDIA_ROOT)
-class TestCaseWithMockData(TestCase):
+class MockDataMixin:
     @classmethod
     def tearDownClass(cls):
         shutil.rmtree(MOCK_MEDIA_ROOT, ignore_errors=True)  # delete the temp dir
@@ -82,6 +103,15 @@ class TestCaseWithMockData(TestCase):
         self.sample_board = BoardSetup.create_board(self.wolf_user, "sample", piece_locations, BoardSetup.Category.OFFICIAL, wincon_white=BoardSetup.WinCon.KILL_ANY_ROYAL, wincon_black=BoardSetup.WinCon.KILL_ANY_ROYAL)
         self.sample_game = Game.create_game(self.wolf_user, self.dan_user, self.sample_board)
 
+@override_settings(MEDIA_ROOT=MOCK_MEDIA_ROOT)
+class TestCaseWithMockData(MockDataMixin, TestCase):
+    pass
+
+# For tests whose database work outlives the test's transaction, like a consumer disconnecting
+@override_settings(MEDIA_ROOT=MOCK_MEDIA_ROOT)
+class TransactionTestCaseWithMockData(MockDataMixin, TransactionTestCase):
+    pass
+
 class MovesTest(TestCaseWithMockData):
     def test_can_get_official_moves(self):
         client = Client()
@@ -101,6 +131,16 @@ class MovesTest(TestCaseWithMockData):
         self.assertEqual(len(moves), 2)
         self.assertEqual(response.status_code, 200)
 
+    def test_save_move_with_missing_act_block(self):
+        client = Client()
+        client.force_login(self.dan_user)
+        new_move = {'pk': 'DNE', 'color': [1, 2, 3], 'overview': 'nothing', 'description': 'does nothing', 'symbol': '',
+                    'implementation': {"blocks": {"languageVersion": 0, "blocks": []}}}
+        response = client.post('/api/moves?' + urlencode({'newMove': json.dumps(new_move)}))
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json()['message'], "A move needs an Act block.")
+        assert not Move.objects.filter(overview='nothing').exists()
+
 class PiecesTest(TestCaseWithMockData):
     def test_get_piece(self):
         client = Client()
@@ -144,6 +184,244 @@ class PiecesTest(TestCaseWithMockData):
         assert len(pieceMove) == 2
         assert pieceMove[0].move == self.dan_move
 
+    def test_create_invalid_piece(self):
+        pieces = Piece.objects.count()
+        for moves in [[{'relative_row': 8, 'relative_col': 0, 'move': self.dan_move.pk}],
+                      [{'relative_row': 1, 'relative_col': 0, 'move': self.dan_move.pk + 1000}],
+                      [{'relative_row': 1, 'relative_col': 0, 'move': self.dan_move.pk},
+                       {'relative_row': 1, 'relative_col': 0, 'move': self.move_official.pk}]]:
+            with self.assertRaises(ValidationError):
+                Piece.create_piece(image_bytes, self.dan_user, 'rook', moves, Piece.Category.CUSTOM)
+        assert Piece.objects.count() == pieces
+        # Nor can a move be added at an offset the piece already has
+        duplicate = PieceMove(piece=self.piece_official, move=self.dan_move, relative_row=1, relative_col=0)
+        with self.assertRaises(ValidationError):
+            duplicate.full_clean()
+        PieceMove(piece=self.piece_official, move=self.dan_move, relative_row=2, relative_col=0).full_clean()
+
+    def test_piece_with_duplicate_offsets(self):
+        # Pieces saved before duplicates were rejected play the first move at the offset, as they used to
+        PieceMove.objects.create(piece=self.piece_official, move=self.dan_move, relative_row=1, relative_col=0)
+        game = Game.create_game(self.wolf_user, self.dan_user, self.sample_board)
+        piece_type = game.game_state['piece_types'][str(self.piece_official.pk)]
+        assert piece_type['piece_moves'] == {'1,0': str(self.move_official.pk)}
+
+class CatalogQueriesTest(TestCaseWithMockData):
+    """The catalog endpoints use the same number of queries no matter how big the catalog is."""
+    def setUp(self):
+        super().setUp()
+        self.client = Client()
+        self.client.force_login(self.dan_user)
+
+    def add_to_catalog(self, count: int):
+        for i in range(Move.objects.count(), Move.objects.count() + count):
+            for user, cat in [(self.wolf_user, 'official'), (self.dan_user, 'custom')]:
+                move = Move.objects.create(author=user, cat=cat, color='[1,2,3]', implementation=move_implementation,
+                                           overview=f'move {i}', description='another move', symbol='')
+                piece = Piece.create_piece(image_bytes, user, f"piece {i}", [
+                    {'relative_row': 1, 'relative_col': 0, 'move': move.pk},
+                    {'relative_row': 0, 'relative_col': 1, 'move': self.move_official.pk},
+                ], cat)
+                board = BoardSetup.create_board(user, f"board{cat}{i}", [
+                    {'row': 0, 'col': 0, 'piece': piece.pk, 'team': 'white', 'is_royal': True},
+                    {'row': 7, 'col': 0, 'piece': self.piece_official.pk, 'team': 'black', 'is_royal': True},
+                ], cat, wincon_white=BoardSetup.WinCon.KILL_ALL, wincon_black=BoardSetup.WinCon.KILL_ALL)
+                GameRequest.objects.create(requesting_user=user, board_setup=board)
+
+    def assert_queries(self, queries: int, path: str, params=None, cached_queries=None):
+        """Queries after the catalog changed, and then again when the official catalog is cached."""
+        for catalog_size in [1, 3]:
+            self.add_to_catalog(catalog_size)
+            with self.assertNumQueries(queries):
+                response = self.client.get(path, params or {})
+            self.assertEqual(response.status_code, 200)
+            with self.assertNumQueries(queries if cached_queries is None else cached_queries):
+                cached_response = self.client.get(path, params or {})
+            self.assertEqual(cached_response.json(), response.json())
+        return response.json()
+
+    def test_moves(self):
+        data = self.assert_queries(4, '/api/moves', cached_queries=3)
+        assert len(data) == 2 + 2 * 4
+        assert [int(move['pk']) for move in data] == sorted(int(move['pk']) for move in data)
+
+    def test_pieces(self):
+        data = self.assert_queries(8, '/api/pieces', cached_queries=5)
+        assert len(data['pieces']) == 2 + 2 * 4
+        assert len(data['move_map']) == 2 + 2 * 4
+
+    def test_board_setups(self):
+        data = self.assert_queries(10, '/api/boardSetups', cached_queries=6)
+        assert len(data['boards']) == 1 + 2 * 4
+        assert len(data['pieces']) == 2 + 2 * 4
+
+    def test_board_setups_by_pk(self):
+        pks = [board.pk for board in BoardSetup.objects.order_by('-pk')[:3]]
+        data = self.assert_queries(6, '/api/boardSetups', {'pk_list': ','.join(map(str, pks))})
+        assert [int(board['pk']) for board in data['boards']] == pks
+        response = self.client.get('/api/boardSetups', {'pk_list': '-1'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_game_requests(self):
+        data = self.assert_queries(6, '/api/gameRequests')
+        assert len(data['game_requests']) == 2 * 4
+        assert len(data['pieces']) == 1 + 2 * 4
+
+class CatalogCacheTest(TestCaseWithMockData):
+    def test_not_modified(self):
+        client = Client()
+        client.force_login(self.dan_user)
+        for path in ['/api/moves', '/api/pieces', '/api/boardSetups']:
+            response = client.get(path)
+            self.assertEqual(response.status_code, 200)
+            with self.assertNumQueries(2):  # session and user
+                cached = client.get(path, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(cached.status_code, 304)
+            self.assertEqual(cached['ETag'], response['ETag'])
+        # Other users see other content
+        other_client = Client()
+        other_client.force_login(self.wolf_user)
+        response = other_client.get('/api/moves', HTTP_IF_NONE_MATCH=cached['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_changes_are_seen(self):
+        client = Client()
+        client.force_login(self.dan_user)
+        response = client.get('/api/moves')
+        moves = {move['pk']: move for move in response.json()}
+        assert set(moves) == {str(self.move_official.pk), str(self.dan_move.pk)}
+        self.move_official.description = 'its the new move'
+        self.move_official.save()
+        changed = client.get('/api/moves', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        assert changed['ETag'] != response['ETag']
+        moves = {move['pk']: move for move in changed.json()}
+        assert moves[str(self.move_official.pk)]['description'] == 'its the new move'
+        # Users don't see each other's custom content
+        moves = Client().get('/api/moves').json()
+        assert [move['pk'] for move in moves] == [str(self.move_official.pk)]
+        pieces = Client().get('/api/pieces').json()
+        assert [piece['pk'] for piece in pieces['pieces']] == [str(self.piece_official.pk)]
+        boards = Client().get('/api/boardSetups').json()['boards']
+        assert [board['pk'] for board in boards] == [str(self.sample_board.pk)]
+        self.sample_game.delete()
+        self.sample_board.delete()
+        assert Client().get('/api/boardSetups').json()['boards'] == []
+
+class ListingTest(TestCaseWithMockData):
+    def setUp(self):
+        super().setUp()
+        self.client = Client()
+        self.client.force_login(self.dan_user)
+        for i in range(5):
+            Move.objects.create(author=self.wolf_user, cat=Move.Category.OFFICIAL, color='[1,2,3]',
+                                implementation=move_implementation, description=f'move {i}', symbol='')
+
+    def get_pages(self, path, key, params):
+        pages = []
+        cursor = None
+        while True:
+            response = self.client.get(path, {**params, **({'cursor': cursor} if cursor else {})})
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            pages.append(data[key])
+            cursor = data['next_cursor']
+            if cursor is None:
+                return pages
+
+    def test_pages(self):
+        everything = self.client.get('/api/moves').json()
+        pages = self.get_pages('/api/moves', 'moves', {'limit': 3})
+        assert [len(page) for page in pages] == [3, 3, 1]
+        assert [move for page in pages for move in page] == everything
+        pages = self.get_pages('/api/boardSetups', 'boards', {'limit': 1})
+        assert [board['pk'] for page in pages for board in page] == [str(self.sample_board.pk)]
+        pages = self.get_pages('/api/pieces', 'pieces', {'limit': 1})
+        assert [piece['pk'] for page in pages for piece in page] == \
+            [str(self.piece_official.pk), str(self.piece_official_2.pk)]
+        Game.create_game(self.dan_user, self.wolf_user, self.sample_board)
+        pages = self.get_pages('/api/games', 'games', {'limit': 1, 'exclude': 'game_state'})
+        assert len(pages) == 2
+        assert all('game_state' not in game and game['setup']['name'] == 'sample' for page in pages for game in page)
+
+    def test_fields(self):
+        moves = self.client.get('/api/moves', {'fields': 'pk,overview,author'}).json()
+        assert len(moves) == 7
+        assert all(set(move) == {'pk', 'overview', 'author'} for move in moves)
+        moves = self.client.get('/api/moves', {'exclude': 'implementation,color'}).json()
+        assert all(set(move) == {'pk', 'cat', 'overview', 'description', 'symbol', 'author'} for move in moves)
+        data = self.client.get('/api/pieces', {'fields': 'pk,name,author,cat'}).json()
+        assert [piece['name'] for piece in data['pieces']] == ['king', 'mover']
+        assert data['move_map'] == {}
+        data = self.client.get('/api/pieces', {'exclude': 'image_white,image_black'}).json()
+        assert len(data['move_map']) == 2
+        data = self.client.get('/api/boardSetups', {'fields': 'pk,name'}).json()
+        assert data == {'boards': [{'pk': str(self.sample_board.pk), 'name': 'sample'}], 'pieces': {}}
+
+    def test_invalid_params(self):
+        for params in [{'fields': 'pk,password'}, {'exclude': 'nope'}, {'limit': '0'},
+                       {'limit': '100000'}, {'cursor': 'abc'}]:
+            response = self.client.get('/api/moves', params)
+            self.assertEqual(response.status_code, 400)
+
+class PieceImageTest(TestCaseWithMockData):
+    def test_images_are_stored_once(self):
+        data = PieceSerializer(self.piece_official).data
+        assert data['image_white'].startswith('/media/pieces/')
+        assert data['image_white'] != data['image_black']
+        # Both sample pieces use the same image
+        assert self.piece_official_2.image_white == self.piece_official.image_white
+        stored = sorted(path.name for path in (Path(MOCK_MEDIA_ROOT) / 'pieces').iterdir())
+        assert stored == sorted([self.piece_official.image_white, self.piece_official.image_black])
+
+    def test_serve_image(self):
+        client = Client()
+        url = PieceSerializer(self.piece_official).data['image_white']
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        assert 'immutable' in response['Cache-Control']
+        assert b''.join(response.streaming_content).startswith(b'\x89PNG')
+        response = client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(client.get('/media/pieces/../../db.sqlite').status_code, 404)
+        self.assertEqual(client.get('/media/pieces/' + '0' * 64 + '.png').status_code, 404)
+
+    def test_tile_backgrounds_are_cached(self):
+        tile = api.piece_images.tile_background('white', (208, 208))
+        assert api.piece_images.tile_background('white', (208, 208)) is tile
+        assert tile.size == (208, 208)
+
+    def test_invalid_piece_stores_no_images(self):
+        with BytesIO() as output:
+            Image.new('RGBA', (16, 16), (255, 0, 0, 255)).save(output, format='PNG')
+            image = f"data:image/png;base64,{base64.b64encode(output.getvalue()).decode()}"
+        stored = set((Path(MOCK_MEDIA_ROOT) / 'pieces').iterdir())
+        for moves in [[{'relative_row': 8, 'relative_col': 0, 'move': self.dan_move.pk}],
+                      [{'relative_row': 1, 'relative_col': 0, 'move': self.dan_move.pk + 1000}]]:
+            with self.assertRaises(ValidationError):
+                Piece.create_piece(image, self.dan_user, 'rook', moves, Piece.Category.CUSTOM)
+        # Or the insert fails after everything was checked
+        moves = [{'relative_row': 1, 'relative_col': 0, 'move': self.dan_move.pk}]
+        with mock.patch.object(PieceMove.objects, 'bulk_create', side_effect=IntegrityError('taken')):
+            with self.assertRaises(ValidationError):
+                Piece.create_piece(image, self.dan_user, 'rook', moves, Piece.Category.CUSTOM)
+        assert set((Path(MOCK_MEDIA_ROOT) / 'pieces').iterdir()) == stored
+        piece = Piece.create_piece(image, self.dan_user, 'rook', [], Piece.Category.CUSTOM)
+        assert (Path(MOCK_MEDIA_ROOT) / 'pieces' / piece.image_white).exists()
+
+    def test_image_limits(self):
+        def data_url(size, format='PNG'):
+            with BytesIO() as output:
+                Image.new('RGBA' if format == 'PNG' else 'RGB', size).save(output, format=format)
+                return f"data:image/{format.lower()};base64,{base64.b64encode(output.getvalue()).decode()}"
+        assert api.piece_images.decode(data_url((64, 32)))[0].size == (64, 32)
+        too_many_bytes = 'data:image/png;base64,' + 'A' * 1024 * 1024
+        for image in [data_url((4096, 16)), data_url((64, 64), 'JPEG'), too_many_bytes,
+                      'data:image/png;base64,bm90IGFuIGltYWdl', 'not a data url']:
+            with self.assertRaises(ValidationError):
+                Piece.create_piece(image, self.dan_user, 'rook', [], Piece.Category.CUSTOM)
+
 class BoardSetupTest(TestCaseWithMockData):
     def test_get_board(self):
         client = Client()
@@ -196,6 +474,33 @@ class BoardSetupTest(TestCaseWithMockData):
         assert board.wincon_black == BoardSetup.WinCon.KILL_ALL
         assert board.wincon_white == BoardSetup.WinCon.KILL_ANY_ROYAL
 
+    def board_of(self, size: int):
+        return [{'row': i // 8, 'col': i % 8, 'piece': self.piece_official.pk,
+                 'team': 'white' if i % 2 else 'black', 'is_royal': True} for i in range(size)]
+
+    def test_create_board_queries(self):
+        for size in [2, 32]:
+            # Fetch the pieces, check the author exists and the name is unique, then save in a transaction
+            with self.assertNumQueries(7):
+                board = BoardSetup.create_board(self.dan_user, f"board {size}", self.board_of(size),
+                                                BoardSetup.Category.CUSTOM, BoardSetup.WinCon.KILL_ALL,
+                                                BoardSetup.WinCon.KILL_ALL)
+            assert board.piece_locations.count() == size
+
+    def test_create_invalid_board(self):
+        boards = BoardSetup.objects.count()
+        locations = PieceLocation.objects.count()
+        out_of_bounds = self.board_of(4)
+        out_of_bounds[3]['row'] = 8
+        missing_piece = self.board_of(4)
+        missing_piece[3]['piece'] = self.piece_official.pk + 1000
+        for name, piece_locations in [('sample', self.board_of(4)), ('board', out_of_bounds), ('board', missing_piece)]:
+            with self.assertRaises(ValidationError):
+                BoardSetup.create_board(self.dan_user, name, piece_locations, BoardSetup.Category.CUSTOM,
+                                        BoardSetup.WinCon.KILL_ALL, BoardSetup.WinCon.KILL_ALL)
+        assert BoardSetup.objects.count() == boards
+        assert PieceLocation.objects.count() == locations
+
 class LobbyConsumerTest(TestCaseWithMockData):
     async def test_lobby_consumer(self):
         communicator_wolf = AuthWebsocketCommunicator("/ws/lobby/", user=self.wolf_user)
@@ -258,7 +563,7 @@ class LobbyConsumerTest(TestCaseWithMockData):
         await communicator_wolf.disconnect()
         await communicator_dan.disconnect()
 
-class GameConsumerTest(TestCaseWithMockData):
+class GameConsumerTest(TransactionTestCaseWithMockData):
     async def test_move_forwards(self):
         game_pk = self.sample_game.pk
         communicator_wolf = AuthWebsocketCommunicator(f"/ws/game/{game_pk}/", user=self.wolf_user)
@@ -266,53 +571,99 @@ class GameConsumerTest(TestCaseWithMockData):
         connected, _ = await communicator_dan.connect(TIMEOUT_SEC)
         assert connected
         connected, _ = await communicator_wolf.connect(TIMEOUT_SEC)
-        
+        # The full game is sent on join
+        for communicator in [communicator_dan, communicator_wolf]:
+            response_json = json.loads(await communicator.receive_from(TIMEOUT_SEC))
+            assert response_json['event_type'] == 'game_state'
+            assert response_json['game_data']['ply'] == 0
+            game_state = response_json['game_data']['game_state']
+            # Only the occupied squares
+            assert set(game_state['board']) == {'0,0', '3,0'}
+            assert set(game_state['piece_types']) == {str(self.piece_official.pk), str(self.piece_official_2.pk)}
+
         await communicator_wolf.send_json_to({
             'from_loc': [0, 0],
             'to_loc': [1, 0],
             'event_type': 'move'
         })
-        # One move as white
+        # One move as white, only the changes are sent
         wolf_alert = await communicator_wolf.receive_from(TIMEOUT_SEC)
         response_json = json.loads(wolf_alert)
         response_json['whoami'] = 'dan'
         assert response_json['event_type'] == 'board_update'
         dan_alert = await communicator_dan.receive_from(TIMEOUT_SEC)
         assert json.loads(dan_alert) == response_json
-        board = response_json['game_data']['game_state']['board']
-        assert len(board) == 64
-        assert board["0,0"]['piece'] is None
-        assert board["1,0"]['piece'] is not None
-        
-        # One move as black
-        assert board["3,0"]['piece'] is not None
-        assert board["2,0"]['piece'] is None
+        assert response_json['ply'] == 1
+        assert response_json['changed'] == {"0,0": None, "1,0": 0}
+        assert response_json['captured'] == []
+        assert not response_json['white_to_move']
 
+        # One move as black
         await communicator_dan.send_json_to({
             'from_loc': [3, 0],
-            'to_loc': [2, 0]
+            'to_loc': [2, 0],
+            'event_type': 'move'
         })
         dan_alert = await communicator_dan.receive_from(TIMEOUT_SEC)
         wolf_alert = await communicator_wolf.receive_from(TIMEOUT_SEC)
         response_json = json.loads(wolf_alert)
         response_json['whoami'] = 'dan'
         assert json.loads(dan_alert) == response_json
-        board = response_json['game_data']['game_state']['board']
-        assert board["3,0"]['piece'] is None
-        assert board["2,0"]['piece'] is not None
+        assert response_json['ply'] == 2
+        assert response_json['changed'] == {"2,0": 1, "3,0": None}
 
         # One invalid move as white
         await communicator_wolf.send_json_to({
             'from_loc': [1, 0],
-            'to_loc': [2, 0]
+            'to_loc': [2, 0],
+            'event_type': 'move'
         })
         wolf_alert = await communicator_wolf.receive_from(TIMEOUT_SEC)
         response_json = json.loads(wolf_alert)
         assert response_json['event_type'] == "invalid_move"
 
+        # Asking for the whole game again
+        await communicator_wolf.send_json_to({'event_type': 'sync'})
+        response_json = json.loads(await communicator_wolf.receive_from(TIMEOUT_SEC))
+        assert response_json['event_type'] == 'game_state'
+        assert response_json['game_data']['ply'] == 2
+
         await communicator_wolf.disconnect()
         await communicator_dan.disconnect()
 
+class BroadcastTest(TestCase):
+    def make_consumer(self, username):
+        consumer = GameConsumer()
+        consumer.scope = {'user': mock.Mock(username=username)}
+        consumer.group_name = 'game_1'
+        consumer.channel_layer = mock.Mock()
+        consumer.send = mock.AsyncMock()
+        return consumer
+
+    def test_broadcast_encodes_once(self):
+        event = {"event_type": "board_update", "changed": {"0,0": None}, "ply": 1}
+        sender = self.make_consumer('wolf')
+        sent = []
+        async def group_send(group_name, message):
+            sent.append((group_name, message))
+        sender.channel_layer.group_send = group_send
+        with mock.patch('api.consumers.json.dumps', wraps=json.dumps) as dumps:
+            async_to_sync(sender.broadcast)(event)
+            assert dumps.call_count == 1
+            [(group_name, message)] = sent
+            assert group_name == 'game_1'
+            assert message['type'] == 'send_to_socket'
+            receivers = [self.make_consumer(name) for name in ['wolf', 'dan "the man"']]
+            for receiver in receivers:
+                async_to_sync(receiver.send_to_socket)(message)
+                async_to_sync(receiver.send_to_socket)(message)
+            # Only whoami is encoded, once for each receiver
+            assert dumps.call_count == 1 + len(receivers)
+        for receiver in receivers:
+            assert receiver.send.call_count == 2
+            text = receiver.send.call_args.kwargs['text_data']
+            assert json.loads(text) == {**event, "whoami": receiver.scope['user'].username}
+
 class GameTest(TestCaseWithMockData):
     @staticmethod
     def init_empty_board()-> Dict[Location, BoardTile]:
@@ -429,3 +780,616 @@ class GameTest(TestCaseWithMockData):
         assert ctx.did_action
         assert board[Location(0, 0)]['piece'] == None
         assert board[Location(5, 0)]['piece']['piece_id'] == 0
+
+class GameResultTest(TestCaseWithMockData):
+    def test_initial_piece_counts(self):
+        counts = self.sample_game.piece_counts
+        assert counts == count_surviving_pieces(self.sample_game.array_board())
+        assert counts == {'white_total': 1, 'black_total': 1, 'white_royal': 1, 'black_royal': 1}
+
+    def test_take_updates_counts(self):
+        board = self.sample_game.array_board()
+        counts = dict(self.sample_game.piece_counts)
+        ctx = MoveContext(board, Location(0, 0), Location(3, 0), counts)
+        ctx.take(ctx.board[ctx.targeted_tile]['piece'])
+        # Taking a piece that is already gone doesn't count twice
+        ctx.take(board.pieces[1])
+        assert counts == {'white_total': 1, 'black_total': 0, 'white_royal': 1, 'black_royal': 0}
+        assert counts == count_surviving_pieces(board)
+
+    def test_game_result(self):
+        start = {'white_total': 2, 'black_total': 2, 'white_royal': 1, 'black_royal': 1}
+        end = {'white_total': 1, 'black_total': 1, 'white_royal': 0, 'black_royal': 0}
+        any_royal = BoardSetup.WinCon.KILL_ANY_ROYAL
+        kill_all = BoardSetup.WinCon.KILL_ALL
+        assert get_game_result(start, start, any_royal, any_royal) == Game.Result.IN_PROGRESS
+        assert get_game_result(start, end, any_royal, kill_all) == Game.Result.WHITE_WIN
+        assert get_game_result(start, end, kill_all, BoardSetup.WinCon.KILL_ALL_ROYALS) == Game.Result.BLACK_WIN
+        assert get_game_result(start, end, any_royal, any_royal) == Game.Result.DRAW
+
+    def test_resign_keeps_move_made_in_the_meantime(self):
+        stale_game = Game.objects.get(pk=self.sample_game.pk)
+        assert self.sample_game.make_move((0, 0), (1, 0), self.wolf_user)
+        stale_game.resign('black')
+        stale_game.draw('white')
+        game = Game.objects.get(pk=self.sample_game.pk)
+        assert game.result == Game.Result.WHITE_WIN_RESIGN
+        assert game.game_state['draw_offer'] == 'white'
+        assert game.ply == 1 and not game.white_to_move
+        assert bytes(game.board) == bytes(self.sample_game.board)
+
+class PathTest(TestCase):
+    def test_path_tables_match_compute_path(self):
+        board = ArrayBoard()
+        board.set_piece(Location(0, 0), PieceRecord(0, 'piece_a', 'white', False))
+        ctx = MoveContext(board, Location(0, 0), Location(0, 1))
+        # Exclusivity is clamped to [-8, 8], so this covers every distinct path
+        exclusivities = list(range(-9, 10)) + [True, False]
+        for start in SQUARES:
+            for target in SQUARES:
+                for begin_exclusive in exclusivities:
+                    for end_exclusive in exclusivities:
+                        path = ctx.path(start, target, begin_exclusive, end_exclusive)
+                        if start == target:
+                            expected = () if begin_exclusive and end_exclusive else (start,)
+                        else:
+                            expected = compute_path(start, target, int(begin_exclusive), int(end_exclusive))
+                        assert path == expected, (start, target, begin_exclusive, end_exclusive)
+
+    def test_off_board_path(self):
+        board = ArrayBoard()
+        board.set_piece(Location(0, 0), PieceRecord(0, 'piece_a', 'white', False))
+        ctx = MoveContext(board, Location(0, 0), Location(0, 1))
+        assert ctx.path(Location(0, -2), Location(0, 1), 0, 0) == \
+            (Location(0, -2), Location(0, -1), Location(0, 0), Location(0, 1))
+        assert ctx.path(Location(0, 0), Location(3, 6), False, False) == \
+            (Location(0, 0), Location(1, 2), Location(2, 4), Location(3, 6))
+
+class CompileMoveTest(TestCase):
+    def test_action_is_reused(self):
+        action = compile_move(move_source)
+        for to_col in range(1, 4):
+            board = ArrayBoard()
+            board.set_piece(Location(0, 0), PieceRecord(0, 'piece_a', 'white', False))
+            ctx = make_move(action, board, Location(0, 0), Location(0, to_col))
+            assert ctx.did_action
+            assert board.piece_at(Location(0, to_col)).piece_id == 0
+
+    def test_invalid_source(self):
+        with self.assertRaises(SyntaxError):
+            compile_move("ctx.tele_to(ctx.acting_piece, ctx.targeted_tile)\r\n")
+        # Globals would stick around between moves
+        with self.assertRaises(SyntaxError):
+            compile_move("def action():\r\n  global count\r\n  count = 1\r\n")
+        # The rest of the source can't see action's arguments, same as before
+        action = compile_move("x = None\n\n\ndef action():\r\n  ctx.take(x)\r\n")
+        board = ArrayBoard()
+        board.set_piece(Location(0, 0), PieceRecord(0, 'piece_a', 'white', False))
+        with self.assertRaises(NameError):
+            make_move(action, board, Location(0, 0), Location(0, 1))
+
+class LegalMovesTest(TestCaseWithMockData):
+    def test_legal_moves(self):
+        assert self.sample_game.legal_moves() == [((0, 0), (1, 0))]
+        # Black's moves are relative to black's side of the board
+        self.sample_game.white_to_move = False
+        assert self.sample_game.legal_moves() == [((3, 0), (2, 0)), ((3, 0), (4, 0))]
+
+    def test_legal_moves_that_fail(self):
+        for error in (FunctionTimedOut(), api.sandbox.WorkerCrashed()):
+            with mock.patch('api.sandbox.legal_moves', side_effect=error):
+                with self.assertRaises(ValidationError):
+                    self.sample_game.legal_moves()
+
+    def test_legal_moves_endpoint(self):
+        client = Client()
+        client.force_login(self.wolf_user)
+        response = client.get('/api/legalMoves', {'game_pk': self.sample_game.pk})
+        self.assertEqual(response.status_code, 200)
+        assert response.json()['legal_moves'] == [[[0, 0], [1, 0]]]
+        response = client.get('/api/legalMoves', {'game_pk': -1})
+        self.assertEqual(response.status_code, 404)
+        # Only the players can run the game's moves
+        client.force_login(User.objects.create_user('someone', "someone@gmail.com", "password"))
+        response = client.get('/api/legalMoves', {'game_pk': self.sample_game.pk})
+        self.assertEqual(response.status_code, 403)
+        client.force_login(self.dan_user)
+        with mock.patch('api.sandbox.legal_moves', side_effect=FunctionTimedOut()):
+            response = client.get('/api/legalMoves', {'game_pk': self.sample_game.pk})
+        self.assertEqual(response.status_code, 400)
+        assert response.json()['message'].startswith("It took too long")
+
+    def test_game_update(self):
+        game = self.sample_game
+        previous_board = game.board
+        assert game.make_move((0, 0), (1, 0), self.wolf_user)
+        update = game.game_update(previous_board)
+        assert update['ply'] == 1
+        assert update['changed'] == {"0,0": None, "1,0": 0}
+        assert update['captured'] == []
+        assert not update['white_to_move']
+        # The counts the move kept up to date are saved with it
+        assert Game.objects.get(pk=game.pk).piece_counts == count_surviving_pieces(game.array_board())
+        # A piece that is gone from the board was captured
+        previous_board = bytearray(game.board)
+        previous_board[1 + 5 * 8 + 5] = 7 + 1
+        update = game.game_update(previous_board)
+        assert update['changed'] == {"5,5": None}
+        assert update['captured'] == [7]
+        assert len(json.dumps(update)) < 200
+        # Without a previous board nothing changed, e.g. after a draw offer
+        assert game.game_update()['changed'] == {}
+
+    def test_move_made_in_the_meantime(self):
+        game = self.sample_game
+        move = game.prepare_move((0, 0), (1, 0), self.wolf_user)
+        result = move.run()
+        # Someone else moves between preparing and saving the move
+        assert Game.objects.get(pk=game.pk).make_move((0, 0), (1, 0), self.wolf_user)
+        with self.assertRaises(ValidationError):
+            game.finish_move(move, result)
+        assert game.ply == 1 and not game.white_to_move
+
+    def test_game_keeps_move_code(self):
+        move = self.sample_game.game_state['moves'][str(self.move_official.pk)]
+        assert move['code'] == move_source
+        assert 'implementation' not in move
+        # Later changes to the move don't affect the game
+        self.move_official.implementation = {"blocks": {"languageVersion": 0, "blocks": []}}
+        self.move_official.save()
+        CompiledMove.objects.all().delete()
+        api.move_cache.clear()
+        game = Game.objects.get(pk=self.sample_game.pk)
+        assert game.legal_moves() == [((0, 0), (1, 0))]
+        assert game.make_move((0, 0), (1, 0), self.wolf_user)
+        assert game.array_board()[Location(1, 0)]['piece'].team == 'white'
+
+class GameStateTest(TestCaseWithMockData):
+    def test_pieces_are_stored_once(self):
+        pawns = [{'row': row, 'col': col, 'piece': self.piece_official_2.pk,
+                  'team': 'white' if row == 1 else 'black', 'is_royal': False}
+                 for row in [1, 6] for col in range(8)]
+        kings = [{'row': row, 'col': 4, 'piece': self.piece_official.pk,
+                  'team': 'white' if row == 0 else 'black', 'is_royal': True} for row in [0, 7]]
+        setup = BoardSetup.create_board(self.wolf_user, "pawns", pawns + kings, BoardSetup.Category.OFFICIAL,
+                                        BoardSetup.WinCon.KILL_ANY_ROYAL, BoardSetup.WinCon.KILL_ANY_ROYAL)
+        game = Game.create_game(self.wolf_user, self.dan_user, setup)
+        game_state = game.game_state
+        assert game_state['piece_types'] == {
+            str(self.piece_official.pk): {'name': 'king', 'piece_moves': {'1,0': str(self.move_official.pk)}},
+            str(self.piece_official_2.pk): {'name': 'mover', 'piece_moves': {
+                '1,0': str(self.move_official.pk), '-1,0': str(self.dan_move.pk)}},
+        }
+        assert len(game_state['pieces']) == 18
+        state_board = game.state_json()['board']
+        assert len(state_board) == 18
+        assert state_board['6,3'] == {
+            'piece_id': state_board['6,3']['piece_id'], 'piece_pk': str(self.piece_official_2.pk),
+            'team': 'black', 'is_royal': False}
+        assert game_state['pieces'][str(state_board['6,3']['piece_id'])] == state_board['6,3']
+        # One byte for each square, after the version
+        assert len(game.board) == 65
+        board = game.array_board()
+        pawn = board.piece_at(Location(1, 0))
+        assert pawn.name == 'mover'
+        assert pawn.piece_moves == {(1, 0): str(self.move_official.pk), (-1, 0): str(self.dan_move.pk)}
+        # Every pawn shares its moves
+        assert board.piece_at(Location(1, 7)).piece_moves is pawn.piece_moves
+        assert game.make_move((1, 0), (2, 0), self.wolf_user)
+        game.refresh_from_db()
+        state_board = game.state_json()['board']
+        assert state_board['2,0']['piece_pk'] == str(self.piece_official_2.pk)
+        assert '1,0' not in state_board
+
+class ArrayBoardTest(TestCaseWithMockData):
+    def test_state_round_trip(self):
+        state_board = self.sample_game.state_json()['board']
+        piece_types = self.sample_game.game_state['piece_types']
+        board = ArrayBoard.from_state(state_board, piece_types)
+        assert board[Location(0, 0)]['piece'].team == 'white'
+        assert board[Location(3, 0)]['piece']['team'] == 'black'
+        assert board[Location(1, 0)]['piece'] is None
+        assert board.to_state() == state_board
+        flipped = ArrayBoard.from_state(state_board, piece_types, flip=True)
+        assert flipped[Location(7, 0)]['piece'].team == 'white'
+        assert flipped.to_state(flip=True) == state_board
+
+    def test_pack_round_trip(self):
+        game = self.sample_game
+        board = game.array_board()
+        assert board.pack() == bytes(game.board)
+        pieces = board.pieces
+        assert ArrayBoard.unpack(board.pack(), pieces).to_state() == board.to_state()
+        flipped = ArrayBoard.unpack(board.pack(), pieces, flip=True)
+        assert flipped[Location(7, 0)]['piece'].team == 'white'
+        # Whichever side it's seen from, a board is stored the same way
+        assert flipped.pack() == board.pack()
+        # Other versions, or boards that aren't 8x8, aren't read as something else
+        with self.assertRaises(ValueError):
+            ArrayBoard.unpack(b'\x02' + board.pack()[1:], pieces)
+        with self.assertRaises(ValueError):
+            ArrayBoard.unpack(board.pack()[:-1], pieces)
+
+    def test_flipped_view(self):
+        board = self.sample_game.array_board()
+        flipped = board.flipped()
+        assert flipped.piece_at(Location(7, 0)) is board.piece_at(Location(0, 0))
+        assert [loc for loc, _ in flipped.occupied()] == [Location(4, 0), Location(7, 0)]
+        assert flipped.flipped().occupied() == board.occupied()
+        # Moving a piece as black sees it moves it on the board white sees
+        ctx = MoveContext(flipped, Location(4, 0), Location(5, 0))
+        ctx.tele_to(ctx.acting_piece, Location(5, 0))
+        assert board.piece_at(Location(2, 0)).team == 'black'
+        assert board.piece_at(Location(3, 0)) is None
+        assert ctx.tile_of(ctx.acting_piece) == Location(5, 0)
+
+    def test_move_on_array_board(self):
+        board = ArrayBoard()
+        board.set_piece(Location(0, 0), PieceRecord(0, 'piece_a', 'white', False))
+        board.set_piece(Location(0, 1), PieceRecord(1, 'piece_b', 'black', False))
+        ctx = MoveContext(board, Location(0,0), Location(0,1))
+        def action():
+          ctx.take(ctx.board[ctx.targeted_tile]['piece'])
+          ctx.tele_to(ctx.acting_piece, ctx.targeted_tile)
+        action()
+        assert ctx.did_action
+        assert board[Location(0, 0)]['piece'] is None
+        assert board[Location(0, 1)]['piece'].piece_id == 0
+        assert [piece.piece_id for _, piece in board.occupied()] == [0]
+        # The index follows the pieces around
+        assert ctx.tile_of(ctx.acting_piece) == Location(0, 1)
+        with self.assertRaises(InvalidMoveError):
+            ctx.tile_of(PieceRecord(1, 'piece_b', 'black', False))
+        with self.assertRaises(KeyError):
+            board[Location(8, 0)]
+
+class MoveCacheTest(TestCase):
+    def setUp(self):
+        api.move_cache.clear()
+
+    def test_lru_eviction(self):
+        cache = api.move_cache.LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        assert cache.get('a') == 1
+        cache.put('c', 3)
+        # b was the least recently used
+        assert 'b' not in cache
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+        assert len(cache) == 2
+
+    def test_hash_ignores_key_order(self):
+        reordered = json.loads(json.dumps(move_implementation))
+        reordered['blocks'] = dict(reversed(list(reordered['blocks'].items())))
+        assert api.move_cache.implementation_hash(reordered) == api.move_cache.implementation_hash(move_implementation)
+
+    def test_durable_tier_skips_converter(self):
+        # The stored source is used rather than converting the implementation again.
+        key = api.move_cache.implementation_hash(move_implementation)
+        stored_source = move_source + "# from the database\r\n"
+        CompiledMove.objects.create(implementation_hash=key, generator=api.move_cache.GENERATOR, source=stored_source)
+        compiled = api.move_cache.get_move_code(move_implementation)
+        assert compiled.source == stored_source
+        assert api.move_cache.get_move_code(move_implementation) is compiled
+        board = GameTest.init_empty_board()
+        board[Location(0, 0)]['piece'] = PieceInstance({
+            'piece_id': 0,
+            'name': 'piece_a',
+            'team': 'white',
+            'is_royal': False,
+        })
+        ctx = make_move(compiled.action, board, Location(0, 0), Location(2, 0))
+        assert ctx.did_action
+        assert board[Location(2, 0)]['piece']['piece_id'] == 0
+
+    def test_durable_tier_ignores_other_generators(self):
+        key = api.move_cache.implementation_hash(move_implementation)
+        CompiledMove.objects.create(implementation_hash=key, generator='python-0', source="# from an old generator\r\n")
+        assert api.move_cache.get_move_source(move_implementation) == move_source
+        assert CompiledMove.objects.get(implementation_hash=key, generator=api.move_cache.GENERATOR).source == move_source
+
+    def test_check_source(self):
+        api.move_cache.check_source(move_source)
+        # Variables are fine once they have been set
+        api.move_cache.check_source("count = None\n\n\ndef action():\r\n  count = 1\r\n  ctx.tele_to(ctx.acting_piece, ctx.targeted_tile)\r\n")
+        bad_sources = {
+            "def action():\r\n  if :\r\n    pass\r\n": "line 2",
+            "ctx.tele_to(ctx.acting_piece, ctx.targeted_tile)\r\n": "Act block",
+            "import math\n\n\ndef action():\r\n  math.sqrt(2)\r\n": "math",
+            "count = None\n\n\ndef action():\r\n  ctx.path(ctx.targeted_tile, ctx.targeted_tile, count, 0)\r\n": "count",
+            "def action():\r\n  for i in range(0, 3):\r\n    pass\r\n": "can't use the built-in range",
+            "def action():\r\n  ctx.tele_to(ctx.acting_piece, round(ctx.targeted_tile))\r\n": "can't use the built-in round",
+            "def upRange(start, stop, step):\n  pass\n\n\ndef action():\r\n  for i in upRange(0, 3, 1):\r\n    pass\r\n": "can't use upRange",
+        }
+        for source, message in bad_sources.items():
+            with self.assertRaises(ValidationError) as e:
+                api.move_cache.check_source(source)
+            assert message in e.exception.messages[0], e.exception.messages
+
+    def test_check_counting_loop(self):
+        # A count with block, which blockly turns into a loop over range
+        workspace = {"blocks": {"languageVersion": 0, "blocks": [{"type": "chess_action", "id": "a", "inputs": {"ACTION": {"block": {
+            "type": "controls_for", "id": "b", "fields": {"VAR": {"id": "v1"}}, "inputs": {
+                "FROM": {"block": {"type": "math_number", "id": "c", "fields": {"NUM": 0}}},
+                "TO": {"block": {"type": "math_number", "id": "d", "fields": {"NUM": 7}}},
+                "BY": {"block": {"type": "math_number", "id": "e", "fields": {"NUM": 1}}}}}}}}]},
+            "variables": [{"name": "i", "id": "v1", "type": "Number"}]}
+        source = api.blockly_compiler.compile_workspace(workspace)
+        assert 'range(8)' in source
+        with self.assertRaises(ValidationError) as e:
+            api.move_cache.check_source(source)
+        assert e.exception.messages == ["Moves can't use the built-in range. Try rewriting this part of the move."]
+
+    def test_game_code_by_source(self):
+        compiled = api.move_cache.get_game_move_code({'code': move_source})
+        assert compiled.source == move_source
+        assert api.move_cache.get_game_move_code({'code': move_source}) is compiled
+        # Games from before moves kept their code
+        assert api.move_cache.get_game_move_code({'implementation': move_implementation}).source == move_source
+
+class SandboxTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.pool = SandboxPool(1, max_runtime_seconds=0.2, grace_seconds=0.5,
+                               max_legal_moves_seconds=0.5, wait_seconds=0.2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+        super().tearDownClass()
+
+    @staticmethod
+    def make_board():
+        board = ArrayBoard()
+        board.set_piece(Location(0, 0), PieceRecord(0, 'piece_a', 'white', False))
+        return board
+
+    def assert_pool_works(self):
+        board = self.make_board()
+        result = self.pool.make_move(('tele', move_source), board, Location(0, 0), Location(1, 0))
+        assert result.did_action
+        assert result.board[Location(1, 0)]['piece'].piece_id == 0
+        # The board we sent is left alone
+        assert board[Location(0, 0)]['piece'].piece_id == 0
+
+    def test_make_move(self):
+        self.assert_pool_works()
+        with self.assertRaises(InvalidMoveError):
+            self.pool.make_move(('tele', move_source), self.make_board(), Location(0, 0), Location(8, 0))
+
+    def test_infinite_loop(self):
+        source = "def action():\r\n  while True:\r\n    pass\r\n"
+        with self.assertRaises(FunctionTimedOut):
+            self.pool.make_move(('loop', source), self.make_board(), Location(0, 0), Location(1, 0))
+        self.assert_pool_works()
+
+    def test_unresponsive_worker_is_replaced(self):
+        # This move swallows the worker's own timeout, so the worker has to be killed
+        source = ("def action():\r\n  while True:\r\n    try:\r\n      while True:\r\n"
+                  "        pass\r\n    except:\r\n      pass\r\n")
+        with self.assertRaises(FunctionTimedOut):
+            self.pool.make_move(('huge', source), self.make_board(), Location(0, 0), Location(1, 0))
+        self.assert_pool_works()
+
+    def test_slow_legal_moves(self):
+        loop_source = "def action():\r\n  while True:\r\n    pass\r\n"
+        codes = {'loop': ('loop', loop_source), 'tele': ('tele', move_source)}
+        board = ArrayBoard()
+        board.set_piece(Location(0, 0), PieceRecord(0, 'piece_a', 'white', False, piece_moves={(1, 0): 'loop', (2, 0): 'tele'}))
+        # Only the slow candidate is ruled out
+        assert self.pool.legal_moves(codes, board, 'white') == {(Location(0, 0), Location(2, 0))}
+        # But together the candidates can't take longer than max_legal_moves_seconds
+        board.set_piece(Location(0, 0), PieceRecord(0, 'piece_a', 'white', False,
+                                                    piece_moves={(row, 0): 'loop' for row in range(1, 6)}))
+        with self.assertRaises(FunctionTimedOut):
+            self.pool.legal_moves(codes, board, 'white')
+        self.assert_pool_works()
+
+    def test_busy_pool(self):
+        worker = self.pool._idle.get()
+        try:
+            with self.assertRaises(FunctionTimedOut):
+                self.pool.make_move(('tele', move_source), self.make_board(), Location(0, 0), Location(1, 0))
+        finally:
+            self.pool._idle.put(worker)
+        self.assert_pool_works()
+
+class SimulatorTest(TestCaseWithMockData):
+    def setUp(self):
+        super().setUp()
+        key = api.move_cache.implementation_hash(move_implementation)
+        CompiledMove.objects.create(implementation_hash=key, generator=api.move_cache.GENERATOR, source=move_source)
+
+    def test_simulate_setup(self):
+        report = simulate_setup(self.sample_board, 8, processes=1, seed=3, max_plies=20)
+        assert report['games'] == 8
+        assert report['white_win_rate'] + report['black_win_rate'] + report['draw_rate'] == 1
+        assert 0 < report['mean_game_length'] <= 20
+        # The same seed plays the same games, however they are split between processes
+        for processes in [1, 2]:
+            again = simulate_setup(self.sample_board, 8, processes=processes, seed=3, max_plies=20)
+            for key in ['white_win_rate', 'black_win_rate', 'draw_rate', 'mean_game_length', 'end_reasons']:
+                assert again[key] == report[key]
+
+    def test_greedy_captures(self):
+        report = simulate_setup(self.sample_board, 4, white_policy=greedy_capture_policy,
+                                black_policy=greedy_capture_policy, processes=1)
+        assert report['games'] == 4
+
+class BenchmarksTest(TestCaseWithMockData):
+    def test_run_and_compare(self):
+        key = api.move_cache.implementation_hash(move_implementation)
+        CompiledMove.objects.create(implementation_hash=key, generator=api.move_cache.GENERATOR, source=move_source)
+        fixtures = {
+            'board': self.sample_game.array_board(),
+            'counts': count_surviving_pieces(self.sample_game.array_board()),
+            'move_code': api.move_cache.get_move_code(move_implementation),
+            'game': self.sample_game,
+            'game_state': self.sample_game.game_state,
+            'game_board': self.sample_game.board,
+        }
+        results = run_benchmarks(fixtures, min_seconds=0.01, repeat=2)
+        assert set(results['results']) == {bench.name for bench in BENCHMARKS}
+        assert all(result['seconds'] > 0 for result in results['results'].values())
+        assert compare(results, results, 0.1) == []
+        baseline = json.loads(json.dumps(results))
+        baseline['results']['tile_of']['seconds'] /= 2
+        assert [regression.name for regression in compare(results, baseline, 0.1)] == ['tile_of']
+
+    def test_game_is_reset(self):
+        fixtures = {
+            'counts': self.sample_game.piece_counts,
+            'game': self.sample_game,
+            'game_state': self.sample_game.game_state,
+            'game_board': self.sample_game.board,
+        }
+        [bench] = [bench for bench in BENCHMARKS if bench.name == 'game_make_move']
+        reset = bench.setup(fixtures)
+        make_move = bench.build(fixtures)
+        # Every call plays the same move from the same position, saved game included
+        for _ in range(3):
+            game = reset()
+            assert game.ply == 0
+            assert make_move(game)
+            assert Game.objects.get(pk=game.pk).ply == 1
+
+class BlocklyCompilerTest(TestCase):
+    def test_corpus(self):
+        # Each case holds the source that the js generator gives for its workspace
+        corpus_dir = Path(api.blockly_compiler.__file__).parent / 'blockly_corpus'
+        cases = sorted(corpus_dir.glob('*.json'))
+        assert cases
+        for case_path in cases:
+            with open(case_path) as f:
+                case = json.load(f)
+            with self.subTest(case_path.stem):
+                self.assertEqual(api.blockly_compiler.compile_workspace(case['workspace']), case['python'])
+
+    def test_sample_move(self):
+        assert api.blockly_compiler.compile_workspace(move_implementation) == move_source
+        api.move_cache.clear()
+        assert api.move_cache.get_move_code(move_implementation).source == move_source
+
+    def test_unknown_block(self):
+        workspace = {'blocks': {'languageVersion': 0, 'blocks': [{'type': 'launch_missiles', 'id': 'a'}]}}
+        with self.assertRaises(api.blockly_compiler.BlocklyCompileError):
+            api.blockly_compiler.compile_workspace(workspace)
+
+class FakeConverter:
+    """
+    Stands in for the convert_code_server (frontend/convert_code_server.ts), using
+    api/blockly_compiler.py to convert. fail_next makes the next few requests fail with a 503.
+    """
+    def __init__(self):
+        fake = self
+        self.requests = []
+        self.connections = 0
+        self.fail_next = 0
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                fake.connections += 1
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                fake.requests.append(self.path)
+                if fake.fail_next > 0:
+                    fake.fail_next -= 1
+                    return self.reply(503, 'text/plain', b'unavailable')
+                if self.path == '/batch':
+                    results = []
+                    for workspace in body['workspaces']:
+                        try:
+                            results.append({'code': api.blockly_compiler.compile_workspace(workspace)})
+                        except api.blockly_compiler.BlocklyCompileError as e:
+                            results.append({'error': str(e)})
+                    return self.reply(200, 'application/json', json.dumps({'results': results}).encode())
+                self.reply(200, 'text/plain', api.blockly_compiler.compile_workspace(body).encode())
+
+            def reply(self, status, content_type, data):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class ConverterClientTest(TestCaseWithMockData):
+    def setUp(self):
+        self.converter = FakeConverter()
+        self.client = ConverterClient(self.converter.url, timeout_seconds=2, retries=2, retry_backoff_seconds=0)
+        super().setUp()
+
+    def tearDown(self):
+        self.client.close()
+        self.converter.close()
+        super().tearDown()
+
+    def test_convert_keeps_connection_alive(self):
+        for _ in range(3):
+            assert self.client.convert(move_implementation) == move_source
+        assert self.converter.requests == ['/', '/', '/']
+        assert self.converter.connections == 1
+
+    def test_convert_many(self):
+        broken = {'blocks': {'languageVersion': 0, 'blocks': [{'type': 'launch_missiles', 'id': 'a'}]}}
+        assert self.client.convert_many([move_implementation, move_implementation]) == [move_source, move_source]
+        with self.assertRaises(ConversionFailed):
+            self.client.convert_many([move_implementation, broken])
+        assert self.converter.requests == ['/batch', '/batch']
+
+    def test_retries(self):
+        self.converter.fail_next = 2
+        assert self.client.convert(move_implementation) == move_source
+        self.converter.fail_next = 3
+        with self.assertRaises(ConverterUnavailable):
+            self.client.convert(move_implementation)
+        assert len(self.converter.requests) == 6
+
+    def test_circuit_breaker(self):
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=2, reset_seconds=10, clock=lambda: now[0])
+        self.client.breaker = breaker
+        self.client.retries = 0
+        self.converter.fail_next = 2
+        for _ in range(2):
+            with self.assertRaises(ConverterUnavailable):
+                self.client.convert(move_implementation)
+        assert breaker.is_open
+        # Open: the converter isn't asked at all
+        with self.assertRaises(ConverterUnavailable):
+            self.client.convert(move_implementation)
+        assert len(self.converter.requests) == 2
+        # After reset_seconds a trial request goes through and closes the breaker
+        now[0] = 11
+        assert self.client.convert(move_implementation) == move_source
+        assert not breaker.is_open
+
+    def test_create_game_converts_in_one_request(self):
+        CompiledMove.objects.all().delete()
+        api.move_cache.clear()
+        self.dan_move.implementation = {"blocks": {"languageVersion": 0, "blocks": [
+            {"type": "chess_action", "id": "a", "inputs": {"ACTION": {"block": {"type": "take", "id": "b", "inputs": {
+                "TARGET_UNIT": {"block": {"type": "acting_unit", "id": "c"}}}}}}}]}}
+        self.dan_move.save()
+        with mock.patch('api.move_cache.CODE_CONVERTER', 'server'), \
+                mock.patch('api.converter_client._client', self.client):
+            game = Game.create_game(self.wolf_user, self.dan_user, self.sample_board)
+        assert self.converter.requests == ['/batch']
+        assert game.game_state['moves'][str(self.move_official.pk)]['code'] == move_source
+        assert CompiledMove.objects.count() == 2
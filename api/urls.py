@@ -1,5 +1,5 @@
 from django.urls import path
-from .views import Pieces, Moves, Users, documentation, BoardSetups, GameRequests, Games
+from .views import Pieces, Moves, Users, documentation, BoardSetups, GameRequests, Games, LegalMoves
 
 urlpatterns = [
     path('users', Users.as_view()),
@@ -8,5 +8,6 @@ urlpatterns = [
     path('moves', Moves.as_view()),
     path('gameRequests', GameRequests.as_view()),
     path('games', Games.as_view()),
+    path('legalMoves', LegalMoves.as_view()),
     path('', documentation),
 ]
\ No newline at end of file
@@ -6,18 +6,45 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 
+import api.catalog_cache
+import api.image_store
 from api.models import Move, Piece, to_color_string, PieceSerializer, MoveSerializer, \
     BoardSetup, BoardSetupSerializer, GameRequest, GameRequestSerializer, \
     GameSerializer, Game
+import itertools
 import json
+import mimetypes
+from typing import Any, Dict, List, Optional, Tuple
 from django.contrib.auth.models import User
 # Create your views here.
-from django.http import HttpResponse
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified
 from django.core.exceptions import ValidationError
+from django.db.models import Q
 
 def documentation(request):
     return HttpResponse("Yo! Welcome to the API.")
 
+def piece_image(request, name):
+    """Serve an image from api.image_store.
+
+    An image name never changes what it points to, so browsers can cache it forever.
+    """
+    try:
+        path = api.image_store.path_of(name)
+    except ValueError:
+        raise Http404("No such image")
+    etag = api.image_store.etag_of(name)
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponseNotModified()
+    else:
+        try:
+            response = FileResponse(open(path, 'rb'), content_type=mimetypes.guess_type(name)[0])
+        except FileNotFoundError:
+            raise Http404("No such image")
+    response['ETag'] = etag
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
 # https://www.django-rest-framework.org/api-guide/views/
 def ResponseWithMessage(message, status):
     return Response(data={"message": str(message)}, status=status)
@@ -58,21 +85,106 @@ class Users(APIView):
     # Using https://learndjango.com/tutorials/django-login-and-logout-tutorial
     # for the auth
 
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+def list_params(request, serializer_class) -> Tuple[Optional[List[str]], Optional[int], Optional[int]]:
+    """The fields, cursor and limit query parameters of a listing.
+
+    fields and exclude are comma separated names of serializer fields, without
+    either all fields are sent (fields is None). A listing is paginated if it's
+    given a limit or a cursor, the cursor is the next_cursor of the previous
+    page. Without them everything is sent (limit is None).
+    Raises ValueError if the parameters are invalid.
+    """
+    all_fields = serializer_class.Meta.fields
+    fields = None
+    if 'fields' in request.GET or 'exclude' in request.GET:
+        included = request.GET['fields'].split(',') if 'fields' in request.GET else all_fields
+        excluded = request.GET['exclude'].split(',') if 'exclude' in request.GET else []
+        for name in itertools.chain(included, excluded):
+            if name not in all_fields:
+                raise ValueError(f"Unknown field {name}, the fields are {', '.join(all_fields)}")
+        fields = [name for name in included if name not in excluded]
+    cursor = None
+    if 'cursor' in request.GET:
+        try:
+            cursor = int(request.GET['cursor'])
+        except ValueError:
+            raise ValueError("Invalid cursor")
+    limit = None
+    if 'limit' in request.GET:
+        try:
+            limit = int(request.GET['limit'])
+        except ValueError:
+            raise ValueError("Invalid limit")
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            raise ValueError(f"The limit must be between 1 and {MAX_PAGE_SIZE}")
+    elif cursor is not None:
+        limit = DEFAULT_PAGE_SIZE
+    return fields, cursor, limit
+
+def page_of(queryset, cursor: Optional[int], limit: Optional[int]) -> Tuple[List[Any], Optional[str]]:
+    """The objects after the cursor, in pk order, and the cursor of the page after them (None on the last page)."""
+    queryset = queryset.order_by('pk')
+    if limit is None:
+        return list(queryset), None
+    if cursor is not None:
+        queryset = queryset.filter(pk__gt=cursor)
+    # One extra to know if there's another page
+    objects = list(queryset[:limit + 1])
+    if len(objects) <= limit:
+        return objects, None
+    return objects[:limit], str(objects[limit - 1].pk)
+
+def without_unused_fields(queryset, fields: Optional[List[str]]):
+    """Don't load the (possibly big) columns that won't be sent."""
+    if fields is None:
+        return queryset
+    unused = [field.name for field in queryset.model._meta.concrete_fields
+              if not field.primary_key and not field.is_relation and field.name not in fields]
+    return queryset.defer(*unused)
+
+def catalog_etag(get):
+    """Answer with 304 if the client has the current catalog, see api.catalog_cache."""
+    def get_with_etag(self, request, *args, **kwargs):
+        etag = api.catalog_cache.etag(request.user)
+        if etag in request.headers.get('If-None-Match', ''):
+            response = HttpResponseNotModified()
+        else:
+            response = get(self, request, *args, **kwargs)
+            if response.status_code != status.HTTP_200_OK:
+                return response
+        response['ETag'] = etag
+        # Users' own content is in there too, and browsers have to check it's still current
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+    return get_with_etag
+
 class Moves(APIView):
     """
     User developed chess moves
     """
+    @catalog_etag
     def get(self, request, format=None):
         """
         Return a list of all the default moves, plus
         any moves this user has made
         """
-        moves = Move.objects.filter(cat=Move.Category.OFFICIAL)
-        if request.user.is_authenticated:
-            user_moves = Move.objects.filter(author=request.user)
-            moves = moves.union(user_moves)
-        all_moves = [MoveSerializer(move).data for move in moves]
-        return JsonResponse(all_moves, safe=False)
+        try:
+            fields, cursor, limit = list_params(request, MoveSerializer)
+        except ValueError as e:
+            return ResponseWithMessage(e, status=status.HTTP_400_BAD_REQUEST)
+        if fields is None and limit is None:
+            official_moves = api.catalog_cache.get_or_build('moves', lambda: serialize_moves(official(Move)))
+            own_moves = serialize_moves(own_content(request.user, Move))
+            return JsonResponse(by_pk(official_moves, own_moves), safe=False)
+        moves = Move.objects.filter(visible_to(request.user, Move)).select_related('author')
+        moves, next_cursor = page_of(without_unused_fields(moves, fields), cursor, limit)
+        serialized_moves = list(MoveSerializer(moves, many=True, fields=fields).data)
+        if limit is None:
+            return JsonResponse(serialized_moves, safe=False)
+        return JsonResponse({'moves': serialized_moves, 'next_cursor': next_cursor})
 
     def post(self, request):
         move_query = json.loads(request.query_params.get('newMove'))
@@ -100,34 +212,88 @@ class Moves(APIView):
             move.save()
             return Response({'new_move': MoveSerializer(move).data}, status=status.HTTP_201_CREATED)
         except ValidationError as e:
-            return ResponseWithMessage(e, status=status.HTTP_401_UNAUTHORIZED)
+            return ResponseWithMessage(" ".join(e.messages), status=status.HTTP_401_UNAUTHORIZED)
+
+def official(model) -> Q:
+    """Filter for the official Moves/Pieces/BoardSetups, which are the same for everyone so they're cached."""
+    return Q(cat=model.Category.OFFICIAL)
+
+def own_content(user, model) -> Q:
+    """Filter for the Moves/Pieces/BoardSetups this user has made, other than official ones."""
+    if not user.is_authenticated:
+        # Matches nothing without a query
+        return Q(pk__in=[])
+    return Q(author=user) & ~official(model)
+
+def visible_to(user, model) -> Q:
+    """Filter for the official Moves/Pieces/BoardSetups, plus the ones this user has made."""
+    return official(model) | own_content(user, model)
+
+def by_pk(*serialized_lists) -> List[Dict[str, Any]]:
+    return sorted(itertools.chain(*serialized_lists), key=lambda data: int(data['pk']))
+
+def serialize_moves(filter: Q) -> List[Dict[str, Any]]:
+    return list(MoveSerializer(Move.objects.filter(filter).select_related('author').order_by('pk'), many=True).data)
+
+def pieces_with_moves():
+    """Pieces, with everything PieceSerializer needs fetched up front."""
+    return Piece.objects.select_related('author').prefetch_related('piece_moves')
+
+def serialized_pieces_of(serialized_boards) -> Dict[str, Any]:
+    """pk -> serialized piece, for every piece used on these (serialized) board setups."""
+    piece_pks = {piece_loc['piece'] for board_data in serialized_boards
+                 for piece_loc in board_data.get('piece_locations', [])}
+    return {str(piece.pk): PieceSerializer(piece).data for piece in pieces_with_moves().filter(pk__in=piece_pks)}
+
+def serialize_pieces(pieces, fields: Optional[List[str]] = None) -> Dict[str, Any]:
+    """The pieces, and the moves that they use."""
+    serialized_pieces = list(PieceSerializer(pieces, many=True, fields=fields).data)
+    all_move_pks = {piece_move['move'] for piece_data in serialized_pieces
+                    for piece_move in piece_data.get('piece_moves', [])}
+    move_pk_map = {
+        str(move.pk): MoveSerializer(move).data
+        for move in Move.objects.filter(pk__in=all_move_pks).select_related('author')
+    }
+    return {
+        'pieces': serialized_pieces,
+        'move_map': move_pk_map
+    }
+
+def serialize_boards(boards, fields: Optional[List[str]] = None) -> Dict[str, Any]:
+    """The board setups, and the pieces used on them."""
+    serialized_boards = list(BoardSetupSerializer(boards, many=True, fields=fields).data)
+    return {
+        'boards': serialized_boards,
+        'pieces': serialized_pieces_of(serialized_boards)
+    }
 
 class Pieces(APIView):
     """
     Fairy chess pieces
     """
+    @catalog_etag
     def get(self, request, format=None):
         """
         Return a list of all pieces, and the moves that they use.
         """
-        pieces = Piece.objects.filter(cat=Move.Category.OFFICIAL)
-        if request.user.is_authenticated:
-            user_pieces = Piece.objects.filter(author=request.user)
-            pieces = pieces.union(user_pieces)
-        serialized_pieces = []
-        all_move_pks = set()
-        for piece in pieces:
-            piece_data = PieceSerializer(piece).data
-            serialized_pieces.append(piece_data)
-            for move_pk in piece_data['piece_moves']:
-                all_move_pks.add(move_pk['move'])
-        move_pk_map = {
-            move_pk: MoveSerializer(Move.objects.get(('pk', move_pk))).data for move_pk in all_move_pks
-        }
-        return JsonResponse({
-            'pieces': serialized_pieces,
-            'move_map': move_pk_map
-        })
+        try:
+            fields, cursor, limit = list_params(request, PieceSerializer)
+        except ValueError as e:
+            return ResponseWithMessage(e, status=status.HTTP_400_BAD_REQUEST)
+        if fields is None and limit is None:
+            official_pieces = api.catalog_cache.get_or_build(
+                'pieces', lambda: serialize_pieces(pieces_with_moves().filter(official(Piece)).order_by('pk')))
+            own_pieces = serialize_pieces(pieces_with_moves().filter(own_content(request.user, Piece)).order_by('pk'))
+            return JsonResponse({
+                'pieces': by_pk(official_pieces['pieces'], own_pieces['pieces']),
+                'move_map': {**official_pieces['move_map'], **own_pieces['move_map']}
+            })
+        pieces = pieces_with_moves().filter(visible_to(request.user, Piece))
+        pieces, next_cursor = page_of(without_unused_fields(pieces, fields), cursor, limit)
+        serialized = serialize_pieces(pieces, fields)
+        if limit is not None:
+            serialized['next_cursor'] = next_cursor
+        return JsonResponse(serialized)
 
     def post(self, request):
         """Create a new piece
@@ -147,34 +313,39 @@ class BoardSetups(APIView):
     """
     Initial board setups
     """
+    @catalog_etag
     def get(self, request, format=None):
         """
         Return a list of all boards.
         """
+        try:
+            fields, cursor, limit = list_params(request, BoardSetupSerializer)
+        except ValueError as e:
+            return ResponseWithMessage(e, status=status.HTTP_400_BAD_REQUEST)
         pk_list_serialized = request.GET.get('pk_list')
+        board_setups = without_unused_fields(
+            BoardSetup.objects.select_related('author').prefetch_related('piece_locations'), fields)
         if pk_list_serialized:
-            pk_list = pk_list_serialized.split(',')
-            boards = []
-            for pk in pk_list:
-                boards.append(BoardSetup.objects.get(pk=int(pk)))
-        else:
-            boards = BoardSetup.objects.filter(cat=BoardSetup.Category.OFFICIAL)
-            if request.user.is_authenticated:
-                user_boards = BoardSetup.objects.filter(author=request.user)
-                boards = boards.union(user_boards)
-        serialized_boards = []
-        all_piece_pks = set()
-        for board in boards:
-            board_data = BoardSetupSerializer(board).data
-            serialized_boards.append(board_data)
-            for piece_loc in board_data['piece_locations']:
-                all_piece_pks.add(piece_loc['piece'])
-        piece_pk_map = {
-            piece_pk: PieceSerializer(Piece.objects.get(('pk', piece_pk))).data for piece_pk in all_piece_pks
-        }
+            try:
+                pk_list = [int(pk) for pk in pk_list_serialized.split(',')]
+            except ValueError:
+                return ResponseWithMessage("Invalid board setup pk", status=status.HTTP_400_BAD_REQUEST)
+            boards_by_pk = board_setups.in_bulk(pk_list)
+            if len(boards_by_pk) != len(set(pk_list)):
+                return ResponseWithMessage("This board setup does not exist", status=status.HTTP_404_NOT_FOUND)
+            return JsonResponse(serialize_boards([boards_by_pk[pk] for pk in pk_list], fields))
+        if fields is not None or limit is not None:
+            boards, next_cursor = page_of(board_setups.filter(visible_to(request.user, BoardSetup)), cursor, limit)
+            serialized = serialize_boards(boards, fields)
+            if limit is not None:
+                serialized['next_cursor'] = next_cursor
+            return JsonResponse(serialized)
+        official_boards = api.catalog_cache.get_or_build(
+            'boards', lambda: serialize_boards(board_setups.filter(official(BoardSetup)).order_by('pk')))
+        own_boards = serialize_boards(board_setups.filter(own_content(request.user, BoardSetup)).order_by('pk'))
         return JsonResponse({
-            'boards': serialized_boards,
-            'pieces': piece_pk_map
+            'boards': by_pk(official_boards['boards'], own_boards['boards']),
+            'pieces': {**official_boards['pieces'], **own_boards['pieces']}
         })
 
     def post(self, request):
@@ -197,20 +368,12 @@ class GameRequests(APIView):
         """
         Return a list of all current game requests
         """
-        game_requests = GameRequest.objects.all()
-        requests = []
-        all_piece_pks = set()
-        for request in game_requests:
-            request_data = GameRequestSerializer(request).data
-            requests.append(request_data)
-            for piece_loc in request_data['board_setup']['piece_locations']:
-                all_piece_pks.add(piece_loc['piece'])
-        piece_pk_map = {
-            piece_pk: PieceSerializer(Piece.objects.get(('pk', piece_pk))).data for piece_pk in all_piece_pks
-        }
+        game_requests = GameRequest.objects.select_related('requesting_user', 'board_setup__author') \
+            .prefetch_related('board_setup__piece_locations').order_by('pk')
+        requests = GameRequestSerializer(game_requests, many=True).data
         return JsonResponse({
             'game_requests': requests,
-            'pieces': piece_pk_map
+            'pieces': serialized_pieces_of([request_data['board_setup'] for request_data in requests])
         })
 
     def post(self, request):
@@ -245,10 +408,42 @@ class Games(APIView):
     def get(self, request, format=None):
         if not request.user.is_authenticated:
             return ResponseWithMessage("You must be logged in to play.", status=status.HTTP_401_UNAUTHORIZED)
-        white_games = Game.objects.filter(white_user=request.user)
-        black_games = Game.objects.filter(black_user=request.user)
-        played_games = white_games.union(black_games)
-        result = []
-        for game in played_games:
-            result.append(GameSerializer(game).data)
-        return Response(data={"games": result}, status=status.HTTP_200_OK)
+        try:
+            fields, cursor, limit = list_params(request, GameSerializer)
+        except ValueError as e:
+            return ResponseWithMessage(e, status=status.HTTP_400_BAD_REQUEST)
+        played_games = Game.objects.filter(Q(white_user=request.user) | Q(black_user=request.user)) \
+            .select_related('white_user', 'black_user', 'setup')
+        # The board and the piece counts are part of the serialized game_state
+        used_fields = fields + ['board', 'piece_counts'] if fields is not None and 'game_state' in fields else fields
+        played_games, next_cursor = page_of(without_unused_fields(played_games, used_fields), cursor, limit)
+        data = {"games": GameSerializer(played_games, many=True, fields=fields).data}
+        if limit is not None:
+            data['next_cursor'] = next_cursor
+        return Response(data=data, status=status.HTTP_200_OK)
+
+class LegalMoves(APIView):
+    def get(self, request, format=None):
+        """
+        Return every move that the side to move can play in a game.
+        """
+        if not request.user.is_authenticated:
+            return ResponseWithMessage("You must be logged in to play.", status=status.HTTP_401_UNAUTHORIZED)
+        try:
+            game = Game.objects.get(pk=int(request.GET.get('game_pk')))
+        except (TypeError, ValueError, Game.DoesNotExist):
+            return ResponseWithMessage("This game does not exist", status=status.HTTP_404_NOT_FOUND)
+        # Finding them runs the game's moves, so only the players can ask
+        if request.user.pk not in (game.white_user_id, game.black_user_id):
+            return ResponseWithMessage("You are not playing in this game.", status=status.HTTP_403_FORBIDDEN)
+        try:
+            legal_moves = game.legal_moves()
+        except ValidationError as e:
+            return ResponseWithMessage(" ".join(e.messages), status=status.HTTP_400_BAD_REQUEST)
+        except (SyntaxError, NameError) as e:
+            return ResponseWithMessage(f"A move in this game could not be run: {e}", status=status.HTTP_400_BAD_REQUEST)
+        return Response(data={
+            "game_pk": str(game.pk),
+            "white_to_move": game.white_to_move,
+            "legal_moves": legal_moves
+        }, status=status.HTTP_200_OK)
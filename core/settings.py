@@ -22,6 +22,26 @@ REDIS_HOST = os.environ.get('REDIS_HOST', '127.0.0.1')
 REDIS_PORT = os.environ.get('REDIS_PORT', '6379')
 CODE_CONVERT_HOST = os.environ.get('CODE_CONVERT_HOST', '127.0.0.1')
 CODE_CONVERT_PORT = os.environ.get('CODE_CONVERT_PORT', '3333')
+# 'python' turns blockly workspaces into python in process (see api/blockly_compiler.py),
+# 'server' sends them to the convert_code_server
+CODE_CONVERTER = os.environ.get('CODE_CONVERTER', 'python')
+# Each request to the convert_code_server gives up after this long, and is retried this many times
+CODE_CONVERT_TIMEOUT_SECONDS = float(os.environ.get('CODE_CONVERT_TIMEOUT_SECONDS', '5'))
+CODE_CONVERT_RETRIES = int(os.environ.get('CODE_CONVERT_RETRIES', '2'))
+# Number of compiled move implementations each process keeps in memory
+COMPILED_MOVE_CACHE_SIZE = int(os.environ.get('COMPILED_MOVE_CACHE_SIZE', '512'))
+# Moves run on this many sandbox worker processes (see api/sandbox.py), 0 runs them in the server process
+MOVE_SANDBOX_WORKERS = int(os.environ.get('MOVE_SANDBOX_WORKERS', '2'))
+MOVE_TIMEOUT_SECONDS = float(os.environ.get('MOVE_TIMEOUT_SECONDS', '1'))
+# Finding the legal moves runs every move a player could make, each limited to MOVE_TIMEOUT_SECONDS
+LEGAL_MOVES_TIMEOUT_SECONDS = float(os.environ.get('LEGAL_MOVES_TIMEOUT_SECONDS', '10'))
+# How long a move waits for a sandbox worker when they are all busy
+MOVE_SANDBOX_WAIT_SECONDS = float(os.environ.get('MOVE_SANDBOX_WAIT_SECONDS', '10'))
+# Limits on uploaded piece images (see api/piece_images.py)
+PIECE_IMAGE_MAX_BYTES = int(os.environ.get('PIECE_IMAGE_MAX_BYTES', str(512 * 1024)))
+PIECE_IMAGE_MAX_SIZE = int(os.environ.get('PIECE_IMAGE_MAX_SIZE', '512'))
+# 'redis' shares the cache (see api/catalog_cache.py) between server processes, 'locmem' keeps one per process
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'locmem')
 POSTGRES_HOST = os.environ.get('POSTGRES_HOST', 'lumpy-wyvern-4982.g8z.cockroachlabs.cloud')
 POSTGRES_PORT = os.environ.get('POSTGRES_PORT', '26257')
 POSTGRES_USERNAME = os.environ.get('POSTGRES_USERNAME', 'alex')
@@ -126,6 +146,21 @@ CHANNEL_LAYERS = {
     },
 }
 
+if CACHE_BACKEND == 'redis':
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            # db 0 is used by the channel layer
+            "LOCATION": f"redis://{REDIS_HOST}:{REDIS_PORT}/1",
+        },
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        },
+    }
+
 
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
@@ -192,6 +227,6 @@ STATIC_ROOT = BASE_DIR / 'static'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
-# MEDIA_URL = '/media/'
-# MEDIA_ROOT = BASE_DIR / 'core' / 'static'
-# print(f"MEDIA URL {MEDIA_URL} root {MEDIA_ROOT}")
\ No newline at end of file
+# Uploaded files, i.e. piece images (see api/image_store.py)
+MEDIA_URL = '/media/'
+MEDIA_ROOT = os.environ.get('MEDIA_ROOT', BASE_DIR / 'media')
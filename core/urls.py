@@ -26,6 +26,9 @@ from django.contrib.auth.forms import UserCreationForm
 from django.urls import reverse_lazy
 from django.views import generic
 
+import api.image_store
+from api.views import piece_image
+
 class SignUpView(generic.CreateView):
     form_class = UserCreationForm
     success_url = reverse_lazy("chess")
@@ -38,6 +41,7 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('api.urls')),
     re_path(r"^public/(?P<path>.*)$", serve, {"document_root": settings.STATIC_ROOT}), 
+    path(f"{settings.MEDIA_URL.strip('/')}/{api.image_store.IMAGE_DIR}/<str:name>", piece_image),
     re_path(r"^chess$", TemplateView.as_view(template_name="base.html"), name='chess'),
     path("accounts/signup/", SignUpView.as_view(), name='signup'),  # new
     path("accounts/", include("django.contrib.auth.urls")),  # new
@@ -0,0 +1,41 @@
+/*
+Check that the python generator in src/blockly.ts still gives the source
+stored in api/blockly_corpus, which api/blockly_compiler.py is tested against.
+
+Run with npx tsx check_blockly_corpus.ts
+Pass --update to overwrite the stored source with what the generator gives.
+*/
+import 'blockly/blocks';
+import {readdirSync, readFileSync, writeFileSync} from 'fs';
+import {Blockly, pythonGenerator} from './src/blockly';
+
+const corpusDir = '../api/blockly_corpus'
+const update = process.argv.includes('--update')
+
+function generate(json) {
+  const workspace = new Blockly.Workspace();
+  Blockly.serialization.workspaces.load(json, workspace);
+  return pythonGenerator.workspaceToCode(workspace)
+}
+
+let failures = 0
+for (const name of readdirSync(corpusDir).filter(name => name.endsWith('.json')).sort()) {
+  const path = `${corpusDir}/${name}`
+  const testCase = JSON.parse(readFileSync(path, 'utf8'))
+  const code = generate(testCase.workspace)
+  if (code === testCase.python) {
+    continue
+  }
+  if (update) {
+    testCase.python = code
+    writeFileSync(path, JSON.stringify(testCase, null, 2) + '\n')
+    console.log(`Updated ${name}`)
+  } else {
+    failures++
+    console.log(`${name} differs\n--- expected\n${JSON.stringify(testCase.python)}\n--- generated\n${JSON.stringify(code)}`)
+  }
+}
+if (failures > 0) {
+  process.exit(1)
+}
+console.log("Corpus matches the generator")
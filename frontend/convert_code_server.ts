@@ -20,10 +20,13 @@ as this folder has the blockly generators and a javascript setup already.
 
 
 import express, { Express, Request, Response } from './node_modules/express';
+// Blockly's own blocks (if, for, math, ...) that the move editor's toolbox has
+import 'blockly/blocks';
 import {Blockly, pythonGenerator} from './src/blockly';
 
 const app: Express = express()
-app.use(express.json());
+// A batch can hold every move of a board setup
+app.use(express.json({limit: '5mb'}));
 
 const port = 3333
 function generate(json) {
@@ -42,6 +45,25 @@ app.post('/', (req: Request, res: Response) => {
   res.send(generate(workspace_json))
 })
 
+// Convert many workspaces in one request.
+// Takes {workspaces: [...]} and returns {results: [{code: "..."} or {error: "..."}, ...]} in the same order,
+// so one broken workspace doesn't fail the others.
+app.post('/batch', (req: Request, res: Response) => {
+  const workspaces = req.body.workspaces
+  if (!Array.isArray(workspaces)) {
+    res.status(400).send("Expected {workspaces: [...]}")
+    return
+  }
+  const results = workspaces.map((workspace_json) => {
+    try {
+      return {code: generate(workspace_json)}
+    } catch (e) {
+      return {error: String(e)}
+    }
+  })
+  res.json({results: results})
+})
+
 app.listen(port, () => {
   console.log(`Example app listening on port ${port}`)
 })
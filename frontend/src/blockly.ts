@@ -5,6 +5,7 @@ import * as BLOCKLY_ENGLISH from 'blockly/msg/en';
 // Imported in a weird way because the convert_code_server was getting angsty
 import pkg from 'blockly/python';
 const {pythonGenerator: pyGen} = pkg;
+// Changing the generated code? Bump GENERATOR_VERSION in api/blockly_compiler.py
 
 Blockly.setLocale(BLOCKLY_ENGLISH);
 const chessTheme = Blockly.Theme.defineTheme('chessTheme', {
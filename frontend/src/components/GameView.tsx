@@ -1,10 +1,10 @@
 import React, { FC, useRef, useState, useEffect } from "react";
 import _ from 'lodash'
 import { chessStore, exitGame, updateGamePkToMove, updateGameMessage, setErrorMessage } from "../store";
-import { Game, GameState, GameTile, GamePiece, DjangoGameData } from "./types";
+import { Game, GameState, GameTile, GamePiece, DjangoGameData, DjangoGameUpdate } from "./types";
 import PieceView from "./PieceView";
 import MoveIcon from "./MoveIcon";
-import { updateGame } from "../networking";
+import { applyGameUpdate, updateGame } from "../networking";
 import { GameResult } from "./definitions";
 import { Button } from "flowbite-react";
 import { format_username, isYourMove } from './utils'
@@ -19,12 +19,17 @@ export const makeGameSocket = (gamePk: string) => {
     const data = JSON.parse(m.data);
     if ((data['event_type'] == 'invalid_move') || (data['event_type'] == 'fail')){
       updateGameMessage(gamePk, data['message'])
-    } else if (data['event_type'] == "board_update" || // played a move
-               data['event_type'] == "agreement" // resign/draw offer
-    ) {
+    } else if (data['event_type'] == "game_state") { // the whole game, when we join or ask for it
       const gameData: DjangoGameData = data['game_data']
       updateGamePkToMove(gameData['game_state']['moves'], gameData['pk'])
       updateGame(gameData)
+    } else if (data['event_type'] == "board_update" || // played a move
+               data['event_type'] == "agreement" // resign/draw offer
+    ) {
+      if (!applyGameUpdate(data as DjangoGameUpdate)) {
+        // We missed an update, get the whole game again
+        gameSocket.send(JSON.stringify({'event_type': 'sync'}))
+      }
     }
 
   }
@@ -66,6 +66,7 @@ export type LobbySetup = {
 export interface GamePiece extends Piece {
   team: string
   isRoyal: boolean
+  pieceId: number
 }
 
 // State of a tile pertaining to a specific game being played
@@ -88,7 +89,9 @@ export type Game = {
   result: GameResult
   whiteToMove: boolean,
   errorMessage: string,
-  drawOffer: string
+  drawOffer: string,
+  // Number of moves played, see applyGameUpdate
+  ply: number
 }
 
 
@@ -103,19 +106,23 @@ export type Game = {
 // - it's good to decouple so that backend changes can be dealt with in one place
 // so they are not. It's harder than you would expect to share the same types
 // in the frontend and backend!
+// A piece on the board of a game, its name and moves are in its DjangoPieceType
 export type DjangoGamePiece = {
   is_royal: boolean
-  name: string
   piece_id: number
   piece_pk: string
-  piece_moves: PieceMove[]
   team: string
 }
-export type DjangoGameStateTile = {
-  piece: DjangoGamePiece | null
+export type DjangoPieceType = {
+  name: string
+  // "relative_row,relative_col" -> move pk
+  piece_moves: {[key: string]: string}
 }
 export type DjangoGameState = {
-  board: {[key: string]: DjangoGameStateTile}
+  // piece_pk -> the piece, shared by every instance of it on the board
+  piece_types: {[key: string]: DjangoPieceType}
+  // "row,col" -> piece, only for the occupied squares
+  board: {[key: string]: DjangoGamePiece}
   moves: Move[]
   wincon_black: string
   wincon_white: string
@@ -134,6 +141,19 @@ export type DjangoGameData = {
   setup: DjangoSetupShort
   white_to_move: boolean
   result: GameResult
+  ply: number
+}
+// Sent after each move (board_update) or resign/draw (agreement), see Game.game_update in api/models.py
+export type DjangoGameUpdate = {
+  event_type: 'board_update' | 'agreement'
+  pk: string
+  ply: number
+  white_to_move: boolean
+  result: GameResult
+  draw_offer: string
+  // "row,col" -> piece_id of the piece now there, or null if it's empty
+  changed: {[key: string]: number | null}
+  captured: number[]
 }
 
 export type BoardSetupDjangoMeta = {
@@ -4,7 +4,7 @@ import axios from 'axios';
 import { makeGameSocket } from './components/GameView';
 import { addToLobby } from './components/Lobby';
 import { initBoardSetup, moveMapToGrid } from './components/utils'
-import { BoardSetup, Game, BoardSetupMeta, GameState, BoardSetupDjangoMeta, DjangoGameData, DjangoGameState, DjangoPieceMap} from './components/types'
+import { BoardSetup, Game, BoardSetupMeta, GameState, GamePiece, BoardSetupDjangoMeta, DjangoGameData, DjangoGameState, DjangoGameUpdate, DjangoPieceMap, MoveGrid} from './components/types'
 import { chessStore, updatePieces, updateMoves, updatePkToMove, updatePkToPiece } from "./store";
 import {api} from './App';
 
@@ -91,27 +91,33 @@ const gameStateFromDjango = (init_state: DjangoGameState) => {
     });
   });
   const pkToPiece = chessStore.getState().pkToPiece
-  for(let [key, value] of Object.entries(init_state.board)) {
+  // Every piece of a type shares its move grid
+  const typeMoves = new Map<string, MoveGrid>()
+  for (let [piecePk, pieceType] of Object.entries(init_state.piece_types)) {
+    typeMoves.set(piecePk, moveMapToGrid(Object.entries(pieceType.piece_moves).map(([key, move]) => {
+      const [relativeRow, relativeCol] = key.split(',').map((x) => parseInt(x))
+      return {relative_row: relativeRow, relative_col: relativeCol, move: move}
+    })))
+  }
+  for(let [key, p] of Object.entries(init_state.board)) {
     let [row, col] = key.split(',')
-    const p = value.piece
-    if (p != null) {
-      const orig_piece = pkToPiece.get(p.piece_pk)!
-      const piece = {
-        team: p.team,
-        isRoyal: p.is_royal,
-        moves: moveMapToGrid(p.piece_moves),
-        name: p.name,
-        pk: p.piece_pk,
-        // Reference orig_piece only for data unrelated
-        // to the game - if the piece is modified, and
-        // then the game is refreshed, it may change,
-        // and we want to mitigate the damage!
-        author: orig_piece?.author,
-        imageBlack: orig_piece?.imageBlack,
-        imageWhite: orig_piece?.imageWhite
-      }
-      grid[parseInt(row)][parseInt(col)]['piece'] = piece
+    const orig_piece = pkToPiece.get(p.piece_pk)!
+    const piece = {
+      team: p.team,
+      isRoyal: p.is_royal,
+      moves: typeMoves.get(p.piece_pk)!,
+      name: init_state.piece_types[p.piece_pk].name,
+      pk: p.piece_pk,
+      pieceId: p.piece_id,
+      // Reference orig_piece only for data unrelated
+      // to the game - if the piece is modified, and
+      // then the game is refreshed, it may change,
+      // and we want to mitigate the damage!
+      author: orig_piece?.author,
+      imageBlack: orig_piece?.imageBlack,
+      imageWhite: orig_piece?.imageWhite
     }
+    grid[parseInt(row)][parseInt(col)]['piece'] = piece
   }
   return grid
 }
@@ -132,7 +138,8 @@ export const updateGame = (gameData: DjangoGameData) => chessStore.setState((sta
         pk: gameData.pk,
         result: gameData.result,
         errorMessage: "",
-        drawOffer: gameData.game_state.draw_offer
+        drawOffer: gameData.game_state.draw_offer,
+        ply: gameData.ply
       }
     } else {
       return game
@@ -141,6 +148,50 @@ export const updateGame = (gameData: DjangoGameData) => chessStore.setState((sta
   return {games: newGames}
 })
 
+// Apply an update to a game that we have the full state of.
+// Returns false if the update doesn't follow on from our state (we missed one),
+// then the full game has to be requested again.
+export const applyGameUpdate = (update: DjangoGameUpdate): boolean => {
+  const game = _.find(chessStore.getState().games, (game) => game.pk == update.pk)
+  if (game === undefined) {
+    return false
+  }
+  // Only moves change the ply
+  const expectedPly = update.event_type == 'board_update' ? game.ply + 1 : game.ply
+  if (update.ply != expectedPly) {
+    return false
+  }
+  const piecesById = new Map<number, GamePiece>()
+  for (let line of game.gameState) {
+    for (let tile of line) {
+      if (tile.piece != null) {
+        piecesById.set(tile.piece.pieceId, tile.piece)
+      }
+    }
+  }
+  const newGameState: GameState = game.gameState.map((line) => line.slice())
+  for (let [key, pieceId] of Object.entries(update.changed)) {
+    const [row, col] = key.split(',').map((x) => parseInt(x))
+    const piece = pieceId === null ? null : piecesById.get(pieceId)
+    if (piece === undefined) {
+      return false
+    }
+    newGameState[row][col] = {row: row, col: col, piece: piece}
+  }
+  chessStore.setState((state) => ({
+    games: _.map(state.games, (g) => g.pk != update.pk ? g : {
+      ...g,
+      gameState: newGameState,
+      whiteToMove: update.white_to_move,
+      result: update.result,
+      drawOffer: update.draw_offer,
+      ply: update.ply,
+      errorMessage: "",
+    })
+  }))
+  return true
+}
+
 export const pieceMapToBoardSetup = (pieceMap: DjangoPieceMap) => {
   const grid = initBoardSetup()
   for (let piece of Object.values(pieceMap)) {
@@ -174,7 +225,8 @@ export const startGame = (game_data: DjangoGameData) => {
       pk: game_pk,
       result: game_data['result'],
       errorMessage: "",
-      drawOffer: game_data['game_state']['draw_offer']
+      drawOffer: game_data['game_state']['draw_offer'],
+      ply: game_data['ply']
     }
     return {games: [...state.games, newGame]}
     }